@@ -0,0 +1,47 @@
+"""
+from aeon import LLMLabeler, Pipeline, Stage, Prompt
+
+Everything is imported lazily on first access, so `import aeon` (and the `aeon` CLI) doesn't pay
+for openai, pandas, etc. until they're actually needed.
+"""
+import importlib
+import importlib.util
+from typing import TYPE_CHECKING
+
+
+# Public names re-exported at the package level, mapped to the module that defines them.
+_EXPORTS = {
+    "LLMLabeler": "aeon.labeling",
+    "Pipeline": "aeon.labeling",
+    "Stage": "aeon.labeling",
+    "Prompt": "aeon.prompt",
+    "Prompts": "aeon.prompt",
+    "ResponseCache": "aeon.cache",
+    "MinHashLSH": "aeon.dedup",
+    "deduplicate": "aeon.dedup",
+    "field_confidence": "aeon.confidence",
+}
+__all__ = list(_EXPORTS)
+
+if TYPE_CHECKING:
+    from aeon.cache import ResponseCache
+    from aeon.confidence import field_confidence
+    from aeon.dedup import MinHashLSH, deduplicate
+    from aeon.labeling import LLMLabeler, Pipeline, Stage
+    from aeon.prompt import Prompt, Prompts
+
+
+def __getattr__(name: str):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    elif importlib.util.find_spec(f"{__name__}.{name}") is not None:
+        # e.g. `aeon.labeling` after a bare `import aeon`.
+        value = importlib.import_module(f"{__name__}.{name}")
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,98 @@
+"""Helpers for openai's Batch API, which processes a JSONL file of requests asynchronously (within
+24 hours) at a discount. Used by `LLMLabeler.label(engine="batch")`.
+
+requests = [to_batch_request(str(i), prompt.kwargs(**row)) for i, row in enumerate(rows)]
+for path, custom_ids in write_batch_files(requests, output_dir/"batch_inputs"):
+    ...  # upload + create batch
+raw, content = parse_batch_response(line["response"]["body"], response_format)
+"""
+import json
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+from openai.lib._parsing._completions import type_to_response_format_param
+from pydantic import BaseModel
+
+
+ENDPOINT = "/v1/chat/completions"
+# Openai's per-batch limits are 50k requests and 200 MB. Leave a little room on the latter.
+MAX_REQUESTS_PER_BATCH = 50_000
+MAX_BYTES_PER_BATCH = 190 * 1024**2
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def to_batch_request(custom_id: str, api_kwargs: dict) -> dict:
+    """Convert kwargs for `client.chat.completions.parse` into one line of a batch input file.
+    The pydantic response_format is converted to the json schema param that `parse` would have
+    sent.
+    """
+    body = dict(api_kwargs)
+    response_format = body.get("response_format")
+    if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+        body["response_format"] = type_to_response_format_param(response_format)
+    return {"custom_id": custom_id, "method": "POST", "url": ENDPOINT, "body": body}
+
+
+def write_batch_files(
+    requests: Iterable[dict],
+    dir_: Union[str, Path],
+    max_requests: int = MAX_REQUESTS_PER_BATCH,
+    max_bytes: int = MAX_BYTES_PER_BATCH,
+) -> list[tuple[Path, list[str]]]:
+    """Write batch requests to as many JSONL files as needed to respect openai's per-batch limits.
+
+    Returns
+    -------
+    list[tuple[Path, list[str]]]
+        One item per batch we need to create: the input file path and the custom_ids it contains.
+    """
+    dir_ = Path(dir_)
+    dir_.mkdir(parents=True, exist_ok=True)
+    files = []
+    f = None
+    n_requests = n_bytes = 0
+    try:
+        for request in requests:
+            line = (json.dumps(request, ensure_ascii=False) + "\n").encode()
+            if f is None or n_requests >= max_requests or n_bytes + len(line) > max_bytes:
+                if f is not None:
+                    f.close()
+                files.append((dir_/f"input-{len(files):03d}.jsonl", []))
+                f = open(files[-1][0], "wb")
+                n_requests = n_bytes = 0
+            f.write(line)
+            files[-1][1].append(request["custom_id"])
+            n_requests += 1
+            n_bytes += len(line)
+    finally:
+        if f is not None:
+            f.close()
+    return files
+
+
+def parse_batch_response(
+    body: dict,
+    response_format: Optional[type[BaseModel]] = None,
+) -> tuple[dict, dict]:
+    """Convert the chat completion body of one batch output line into the same
+    (response_raw, response_content) pair that `LLMLabeler.retryable_api_call` returns. Batch
+    responses are never parsed server side, so we validate the content against `response_format`
+    here (raising a pydantic ValidationError if the model didn't follow the schema).
+    """
+    message = body["choices"][0]["message"]
+    if message.get("refusal"):
+        raise ValueError(f"Model refused to respond: {message['refusal']}")
+    if response_format is None:
+        parsed = message["content"]
+    else:
+        parsed = response_format.model_validate_json(message["content"]).model_dump(mode="json")
+    message["parsed"] = parsed
+    return body, parsed
+
+
+def batch_error_message(line: dict) -> str:
+    """Human readable error for a failed line of a batch output or error file."""
+    if line.get("error"):
+        return json.dumps(line["error"])
+    response = line.get("response") or {}
+    return f"status {response.get('status_code')}: {json.dumps(response.get('body'))}"
@@ -0,0 +1,225 @@
+"""Throughput benchmarks for LLMLabeler against a local mock server (see aeon.mockserver), to
+measure the labeler's own overhead separately from provider latency.
+
+df = run_benchmark(concurrency=(10, 100, 1_000), engines=("thread", "async"), n_rows=2_000)
+# Or from the command line: aeon benchmark --concurrency 10,100,1000
+
+The mock server runs in a subprocess so its CPU time doesn't count towards the labeler's.
+"""
+from collections.abc import Iterable
+from contextlib import contextmanager
+import gc
+import os
+from pathlib import Path
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Iterator, Optional
+
+import pandas as pd
+
+from aeon.labeling import LLMLabeler
+from aeon.logging import logger
+from aeon.prompt import Prompt
+
+
+PROVIDERS = ("openai", "openrouter")
+
+
+def run_benchmark(
+    concurrency: Iterable[int] = (10, 100, 1_000),
+    engines: Iterable[str] = ("thread", "async"),
+    n_rows: int = 2_000,
+    prompt_name: str = "extract_jokes",
+    row_chars: int = 400,
+    latency: str = "lognormal:0.2,0.5",
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    seed: int = 0,
+    **label_kwargs,
+) -> pd.DataFrame:
+    """Label `n_rows` synthetic rows with every combination of engine and concurrency.
+
+    Parameters
+    ----------
+    concurrency : iterable[int]
+        Values of `max_workers` to try.
+    engines : iterable[str]
+        LLMLabeler engines to try ("thread" and/or "async").
+    n_rows : int
+        Rows to label per run.
+    prompt_name : str
+        Prompt to render. Its variables are filled with `row_chars` characters of filler text.
+    row_chars : int
+        Length of each synthetic input.
+    latency : str
+        Mock server latency distribution, see `aeon.mockserver.parse_latency`.
+    error_rate : float
+        Fraction of calls the mock server fails with a 500.
+    rate_limit_rate : float
+        Fraction of calls the mock server fails with a 429.
+    seed : int
+        Mock server seed.
+    label_kwargs : any
+        Forwarded to `LLMLabeler.label`. Caching is disabled unless you pass `cache`.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per run with throughput (rows/s), labeler CPU time per row, peak and added
+        resident memory, latency percentiles, retries, and errors.
+    """
+    variables = Prompt(prompt_name).variables
+    filler = ("lorem ipsum dolor sit amet " * (row_chars // 27 + 1))[:row_chars]
+    df = pd.DataFrame({name: [f"{i} {filler}" for i in range(n_rows)] for name in variables})
+    label_kwargs.setdefault("cache", False)
+    results = []
+    with mock_server(latency, error_rate, rate_limit_rate, seed), \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        for engine in engines:
+            for max_workers in concurrency:
+                logger.info(f"Benchmarking engine={engine!r} with max_workers={max_workers}.")
+                labeler = LLMLabeler(prompt_name, parent_dir=Path(tmp_dir))
+                results.append({
+                    "engine": engine,
+                    "concurrency": max_workers,
+                    **_measure(labeler, df, engine=engine, max_workers=max_workers, **label_kwargs),
+                })
+    return pd.DataFrame(results)
+
+
+def _measure(labeler: LLMLabeler, df: pd.DataFrame, **label_kwargs) -> dict:
+    gc.collect()
+    sampler = RSSSampler()
+    rss_before = rss_bytes()
+    cpu_start = time.process_time()
+    with sampler:
+        res = labeler.label(df, **label_kwargs)
+    cpu_seconds = time.process_time() - cpu_start
+    metrics = res["metrics"]
+    n_rows = metrics["rows"] or 1
+    peak = sampler.peak
+    return {
+        "rows": metrics["rows"],
+        "seconds": res["duration_seconds"],
+        "rows_per_second": metrics["rows"] / res["duration_seconds"],
+        "cpu_ms_per_row": 1_000 * cpu_seconds / n_rows,
+        "peak_rss_mb": None if peak is None else peak / 2**20,
+        "added_rss_mb": None if peak is None or rss_before is None
+        else (peak - rss_before) / 2**20,
+        "p50_latency_seconds": metrics["latency_seconds"]["p50"],
+        "p95_latency_seconds": metrics["latency_seconds"]["p95"],
+        "p95_total_seconds": metrics["total_seconds"]["p95"],
+        "retries": metrics["retries"],
+        "errors": res["n_errors"],
+    }
+
+
+@contextmanager
+def mock_server(
+    latency: str = "lognormal:0.2,0.5",
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    seed: Optional[int] = None,
+) -> Iterator[str]:
+    """Run a mock server in a subprocess and point every provider at it (via the
+    `{PROVIDER}_BASE_URL` env vars) until the block exits. Dummy api keys are set for providers
+    that don't have one, and removed again afterwards. Yields the server's base url.
+    """
+    port = _free_port()
+    cmd = [
+        sys.executable, "-m", "aeon.cli", "mock-server", "--port", str(port),
+        "--latency", latency, "--error-rate", str(error_rate),
+        "--rate-limit-rate", str(rate_limit_rate),
+    ]
+    if seed is not None:
+        cmd += ["--seed", str(seed)]
+    process = subprocess.Popen(cmd)
+    url = f"http://127.0.0.1:{port}/v1"
+    overrides = {f"{provider.upper()}_BASE_URL": url for provider in PROVIDERS}
+    overrides.update({
+        f"{provider.upper()}_API_KEY": "mock" for provider in PROVIDERS
+        if f"{provider.upper()}_API_KEY" not in os.environ
+    })
+    previous = {name: os.environ.get(name) for name in overrides}
+    try:
+        _wait_for_port(port, process)
+        os.environ.update(overrides)
+        yield url
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        process.terminate()
+        process.wait()
+
+
+class RSSSampler:
+    """Track peak resident memory of this process by polling in a background thread, since
+    `ru_maxrss` can't be reset between runs.
+    """
+
+    def __init__(self, interval_seconds: float = 0.05):
+        self.interval_seconds = interval_seconds
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval_seconds)
+
+    def _sample(self):
+        rss = rss_bytes()
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="aeon-rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident memory of this process, or None if we can't tell on this platform."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Mock server exited with code {process.returncode}.")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Mock server didn't start listening on port {port} within {timeout}s.")
@@ -0,0 +1,139 @@
+"""Persistent, content-addressed cache of LLM api responses.
+
+cache = ResponseCache()
+key = cache_key(prompt.kwargs(**row))
+if (hit := cache.get(key)) is None:
+    hit = call_api(...)
+    cache.put(key, hit)
+"""
+import hashlib
+import json
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any, Optional, Union
+import zlib
+
+from pydantic import BaseModel
+
+from aeon.config import CACHE_DIR
+from aeon.logging import logger
+
+
+def cache_key(api_kwargs: dict) -> str:
+    """Hash of fully resolved api kwargs (model, sampling params, rendered messages, etc.). The
+    response_format class is replaced by its name and json schema so that editing a field
+    description or type invalidates old entries.
+    """
+    kwargs = dict(api_kwargs)
+    # Only affects which of the provider's servers handles the request, not the response.
+    kwargs.pop("prompt_cache_key", None)
+    response_format = kwargs.get("response_format")
+    if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+        kwargs["response_format"] = {
+            "name": response_format.__name__,
+            "schema": response_format.model_json_schema(),
+        }
+    serialized = json.dumps(kwargs, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed key/value store with least-recently-used eviction once the stored values
+    exceed `max_bytes`. Values are anything json serializable and are stored zlib compressed.
+    Safe to share across threads.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path] = CACHE_DIR/"responses.sqlite",
+        max_bytes: int = 5 * 1024**3,
+    ):
+        """
+        Parameters
+        ----------
+        path : str or Path
+            SQLite file, by default in the per-user cache dir ($XDG_CACHE_HOME/aeon or
+            ~/.cache/aeon). Parent dirs are created if necessary.
+        max_bytes : int
+            Max total size of (compressed) values. Least recently used entries are evicted
+            once we exceed this.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS accessed_idx ON responses (accessed)")
+        self.n_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for `key` or None if it's missing."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key: str, value: Any):
+        """Store a json serializable value under `key`, evicting old entries if necessary."""
+        blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode())
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), time.time())
+            )
+            self.n_bytes += len(blob) - (old[0] if old else 0)
+            if self.n_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete least recently used entries until we're back under 90% of max_bytes, so we
+        don't have to evict again on every subsequent put. Caller must hold the lock.
+        """
+        target = 0.9 * self.max_bytes
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+        keys = []
+        for key, size in rows:
+            if self.n_bytes <= target:
+                break
+            keys.append((key,))
+            self.n_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        logger.info(f"Evicted {len(keys)} entries from response cache {self.path}.")
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self):
+        """Delete all entries."""
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.n_bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __str__(self):
+        return f"{type(self).__name__}(path={self.path}, n_bytes={self.n_bytes})"
@@ -1,6 +1,6 @@
-from importlib import metadata
 from pathlib import Path
 import shutil
+from typing import Optional
 
 import typer
 
@@ -10,7 +10,21 @@ cli = typer.Typer()
 
 @cli.command()
 def version():
-    print(metadata.version("aeon"))
+    from aeon.config import LIB_ROOT
+
+    # In a source checkout (installed in editable mode or not), read the version straight from
+    # pyproject. importlib.metadata is slow to import and has to scan every installed
+    # distribution to find ours.
+    pyproject = LIB_ROOT/"pyproject.toml"
+    if pyproject.exists():
+        import tomllib
+
+        with open(pyproject, "rb") as f:
+            print(tomllib.load(f)["project"]["version"])
+    else:
+        from importlib import metadata
+
+        print(metadata.version("aeon"))
 
 
 @cli.command()
@@ -30,5 +44,115 @@ def make_prompt(name: str):
     print(f"New prompt template at {file_path} is ready to be updated.")
 
 
+@cli.command()
+def label(
+    prompt: str,
+    input_path: Path,
+    model: Optional[str] = None,
+    max_workers: int = 15,
+    engine: str = "thread",
+    output_dir: Optional[Path] = None,
+    output_format: str = "nested",
+    cache: bool = True,
+    pack_tokens: Optional[int] = None,
+    chunk_tokens: Optional[int] = None,
+    resume_dir: Optional[Path] = None,
+):
+    """Label every row of a parquet file with an aeon prompt (see LLMLabeler.label). Results are
+    streamed to `output.pq` in the output dir rather than loaded into memory.
+
+    Parameters
+    ----------
+    prompt : str
+        Prompt name, e.g. extract_jokes.
+    input_path : Path
+        Parquet file with a column for each of the prompt's variables.
+    model : str or None
+        Overrides the prompt's model.
+    resume_dir : Path or None
+        Output dir of an interrupted run to pick up where it left off.
+    """
+    from aeon.labeling import LLMLabeler
+
+    kwargs = {"model": model} if model else {}
+    res = LLMLabeler(prompt).label(
+        input_path,
+        max_workers=max_workers,
+        engine=engine,
+        output_dir=output_dir,
+        output_format=output_format,
+        cache=cache,
+        pack_tokens=pack_tokens,
+        chunk_tokens=chunk_tokens,
+        resume_dir=resume_dir,
+        return_df=False,
+        **kwargs,
+    )
+    print(
+        f"{'Completed' if res['completed'] else 'Interrupted'} in {res['duration_seconds']:.1f}s "
+        f"with {res['n_errors']} errors. Results: {res['output_path']}"
+    )
+    if not res["completed"]:
+        raise typer.Exit(code=1)
+
+
+@cli.command()
+def mock_server(
+    port: int = 8000,
+    host: str = "127.0.0.1",
+    latency: str = "lognormal:0.5,0.6",
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    seed: Optional[int] = None,
+):
+    """Run a local openai-compatible mock server (see aeon.mockserver). Point labeling at it with
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1.
+    """
+    from aeon.mockserver import MockLLMServer
+
+    MockLLMServer(
+        host=host, port=port, latency=latency, error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate, seed=seed,
+    ).serve_forever()
+
+
+@cli.command()
+def benchmark(
+    concurrency: str = "10,100,1000",
+    engines: str = "thread,async",
+    rows: int = 2_000,
+    prompt: str = "extract_jokes",
+    latency: str = "lognormal:0.2,0.5",
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    output: Optional[Path] = None,
+):
+    """Benchmark LLMLabeler throughput, cpu, and memory against a local mock server.
+
+    Parameters
+    ----------
+    concurrency : str
+        Comma separated max_workers values to try.
+    engines : str
+        Comma separated engines to try.
+    output : Path or None
+        If provided, also save results as csv here.
+    """
+    from aeon.benchmark import run_benchmark
+
+    df = run_benchmark(
+        concurrency=[int(x) for x in concurrency.split(",")],
+        engines=engines.split(","),
+        n_rows=rows,
+        prompt_name=prompt,
+        latency=latency,
+        error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate,
+    )
+    print(df.round(3).to_string(index=False))
+    if output:
+        df.to_csv(output, index=False)
+
+
 if __name__ == "__main__":
     cli()
\ No newline at end of file
@@ -0,0 +1,275 @@
+"""Flat, typed parquet output for labeling runs (`LLMLabeler.label(..., output_format="columnar")`).
+
+Instead of nested dicts per row (raw response, parsed content, and fully rendered api kwargs),
+each top-level field of the prompt's pydantic response_format becomes its own typed Arrow column,
+logprobs go in one list column, and each prompt variable gets a string column. The prompt itself
+(static messages, last message template, and api kwargs) is stored once in the file's metadata.
+
+fmt = ColumnarFormat(Prompt("extract_jokes"))
+fmt.schema  # id, transcript, items (list<struct<joke, prompt, ...>>), logprobs, success, ...
+table = fmt.table(row_results)
+metadata = read_metadata("output.pq")
+messages = render_messages(metadata, df.iloc[0].to_dict())  # What was sent for that row.
+"""
+import json
+from pathlib import Path
+from string import Template
+from typing import Any, Callable, Optional, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydantic import BaseModel
+
+from aeon.prompt import Prompt
+
+
+# Parquet key-value metadata key holding the prompt (see `ColumnarFormat.metadata`).
+METADATA_KEY = b"aeon"
+
+# Row result fields we keep as is, in output order (see `LLMLabeler._init_row_result`).
+RESULT_FIELDS = [
+    ("success", pa.bool_()),
+    ("error", pa.string()),
+    ("finish_reason", pa.string()),
+    ("cached", pa.bool_()),
+    ("cache_key", pa.string()),
+    ("endpoint", pa.string()),
+    ("queue_wait_seconds", pa.float64()),
+    ("latency_seconds", pa.float64()),
+    ("retries", pa.int64()),
+    ("prompt_tokens", pa.int64()),
+    ("cached_tokens", pa.int64()),
+    ("completion_tokens", pa.int64()),
+]
+
+# float32 is plenty for logprobs and halves the size of the biggest column. `bytes` is kept for
+# sampled tokens (a token can be part of a multi-byte character) so `aeon.confidence` can line
+# them up with the response text exactly.
+TOP_LOGPROB_TYPE = pa.struct([("token", pa.string()), ("logprob", pa.float32())])
+LOGPROB_TYPE = pa.struct([
+    ("token", pa.string()),
+    ("bytes", pa.binary()),
+    ("logprob", pa.float32()),
+    ("top_logprobs", pa.list_(TOP_LOGPROB_TYPE)),
+])
+
+# Converts a python value to something pyarrow can store in a column of the matching type.
+Converter = Optional[Callable[[Any], Any]]
+
+
+def _json_dumps(value: Any) -> Optional[str]:
+    return None if value is None else json.dumps(value)
+
+
+def arrow_type(schema: dict, defs: Optional[dict] = None) -> tuple[pa.DataType, Converter]:
+    """Arrow type for values matching a JSON schema (e.g. from pydantic's `model_json_schema`).
+    Anything without a natural Arrow equivalent (unions of several types, objects with arbitrary
+    keys, tuples) is stored as a JSON string.
+
+    Returns
+    -------
+    tuple[pa.DataType, callable or None]
+        The type, and a function to convert python values before building a column of that type,
+        or None if they can be used as is.
+    """
+    defs = schema.get("$defs", defs) or {}
+    if "$ref" in schema:
+        return arrow_type(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+    options = schema.get("anyOf") or schema.get("oneOf")
+    if options:
+        non_null = [option for option in options if option.get("type") != "null"]
+        if len(non_null) == 1:
+            return arrow_type(non_null[0], defs)
+        return pa.string(), _json_dumps
+    if "enum" in schema or "const" in schema:
+        values = schema.get("enum", [schema.get("const")])
+        if all(isinstance(v, bool) for v in values):
+            return pa.bool_(), None
+        if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            return pa.int64(), None
+        if all(isinstance(v, str) for v in values):
+            return pa.string(), None
+        return pa.string(), _json_dumps
+
+    type_ = schema.get("type")
+    if isinstance(type_, list):
+        non_null = [t for t in type_ if t != "null"]
+        if len(non_null) != 1:
+            return pa.string(), _json_dumps
+        type_ = non_null[0]
+    if type_ == "object" and "properties" in schema:
+        return _struct_type(schema["properties"], defs)
+    if type_ == "array" and isinstance(schema.get("items"), dict):
+        item_type, convert = arrow_type(schema["items"], defs)
+        if convert is None:
+            return pa.list_(item_type), None
+        return pa.list_(item_type), \
+            lambda values: None if values is None else [convert(v) for v in values]
+    scalar_types = {
+        "string": pa.string(), "integer": pa.int64(), "number": pa.float64(),
+        "boolean": pa.bool_(), "null": pa.null(),
+    }
+    if type_ in scalar_types:
+        return scalar_types[type_], None
+    return pa.string(), _json_dumps
+
+
+def _struct_type(properties: dict, defs: dict) -> tuple[pa.DataType, Converter]:
+    fields, converters = [], {}
+    for name, prop in properties.items():
+        type_, convert = arrow_type(prop, defs)
+        fields.append((name, type_))
+        if convert is not None:
+            converters[name] = convert
+    if not converters:
+        return pa.struct(fields), None
+
+    def _convert(value: Optional[dict]) -> Optional[dict]:
+        if value is None:
+            return None
+        return {k: converters[k](v) if k in converters else v for k, v in value.items()}
+
+    return pa.struct(fields), _convert
+
+
+def logprobs_column(raw: dict) -> Optional[list[dict]]:
+    """Token logprobs from a raw chat completion, in the shape of LOGPROB_TYPE. None if the
+    response has none.
+    """
+    choices = (raw or {}).get("choices") or [{}]
+    content = (choices[0].get("logprobs") or {}).get("content")
+    if content is None:
+        return None
+    return [
+        {
+            "token": item["token"],
+            "bytes": None if item.get("bytes") is None else bytes(item["bytes"]),
+            "logprob": item["logprob"],
+            "top_logprobs": [
+                {"token": top["token"], "logprob": top["logprob"]}
+                for top in item.get("top_logprobs") or []
+            ],
+        }
+        for item in content
+    ]
+
+
+class ColumnarFormat:
+    """Converts row results for one prompt to records of a fixed Arrow schema:
+
+    - `id`
+    - one string column per prompt variable, holding the value the template was rendered with
+    - one column per top-level response_format field (or a JSON string `response_content` column
+      if the response_format isn't a pydantic model)
+    - `logprobs`, a list of {token, bytes, logprob, top_logprobs} structs, null if not requested
+    - RESULT_FIELDS
+
+    A variable that shares its name with another column is stored as `input_{name}`; the
+    metadata records which column holds each variable.
+    """
+
+    def __init__(self, prompt: Prompt):
+        self.prompt = prompt
+        response_format = prompt.default_kwargs.get("response_format")
+        self._converters = {}
+        content_fields = []
+        if isinstance(response_format, type) and issubclass(response_format, BaseModel):
+            json_schema = response_format.model_json_schema()
+            defs = json_schema.get("$defs", {})
+            for name, prop in json_schema.get("properties", {}).items():
+                type_, convert = arrow_type(prop, defs)
+                content_fields.append((name, type_))
+                if convert is not None:
+                    self._converters[name] = convert
+            self.content_columns = [name for name, _ in content_fields]
+        else:
+            content_fields.append(("response_content", pa.string()))
+            self._converters["response_content"] = _json_dumps
+            self.content_columns = None
+
+        taken = {"id", "logprobs"} | {name for name, _ in content_fields + RESULT_FIELDS}
+        self.variable_columns = {
+            var: f"input_{var}" if var in taken else var for var in prompt.variables
+        }
+        self.schema = pa.schema(
+            [("id", pa.int64())]
+            + [(column, pa.string()) for column in self.variable_columns.values()]
+            + content_fields
+            + [("logprobs", pa.list_(LOGPROB_TYPE))]
+            + RESULT_FIELDS,
+            metadata={METADATA_KEY: json.dumps(self.metadata, default=str).encode()},
+        )
+
+    @property
+    def metadata(self) -> dict:
+        """Everything needed to reconstruct each row's api kwargs, stored once per file."""
+        kwargs = {
+            k: v for k, v in self.prompt.default_kwargs.items()
+            if k not in ("messages", "response_format")
+        }
+        return {
+            "format": "columnar",
+            "prompt_name": self.prompt.name,
+            "messages": self.prompt.static_messages + [{
+                "role": self.prompt.last_role,
+                "content": self.prompt.last_template.template,
+            }],
+            "variables": self.variable_columns,
+            "kwargs": kwargs,
+        }
+
+    def record(self, res: dict) -> dict:
+        """Flatten one row result (from `LLMLabeler`, with `variables`) into a record matching
+        `schema`. Records that are already flat (e.g. read back from a previous output) are
+        returned unchanged.
+        """
+        if "response_content" not in res:
+            return res
+        record = {"id": res["id"]}
+        variables = res.get("variables") or {}
+        for var, column in self.variable_columns.items():
+            record[column] = variables.get(var)
+        content = res["response_content"] if res["success"] else None
+        if self.content_columns is None:
+            record["response_content"] = content or None
+        else:
+            content = content if isinstance(content, dict) else {}
+            for name in self.content_columns:
+                record[name] = content.get(name)
+        for name, convert in self._converters.items():
+            record[name] = convert(record[name])
+        raw = res.get("response_raw") or {}
+        record["logprobs"] = logprobs_column(raw)
+        record["finish_reason"] = ((raw.get("choices") or [{}])[0]).get("finish_reason")
+        for name, _ in RESULT_FIELDS:
+            record.setdefault(name, res.get(name))
+        return record
+
+    def table(self, results: list[dict]) -> pa.Table:
+        """Arrow table of row results (see `record`)."""
+        return pa.Table.from_pylist([self.record(res) for res in results], schema=self.schema)
+
+
+def read_metadata(path: Union[str, Path]) -> Optional[dict]:
+    """Prompt metadata of a columnar output file, or None if it's in the nested format."""
+    metadata = pq.read_schema(path).metadata or {}
+    if METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[METADATA_KEY])
+
+
+def render_messages(metadata: dict, row: dict) -> list[dict]:
+    """Rebuild the messages sent for one row of a columnar output file (as if it wasn't packed).
+
+    Parameters
+    ----------
+    metadata : dict
+        From `read_metadata`.
+    row : dict
+        One row of the output, or any dict containing its variable columns.
+    """
+    *static, last = metadata["messages"]
+    variables = {var: row[column] for var, column in metadata["variables"].items()}
+    return [dict(m) for m in static] + [
+        {"role": last["role"], "content": Template(last["content"]).substitute(**variables)}
+    ]
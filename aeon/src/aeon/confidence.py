@@ -0,0 +1,401 @@
+"""Per-field confidence for structured outputs, computed from token logprobs.
+
+Each sampled token is mapped back to the JSON field its text falls in, e.g. `joke` or `ranking`
+(fields nested in lists are collapsed, so every joke extract_jokes returns counts towards
+`items.joke`), and we report the mean and min token logprob per field and row. Everything runs
+on flat NumPy arrays for the whole run at once: the responses' JSON is scanned with vectorized
+masks rather than parsed row by row.
+
+paths = field_paths(BatchResponse)  # ["items", "items.joke", "items.prompt", ...]
+df_conf = field_confidence(df_labeled, paths)  # Columns like "items.joke_logprob_min".
+df_labeled[df_conf["items.joke_logprob_min"] > -2]
+add_field_confidence("output.pq", paths)  # Or append the columns to a run's output in place.
+
+Logprobs describe a whole response, so for rows answered as part of a packed request the
+confidence covers every row in that request.
+"""
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pydantic import BaseModel
+
+
+WHITESPACE = np.array([ord(c) for c in " \t\n\r"], dtype=np.uint8)
+
+
+def confidence_columns(paths: list[str]) -> list[str]:
+    """Names of the columns `field_confidence` returns for these field paths."""
+    return [f"{path}_logprob_{stat}" for path in paths for stat in ("mean", "min")]
+
+
+def field_paths(response_format: type[BaseModel]) -> list[str]:
+    """Dotted paths of every field in a pydantic response_format, parents before children. List
+    items don't add a level: `BatchResponse` gives "items", "items.joke", "items.prompt", ....
+    """
+    schema = response_format.model_json_schema()
+    defs = schema.get("$defs", {})
+    paths = []
+
+    def _walk(node: dict, prefix: str, refs: frozenset):
+        if "$ref" in node:
+            ref = node["$ref"].rsplit("/", 1)[-1]
+            # Recursive models would otherwise go on forever.
+            if ref not in refs:
+                _walk(defs[ref], prefix, refs | {ref})
+            return
+        for option in node.get("anyOf") or node.get("oneOf") or []:
+            _walk(option, prefix, refs)
+        if isinstance(node.get("items"), dict):
+            _walk(node["items"], prefix, refs)
+        for name, prop in (node.get("properties") or {}).items():
+            path = f"{prefix}.{name}" if prefix else name
+            if path not in paths:
+                paths.append(path)
+            _walk(prop, path, refs)
+
+    _walk(schema, "", frozenset())
+    return paths
+
+
+def logprobs_array(table: pa.Table) -> Optional[pa.Array]:
+    """Per-row token logprobs (a list<struct<token, logprob, ...>> array) from labeling output in
+    either format: the `logprobs` column of columnar output, or `response_raw` of nested output.
+    None if the output has no logprobs at all.
+    """
+    if "logprobs" in table.column_names:
+        array = table.column("logprobs")
+    elif "response_raw" in table.column_names:
+        array = table.column("response_raw")
+        for step in ("choices", 0, "logprobs", "content"):
+            array = array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array
+            if isinstance(step, int):
+                if not pa.types.is_list(array.type):
+                    return None
+                array = pc.list_element(array, step)
+            else:
+                if not pa.types.is_struct(array.type) or array.type.get_field_index(step) < 0:
+                    return None
+                array = pc.struct_field(array, step)
+    else:
+        return None
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if not pa.types.is_list(array.type) or not pa.types.is_struct(array.type.value_type):
+        return None
+    return array
+
+
+def field_confidence(
+    data: Union[pd.DataFrame, pa.Table],
+    paths: Optional[list[str]] = None,
+) -> pd.DataFrame:
+    """Mean and min token logprob of each field, per row.
+
+    Parameters
+    ----------
+    data : pd.DataFrame or pa.Table
+        Labeling output in either format (see `logprobs_array`).
+    paths : list[str] or None
+        Field paths to report, e.g. from `field_paths`. Fields a row doesn't have are NaN. If
+        None, every path found in the responses is reported, in order of first appearance.
+
+    Returns
+    -------
+    pd.DataFrame
+        Same index as `data`, with `{path}_logprob_mean` and `{path}_logprob_min` columns.
+    """
+    if isinstance(data, pd.DataFrame):
+        index = data.index
+        column = "logprobs" if "logprobs" in data.columns else "response_raw"
+        table = pa.Table.from_pandas(data[[column]], preserve_index=False) \
+            if column in data.columns else pa.table({})
+    else:
+        index = pd.RangeIndex(data.num_rows)
+        table = data
+    logprobs = logprobs_array(table)
+    if logprobs is None:
+        found, sums, counts, mins = [], *[np.zeros((len(index), 0))] * 3
+    else:
+        found, sums, counts, mins = _field_stats(logprobs)
+
+    paths = found if paths is None else paths
+    columns = {}
+    for path in paths:
+        if path in found:
+            j = found.index(path)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                columns[f"{path}_logprob_mean"] = np.where(
+                    counts[:, j] > 0, sums[:, j] / counts[:, j], np.nan
+                )
+            columns[f"{path}_logprob_min"] = np.where(counts[:, j] > 0, mins[:, j], np.nan)
+        else:
+            columns[f"{path}_logprob_mean"] = np.full(len(index), np.nan)
+            columns[f"{path}_logprob_min"] = np.full(len(index), np.nan)
+    return pd.DataFrame(columns, index=index)
+
+
+def add_field_confidence(path: Union[str, Path], paths: list[str]) -> list[str]:
+    """Append `field_confidence` columns to a labeling output parquet file in place, one row
+    group at a time so the file never has to fit in memory.
+
+    Returns
+    -------
+    list[str]
+        Names of the added columns.
+    """
+    path = Path(path)
+    names = confidence_columns(paths)
+    parquet_file = pq.ParquetFile(path)
+    schema = parquet_file.schema_arrow
+    for name in names:
+        if name in schema.names:
+            schema = schema.remove(schema.get_field_index(name))
+        schema = schema.append(pa.field(name, pa.float64()))
+    tmp_path = Path(f"{path}.tmp")
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for i in range(parquet_file.num_row_groups):
+            table = parquet_file.read_row_group(i)
+            table = table.drop_columns([name for name in names if name in table.column_names])
+            conf = field_confidence(table, paths)
+            for name in names:
+                table = table.append_column(name, pa.array(conf[name].to_numpy(), pa.float64()))
+            writer.write_table(table.cast(schema))
+    os.replace(tmp_path, path)
+    return names
+
+
+def _token_arrays(logprobs: pa.Array) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Flatten per-row token logprobs.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        Tokens per row, each token's logprob, each token's length in bytes, and the bytes of all
+        tokens of all rows concatenated (i.e. every row's response text back to back).
+    """
+    tokens_per_row = pc.fill_null(pc.list_value_length(logprobs), 0).to_numpy().astype(np.int64)
+    items = logprobs.flatten()
+    fields = dict(zip([field.name for field in items.type], items.flatten()))
+    logprob = pc.fill_null(fields["logprob"].cast(pa.float64()), np.nan) \
+        .to_numpy(zero_copy_only=False)
+
+    token_bytes = fields.get("bytes")
+    if token_bytes is None or token_bytes.null_count:
+        token_bytes = pc.fill_null(fields["token"], "").cast(pa.binary())
+    if pa.types.is_list(token_bytes.type) or pa.types.is_large_list(token_bytes.type):
+        lengths = pc.list_value_length(token_bytes).to_numpy().astype(np.int64)
+        text = token_bytes.flatten().to_numpy(zero_copy_only=False).astype(np.uint8)
+    else:
+        token_bytes = token_bytes.cast(pa.large_binary())
+        lengths = pc.binary_length(token_bytes).to_numpy().astype(np.int64)
+        offsets = np.frombuffer(token_bytes.buffers()[1], dtype=np.int64)
+        offsets = offsets[token_bytes.offset:token_bytes.offset + len(token_bytes) + 1]
+        text = np.frombuffer(token_bytes.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]]
+    return tokens_per_row, logprob, lengths, text
+
+
+def _field_stats(logprobs: pa.Array) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Sum, count, and min of token logprobs per (row, field path).
+
+    Returns
+    -------
+    tuple[list[str], np.ndarray, np.ndarray, np.ndarray]
+        Paths in order of first appearance, then three (n_rows, n_paths) arrays.
+    """
+    tokens_per_row, logprob, token_lengths, text = _token_arrays(logprobs)
+    n_rows = len(tokens_per_row)
+    empty = [], *[np.zeros((n_rows, 0))] * 3
+    if not len(text):
+        return empty
+
+    # Byte offsets of tokens and rows in `text`.
+    token_end = np.cumsum(token_lengths)
+    token_start = token_end - token_lengths
+    row_token_bounds = np.concatenate([[0], np.cumsum(tokens_per_row)])
+    byte_bounds = np.concatenate([[0], token_end])[row_token_bounds]
+    row_start, row_end = byte_bounds[:-1], byte_bounds[1:]
+    n = len(text)
+    row_of = np.repeat(np.arange(n_rows), row_end - row_start)
+    # Index of the first byte of each byte's row, for running totals that restart every row.
+    first = np.minimum(row_start, n - 1)[row_of]
+
+    # Quotes that aren't escaped, i.e. not preceded by an odd number of backslashes.
+    position = np.arange(n)
+    is_backslash = text == ord("\\")
+    last_other = np.maximum.accumulate(np.where(is_backslash, -1, position))
+    backslashes_before = np.zeros(n, dtype=np.int64)
+    backslashes_before[1:] = position[:-1] - last_other[:-1]
+    quote = (text == ord('"')) & (backslashes_before % 2 == 0)
+
+    # Inside a string (including its quotes) if an odd number of quotes opened before us in this
+    # row, or if we are a quote.
+    quotes_so_far = np.cumsum(quote)
+    in_string = ((quotes_so_far - (quotes_so_far - quote)[first]) % 2 == 1) | quote
+    structural = ~in_string
+    opens = structural & ((text == ord("{")) | (text == ord("[")))
+    closes = structural & ((text == ord("}")) | (text == ord("]")))
+    delta = opens.astype(np.int64) - closes
+    # Number of brackets open before each byte, so a closing bracket has the same depth as the
+    # commas and colons it encloses.
+    depth = np.cumsum(delta) - delta
+    depth = depth - depth[first]
+
+    # Every structural colon follows a key: its value starts at the next non-whitespace byte and
+    # ends at the next comma or closing bracket at the same depth (or the end of the row if the
+    # response was cut off).
+    colons = np.flatnonzero(structural & (text == ord(":")))
+    if not len(colons):
+        return empty
+    quote_positions = np.flatnonzero(quote)
+    k = np.searchsorted(quote_positions, colons) - 1
+    valid = k >= 1
+    colons, k = colons[valid], k[valid]
+    key_start, key_end = quote_positions[k - 1] + 1, quote_positions[k]
+    key_row, key_depth = row_of[colons], depth[colons]
+
+    non_space = np.flatnonzero(~np.isin(text, WHITESPACE))
+    next_non_space = np.searchsorted(non_space, colons, "right")
+    value_start = non_space[np.minimum(next_non_space, len(non_space) - 1)]
+    value_start = np.minimum(value_start, row_end[key_row])
+
+    terminators = np.flatnonzero(structural & ((text == ord(",")) | closes))
+    max_depth = int(depth.max()) + 1
+
+    def _group(rows, depths):
+        return rows.astype(np.int64) * max_depth + depths
+
+    term_keys = _group(row_of[terminators], depth[terminators]) * (n + 1) + terminators
+    order = np.argsort(term_keys, kind="stable")
+    term_keys, terminators = term_keys[order], terminators[order]
+    group = _group(key_row, key_depth)
+    j = np.searchsorted(term_keys, group * (n + 1) + colons, "right")
+    j_clipped = np.minimum(j, len(term_keys) - 1)
+    found = (j < len(term_keys)) & (term_keys[j_clipped] // (n + 1) == group)
+    value_end = np.where(found, terminators[j_clipped], row_end[key_row])
+
+    names, name_ids = _key_names(text, key_start, key_end)
+    path_ids, paths = _key_paths(key_row, key_depth, name_ids, names)
+
+    # Tokens that start inside each value.
+    lo = np.searchsorted(token_start, value_start, "left")
+    hi = np.searchsorted(token_start, value_end, "left")
+    hi = np.maximum(hi, lo)
+    finite = np.nan_to_num(logprob, nan=0.0)
+    cumulative = np.concatenate([[0.0], np.cumsum(finite)])
+    value_sums = cumulative[hi] - cumulative[lo]
+    value_counts = hi - lo
+    value_mins = _range_mins(logprob, lo, hi, path_ids, len(paths))
+
+    sums = np.zeros((n_rows, len(paths)))
+    counts = np.zeros((n_rows, len(paths)), dtype=np.int64)
+    mins = np.full((n_rows, len(paths)), np.inf)
+    np.add.at(sums, (key_row, path_ids), value_sums)
+    np.add.at(counts, (key_row, path_ids), value_counts)
+    np.minimum.at(mins, (key_row, path_ids), value_mins)
+    return paths, sums, counts, mins
+
+
+def _key_names(
+    text: np.ndarray,
+    key_start: np.ndarray,
+    key_end: np.ndarray,
+) -> tuple[list[str], np.ndarray]:
+    """Decode each distinct key once.
+
+    Returns
+    -------
+    tuple[list[str], np.ndarray]
+        Distinct key names, and the index into them of every key.
+    """
+    lengths = key_end - key_start
+    width = max(int(lengths.max()), 1)
+    offsets = np.arange(width)
+    padded = text[np.minimum(key_start[:, None] + offsets, len(text) - 1)]
+    # JSON strings can't contain raw NUL bytes, so zero padding can't make two keys collide.
+    padded = np.where(offsets < lengths[:, None], padded, 0).astype(np.uint8)
+    unique, name_ids = np.unique(padded, axis=0, return_inverse=True)
+    names = []
+    for row in unique:
+        raw = row.tobytes().rstrip(b"\0").decode("utf-8", errors="replace")
+        try:
+            names.append(json.loads(f'"{raw}"'))
+        except json.JSONDecodeError:
+            names.append(raw)
+    return names, name_ids.reshape(-1)
+
+
+def _key_paths(
+    key_row: np.ndarray,
+    key_depth: np.ndarray,
+    name_ids: np.ndarray,
+    names: list[str],
+) -> tuple[np.ndarray, list[str]]:
+    """Dotted path of every key (keys are in document order). A key's parent is the closest
+    preceding key in the same row at a lower depth.
+
+    Returns
+    -------
+    tuple[np.ndarray, list[str]]
+        Index into the paths of every key, and the distinct paths.
+    """
+    path_ids = np.full(len(key_row), -1, dtype=np.int64)
+    paths, path_index = [], {}
+    for depth in np.unique(key_depth):
+        at_depth = np.flatnonzero(key_depth == depth)
+        candidates = np.flatnonzero(key_depth < depth)
+        parents = np.full(len(at_depth), -1, dtype=np.int64)
+        if len(candidates):
+            j = np.searchsorted(candidates, at_depth) - 1
+            ok = j >= 0
+            parent = candidates[np.maximum(j, 0)]
+            ok &= key_row[parent] == key_row[at_depth]
+            parents = np.where(ok, parent, -1)
+        parent_paths = np.where(parents >= 0, path_ids[np.maximum(parents, 0)], -1)
+        pairs, inverse = np.unique(
+            np.stack([parent_paths, name_ids[at_depth]], axis=1), axis=0, return_inverse=True
+        )
+        ids = []
+        for parent_path, name_id in pairs:
+            path = names[name_id] if parent_path < 0 else f"{paths[parent_path]}.{names[name_id]}"
+            if path not in path_index:
+                path_index[path] = len(paths)
+                paths.append(path)
+            ids.append(path_index[path])
+        path_ids[at_depth] = np.asarray(ids, dtype=np.int64)[inverse.reshape(-1)]
+    return path_ids, paths
+
+
+def _range_mins(
+    values: np.ndarray,
+    lo: np.ndarray,
+    hi: np.ndarray,
+    groups: np.ndarray,
+    n_groups: int,
+) -> np.ndarray:
+    """Min of `values[lo:hi]` for every range (inf if empty). Ranges of the same group (field
+    path) never overlap unless the schema is recursive, so each group is one `reduceat`.
+    """
+    padded = np.append(values, np.inf)
+    mins = np.full(len(lo), np.inf)
+    for group in range(n_groups):
+        idx = np.flatnonzero(groups == group)
+        if not len(idx):
+            continue
+        idx = idx[np.argsort(lo[idx], kind="stable")]
+        group_lo, group_hi = lo[idx], hi[idx]
+        if np.all(group_lo[1:] >= group_hi[:-1]):
+            bounds = np.empty(2 * len(idx), dtype=np.int64)
+            bounds[0::2], bounds[1::2] = group_lo, group_hi
+            group_mins = np.minimum.reduceat(padded, bounds)[0::2]
+        else:
+            group_mins = np.array([padded[a:b].min() if b > a else np.inf
+                                   for a, b in zip(group_lo, group_hi)])
+        mins[idx] = np.where(group_hi > group_lo, group_mins, np.inf)
+    return mins
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 
@@ -5,4 +6,6 @@ from pathlib import Path
 LIB_ROOT = Path(__file__).parent.parent.parent
 # The dir containing both aeon and nanochat libs.
 PROJECT_ROOT = LIB_ROOT.parent
-DATA_DIR = LIB_ROOT/"data"
\ No newline at end of file
+DATA_DIR = LIB_ROOT/"data"
+# Per-user cache (e.g. api responses), outside the repo.
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home()/".cache")/"aeon"
@@ -4,7 +4,7 @@ from huggingface_hub import login, HfApi
 import pandas as pd
 
 from aeon import config
-from aeon.secrets import SecretManager
+from aeon.secrets import get_secret
 
 
 def save_dataset(df: pd.DataFrame, name: str, upload_to_hub: bool = True) -> None:
@@ -19,8 +19,7 @@ def save_dataset(df: pd.DataFrame, name: str, upload_to_hub: bool = True) -> Non
         if not hub_token:
             raise ValueError("hub_token must be provided when upload_to_hub is True.")
 
-        secrets = SecretManager().get_secrets()
-        login(secrets["HUGGINGFACE_TOKEN"])
+        login(get_secret("HUGGINGFACE_TOKEN"))
         hf_api = HfApi()
         hf_api.add_collection_item(
             collection_slug="hmamin/aeon",
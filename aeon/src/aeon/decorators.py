@@ -2,9 +2,32 @@
 from typing import Callable
 
 
+class _LazyCompletions(type):
+    """Metaclass for `tab_completion` classes: attributes are computed on first access (or on
+    `dir()`, which is what tab completion calls) rather than when the class is defined.
+    """
+
+    def _values(cls) -> dict:
+        if "_completions" not in cls.__dict__:
+            cls._completions = {val.upper(): val for val in cls._completions_func()}
+        return cls._completions
+
+    def __getattr__(cls, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return cls._values()[name]
+        except KeyError:
+            raise AttributeError(f"type object {cls.__name__!r} has no attribute {name!r}")
+
+    def __dir__(cls):
+        return sorted(set(super().__dir__()) | set(cls._values()))
+
+
 def tab_completion(func: Callable):
     """Create class attributes from the results of some function. Helpful for creating minimal
-    classes that mostly exist to provide tab completion.
+    classes that mostly exist to provide tab completion. `func` isn't called until an attribute
+    is first looked up, so defining the class is free.
 
     Arguments
     ---------
@@ -17,9 +40,8 @@ def tab_completion(func: Callable):
     class Pets:
         ...
     """
-    values = func()
     def decorator(cls):
-        for val in values:
-            setattr(cls, val.upper(), val)
-        return cls
+        namespace = {k: v for k, v in cls.__dict__.items() if k not in ("__dict__", "__weakref__")}
+        namespace["_completions_func"] = staticmethod(func)
+        return _LazyCompletions(cls.__name__, cls.__bases__, namespace)
     return decorator
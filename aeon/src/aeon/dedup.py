@@ -0,0 +1,304 @@
+"""Near-duplicate detection with MinHash + LSH, e.g. to stop labeling the same joke twice when it
+shows up (slightly reworded) in several transcripts.
+
+index = MinHashLSH(threshold=0.8)
+duplicate_of = index.add(["Why did the chicken...", "why did the chicken...!", "Knock knock"])
+# array([0, 0, 2]): the 2nd text is a near-duplicate of the 1st.
+index.clusters()  # Final cluster of every text added so far (its first member's id).
+
+df = deduplicate(jokes, "joke", output_path="data/jokes_clusters.pq")
+df[~df.duplicate]
+
+Pipelines can drop near-duplicate rows between stages, see `Stage(..., dedup="joke")`.
+
+Texts are lowercased, stripped of punctuation, and split into overlapping byte shingles. Each
+text's MinHash signature estimates the Jaccard similarity of its shingle set to any other's. LSH
+splits signatures into bands and only compares texts that share a band exactly, so each insert
+costs about the same no matter how big the index is. Candidates are confirmed by their estimated
+similarity before being clustered (union-find, so clusters are transitive). Memory is about
+`4 * num_perm + 16 * bands` bytes per text (~350MB per million texts with the defaults).
+"""
+import re
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from aeon.logging import logger
+
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase and replace runs of punctuation/whitespace with a single space."""
+    return _NON_WORD.sub(" ", text.lower()).strip()
+
+
+def lsh_params(threshold: float, num_perm: int) -> tuple[int, int]:
+    """Number of bands and rows per band (bands * rows <= num_perm) minimizing the expected rate
+    of false positives (similarity below `threshold` but sharing a band) plus false negatives
+    (similarity above it but sharing no band), assuming uniformly distributed similarities.
+    """
+    s = np.linspace(0, 1, 1001)
+    best, best_error = (1, num_perm), float("inf")
+    for rows in range(1, num_perm + 1):
+        bands = np.arange(1, num_perm // rows + 1)[:, None]
+        p_candidate = 1 - (1 - s ** rows) ** bands
+        fp = np.where(s < threshold, p_candidate, 0).mean(axis=1)
+        fn = np.where(s >= threshold, 1 - p_candidate, 0).mean(axis=1)
+        i = int(np.argmin(fp + fn))
+        if fp[i] + fn[i] < best_error:
+            best, best_error = (i + 1, rows), fp[i] + fn[i]
+    return best
+
+
+class _Buckets:
+    """One LSH band's buckets: maps uint64 keys to the id of the first text added with that key.
+
+    Most keys live in sorted numpy arrays (16 bytes each, looked up a batch at a time with
+    searchsorted); recent ones go in a dict that is merged into the arrays once it gets big, so
+    inserts stay cheap without paying python object overhead for millions of keys.
+    """
+
+    def __init__(self, min_merge_size: int = 100_000):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.recent = {}
+        self.min_merge_size = min_merge_size
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.recent)
+
+    def setdefault(self, keys: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        """Add each (key, id) pair in order unless the key is already taken.
+
+        Returns
+        -------
+        np.ndarray
+            For each pair, the id stored under its key: its own id if it was new, or the first
+            one added with that key otherwise.
+        """
+        out = ids.copy()
+        hit = np.zeros(len(keys), dtype=bool)
+        if len(self.keys):
+            pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            hit = self.keys[pos] == keys
+            out[hit] = self.ids[pos[hit]]
+        recent = self.recent
+        miss = np.flatnonzero(~hit)
+        for j, key, id_ in zip(miss.tolist(), keys[miss].tolist(), ids[miss].tolist()):
+            out[j] = recent.setdefault(key, id_)
+        if len(recent) > max(self.min_merge_size, len(self.keys) // 2):
+            self._merge()
+        return out
+
+    def _merge(self):
+        keys = np.concatenate([self.keys, np.fromiter(self.recent, np.uint64, len(self.recent))])
+        ids = np.concatenate([
+            self.ids, np.fromiter(self.recent.values(), np.int64, len(self.recent))
+        ])
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.ids = keys[order], ids[order]
+        self.recent = {}
+
+
+class MinHashLSH:
+    """Online near-duplicate index. Texts get sequential ids (0, 1, ...) in the order they're
+    added, and each cluster is identified by the id of its first member.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 64,
+        shingle_size: int = 5,
+        batch_size: int = 10_000,
+        seed: int = 0,
+    ):
+        """
+        Parameters
+        ----------
+        threshold : float
+            Estimated Jaccard similarity (of the texts' shingle sets) above which two texts are
+            considered duplicates.
+        num_perm : int
+            MinHash signature size. More is more accurate but slower and bigger.
+        shingle_size : int
+            Shingle length in bytes (at most 8). Texts shorter than this are a single shingle.
+        batch_size : int
+            Max texts to compute signatures for at once in `add`, to bound memory.
+        seed : int
+            Seeds the hash permutations. Indexes with different seeds aren't comparable.
+        """
+        if not 0 < threshold <= 1:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}.")
+        if not 1 <= shingle_size <= 8:
+            raise ValueError(f"shingle_size must be between 1 and 8, got {shingle_size}.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.batch_size = batch_size
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        rng = np.random.default_rng(seed)
+        # Multiply-add-shift hashes of 32-bit shingles, cheaper than the usual modulo a prime.
+        self._a = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) * np.uint64(2) + 1
+        self._b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self._buckets = [_Buckets() for _ in range(self.bands)]
+        self._signatures = np.empty((0, num_perm), dtype=np.uint32)
+        self._parent = np.empty(0, dtype=np.int64)
+        self.size = 0
+        self.n_duplicates = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def signatures(self, texts: list[str]) -> np.ndarray:
+        """MinHash signatures of `texts`, shape (len(texts), num_perm), dtype uint32."""
+        k = self.shingle_size
+        encoded = [normalize(text).encode() for text in texts]
+        lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+        # Pad after every text so short (or empty) texts' single shingle never reads into the
+        # next one.
+        pad = b"\0" * k
+        buf = np.frombuffer(pad.join(encoded) + pad, dtype=np.uint8).astype(np.uint64)
+        starts = np.concatenate([[0], np.cumsum(lengths + k)[:-1]])
+        n_shingles = np.maximum(lengths - k + 1, 1)
+        offsets = np.concatenate([[0], np.cumsum(n_shingles)])
+        pos = np.repeat(starts - offsets[:-1], n_shingles) + np.arange(offsets[-1])
+        # Pack each shingle's bytes into one int, then mix it down to 32 bits.
+        shingles = np.zeros(len(pos), dtype=np.uint64)
+        for j in range(k):
+            shingles |= buf[pos + j] << np.uint64(8 * j)
+        shingles = (shingles * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+
+        signatures = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        for p in range(self.num_perm):
+            hashed = (self._a[p] * shingles + self._b[p]) >> np.uint64(32)
+            signatures[:, p] = np.minimum.reduceat(hashed, offsets[:-1])
+        return signatures
+
+    def add(self, texts: list[str]) -> np.ndarray:
+        """Add texts to the index, in order.
+
+        Returns
+        -------
+        np.ndarray
+            For each text, the id of the cluster it joined, i.e. of the earliest near-duplicate
+            added before it (including earlier texts in the same call), or its own id if it's
+            the first of its kind.
+        """
+        return np.concatenate([
+            self._add_batch(texts[start:start + self.batch_size])
+            for start in range(0, len(texts), self.batch_size)
+        ] or [np.empty(0, dtype=np.int64)])
+
+    def _add_batch(self, texts: list[str]) -> np.ndarray:
+        signatures = self.signatures(texts)
+        ids = np.arange(self.size, self.size + len(texts))
+        self._signatures = _append(self._signatures, signatures, self.size)
+        self._parent = _append(self._parent, ids, self.size)
+        self.size += len(texts)
+
+        pairs = []
+        for band, buckets in enumerate(self._buckets):
+            first = buckets.setdefault(self._band_keys(signatures, band), ids)
+            matched = first != ids
+            pairs.append(np.stack([ids[matched], first[matched]], axis=1))
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+        if len(pairs):
+            # LSH only finds candidates, keep those that really are similar enough.
+            similarity = (
+                self._signatures[pairs[:, 0]] == self._signatures[pairs[:, 1]]
+            ).mean(axis=1)
+            for i, j in pairs[similarity >= self.threshold].tolist():
+                self._union(i, j)
+
+        roots = np.array([self._find(i) for i in ids.tolist()], dtype=np.int64)
+        self.n_duplicates += int((roots != ids).sum())
+        return roots
+
+    def _band_keys(self, signatures: np.ndarray, band: int) -> np.ndarray:
+        """64-bit FNV-style hash of each signature's values in `band`."""
+        keys = np.full(len(signatures), 0xCBF29CE484222325 ^ band, dtype=np.uint64)
+        for col in range(band * self.rows, (band + 1) * self.rows):
+            keys = (keys ^ signatures[:, col]) * np.uint64(0x100000001B3)
+        return keys
+
+    def _find(self, i: int) -> int:
+        parent = self._parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = int(parent[i])
+        return i
+
+    def _union(self, i: int, j: int):
+        # The smaller id wins so a cluster's root is always its first member.
+        ri, rj = self._find(i), self._find(j)
+        if ri != rj:
+            self._parent[max(ri, rj)] = min(ri, rj)
+
+    def clusters(self) -> np.ndarray:
+        """Cluster id (id of the first member) of every text added so far. Unlike the ids
+        returned by `add`, these account for clusters that were merged by later texts.
+        """
+        roots = self._parent[:self.size].copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+
+def _append(array: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    """Write `values` after the first `size` rows of `array`, growing it geometrically."""
+    needed = size + len(values)
+    if needed > len(array):
+        grown = np.empty((max(needed, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+        grown[:size] = array[:size]
+        array = grown
+    array[size:needed] = values
+    return array
+
+
+def deduplicate(
+    df: pd.DataFrame,
+    column: str,
+    threshold: float = 0.8,
+    output_path: Optional[Union[str, Path]] = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """Find near-duplicate rows of a df by the text in one column.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    column : str
+        Text to compare.
+    threshold : float
+        See `MinHashLSH`.
+    output_path : str or Path, optional
+        If given, save the cluster assignments (df's index, `cluster`, `duplicate`) here as
+        parquet, e.g. next to the dataset they describe.
+    kwargs : any
+        Forwarded to `MinHashLSH`.
+
+    Returns
+    -------
+    pd.DataFrame
+        Copy of df with a `cluster` column (position of the cluster's first row in df) and
+        `duplicate` (True for every row but the first of its cluster).
+    """
+    index = MinHashLSH(threshold=threshold, **kwargs)
+    index.add(df[column].fillna("").astype(str).tolist())
+    clusters = index.clusters()
+    df = df.assign(cluster=clusters, duplicate=clusters != np.arange(len(df)))
+    logger.info(
+        f"Found {df.duplicate.sum():,} near-duplicates of {len(df):,} rows "
+        f"({df.cluster.nunique():,} clusters)."
+    )
+    if output_path is not None:
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        df[["cluster", "duplicate"]].to_parquet(output_path)
+    return df
@@ -4,35 +4,56 @@ from aeon import prompts
 labeler = Labeler(prompt="extract_jokes")
 df_labeled = labeler.label(df.id, df.text, output_dir="data/labeled", threads=10)
 """
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import importlib.util
+from collections.abc import Iterable, Iterator, Sized
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, FIRST_EXCEPTION, ThreadPoolExecutor, wait
 import logging
 import os
 from pathlib import Path
 import json
+import queue
 from pydantic import BaseModel
 import shutil
+import threading
+import time
 from tenacity import (
-    retry, stop_after_attempt, wait_exponential, before_sleep_log, retry_if_exception_type,
-    wait_chain, wait_fixed
+    retry, stop_after_attempt, before_sleep_log, retry_if_exception_type, wait_exponential,
+    wait_random
 )
 from tqdm.auto import tqdm
-from typing import Any, Union
+from typing import Any, Callable, Optional, Union
 import traceback
 import yaml
 
-from openai import OpenAI
-from openai._exceptions import RateLimitError, InternalServerError
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+from openai._exceptions import APIConnectionError, RateLimitError, InternalServerError
+from openai._legacy_response import LegacyAPIResponse
+from openai.types import Batch
 from openai.types.chat.parsed_chat_completion import ParsedChatCompletion
 import pandas as pd
+import pyarrow.parquet as pq
 
+from aeon.batch import (
+    ENDPOINT, TERMINAL_STATUSES, batch_error_message, parse_batch_response, to_batch_request,
+    write_batch_files
+)
+from aeon.cache import ResponseCache, cache_key
+from aeon.columnar import ColumnarFormat, read_metadata
+from aeon.confidence import add_field_confidence, field_confidence, field_paths
 from aeon.config import DATA_DIR
+from aeon.dedup import MinHashLSH
 from aeon.logging import logger
-from aeon.prompt import Prompt
-from aeon.secrets import SecretManager
-from aeon.utils import timestamp, git_hash, timer
-
-
-SecretManager().set_secrets()
+from aeon.metrics import RunMetrics
+from aeon.prompt import Prompt, infer_provider
+from aeon.ratelimit import RateLimiter, estimate_tokens, retry_after_seconds
+from aeon.router import Endpoint, Router
+from aeon.secrets import get_secret
+from aeon.sink import ShardWriter, read_shards, write_parquet_chunks
+from aeon.tokens import count_tokens, pack_by_tokens, split_by_tokens
+from aeon.utils import Prefetcher, timestamp, git_hash, timer, run_coroutine, chunked
 
 PROVIDER_URLS = {
     "openai": "https://api.openai.com/v1/",
@@ -40,13 +61,131 @@ PROVIDER_URLS = {
 }
 
 
-def get_client(provider: str) -> OpenAI:
-    """Given a name like "openrouter", create the appropriate openai client.
+def provider_url(provider: str) -> str:
+    """Base url for a provider. Can be overridden with a {PROVIDER}_BASE_URL env var, e.g. to point
+    at a local stub server in tests.
+    """
+    return os.environ.get(f"{provider.upper()}_BASE_URL", PROVIDER_URLS[provider])
+
+
+# Idle connections are kept open this long so that back-to-back runs (e.g. extract then rewrite
+# in a notebook) reuse warm TCP/TLS connections. httpx's default is 5s.
+KEEPALIVE_EXPIRY_SECONDS = 120.0
+
+# HTTP/2 multiplexes many requests over each connection. httpx only supports it with `h2`
+# installed (`pip install httpx[http2]`).
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+# httpcore scans every connection in a pool each time a request starts or finishes, which gets
+# expensive with hundreds of connections (it dominated cpu at 1000 concurrency in
+# `aeon.benchmark`). Big pools are split across several clients with at most this many
+# connections each instead.
+POOL_SHARD_SIZE = 64
+
+# Process-wide client shards, keyed by (base url, sync/async, pool size).
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(provider: str, max_connections: int = 100) -> OpenAI:
+    """Given a name like "openrouter", get the appropriate openai client. Clients are created once
+    per process and pool size and then reused, so later runs start with warm connections. The api
+    key is looked up when the client is created (see `aeon.secrets.get_secret`) and baked into
+    it, so call `close_clients` after rotating a key.
+
+    Parameters
+    ----------
+    provider : str
+        Key of PROVIDER_URLS.
+    max_connections : int
+        Size of the connection pool, i.e. how many requests can be in flight at once. Rounded up
+        to a power of 2 so similar run sizes share a client. Pools bigger than POOL_SHARD_SIZE
+        are split across several clients; this returns the first one, use `get_clients` to get
+        them all.
+    """
+    return get_clients(provider, max_connections)[0]
+
+
+def get_async_client(provider: str, max_connections: int = 1_000) -> AsyncOpenAI:
+    """Async counterpart of `get_client`. Async clients hold connections bound to an event loop,
+    so only use them on `aeon.utils.background_event_loop` (which lives as long as the process,
+    hence reuse is safe).
+    """
+    return get_clients(provider, max_connections, is_async=True)[0]
+
+
+def get_clients(
+    provider: str,
+    max_connections: int = 100,
+    is_async: bool = False,
+) -> list[Union[OpenAI, AsyncOpenAI]]:
+    """All client shards that together provide a pool of `max_connections` connections (see
+    `get_client`). The pool size is rounded up to a power of 2 and split into shards of at most
+    `POOL_SHARD_SIZE` connections. Spread requests over them round robin.
+    """
+    base_url = provider_url(provider)
+    pool_size = 1 << max(max_connections - 1, 0).bit_length()
+    key = (base_url, is_async, pool_size)
+    with _clients_lock:
+        if key not in _clients:
+            n_shards = -(-pool_size // POOL_SHARD_SIZE)
+            limits = httpx.Limits(
+                max_connections=pool_size // n_shards,
+                max_keepalive_connections=pool_size // n_shards,
+                keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+            )
+            cls, http_cls = (AsyncOpenAI, DefaultAsyncHttpxClient) if is_async \
+                else (OpenAI, DefaultHttpxClient)
+            _clients[key] = [
+                cls(
+                    base_url=base_url,
+                    api_key=get_secret(f"{provider.upper()}_API_KEY"),
+                    http_client=http_cls(limits=limits, http2=HTTP2),
+                    # `api_retry` handles retries so they show up in metrics and respect our rate
+                    # limiter.
+                    max_retries=0,
+                )
+                for _ in range(n_shards)
+            ]
+        return _clients[key]
+
+
+def close_clients():
+    """Close all cached sync clients and forget every cached client, e.g. after rotating an api
+    key. Async clients are just dropped since closing them requires their event loop.
     """
-    return OpenAI(
-        base_url=PROVIDER_URLS[provider],
-        api_key=os.environ[f"{provider.upper()}_API_KEY"]
-    )
+    with _clients_lock:
+        for clients in _clients.values():
+            for client in clients:
+                if isinstance(client, OpenAI):
+                    client.close()
+        _clients.clear()
+
+
+# Shared by the sync and async api calls. Pacing is mostly handled by each endpoint's RateLimiter
+# (which also pauses everyone when a 429 comes back) and the Router already fails over to other
+# endpoints, so the backoff here can stay short.
+api_retry = retry(
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((RateLimitError, InternalServerError, APIConnectionError)),
+    # 2s, 4s, 8s... plus up to 1s of jitter. wait_exponential_jitter's `initial` is deprecated.
+    wait=wait_exponential(multiplier=2, max=60) + wait_random(0, 1),
+    before_sleep=before_sleep_log(logger, logging.WARNING)
+)
+
+# How long to pause everyone after a 429 that didn't come with a retry-after header.
+DEFAULT_RATE_LIMIT_BACKOFF_SECONDS = 5.0
+
+# Rows submitted to the thread/async engines at once, per worker. A bit more than 1 keeps workers
+# busy while cache hits and finished rows are handed back, without reading the whole input.
+IN_FLIGHT_PER_WORKER = 2
+
+# How often the thread/async engines check for new input while they have spare capacity but the
+# input iterable hasn't produced anything (e.g. a pipeline stage waiting on the previous one).
+FEED_POLL_SECONDS = 0.05
+
+# Openai only caches prompts at least this long, so there's no point warming up shorter prefixes.
+MIN_CACHEABLE_PREFIX_TOKENS = 1_024
 
 
 class LLMLabeler:
@@ -73,104 +212,855 @@ class LLMLabeler:
 
         # Will set these in `label` method.
         self.client = None
+        self.router = None
+        self.cache = None
+        self.writer = None
         self.output_dir = None
         self.batch_subdir = None
         self.prompt = None
+        self.pack_tokens = None
+        self.chunking = None
+        self.columnar = None
+        self.metrics = None
+        self._stopping = threading.Event()
 
     def label(
         self,
-        df: pd.DataFrame,
+        df: Union[pd.DataFrame, str, Path, Iterable[Union[dict, pd.DataFrame]]],
         max_workers: int = 15,
         cleanup: bool = True,
+        engine: str = "thread",
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        cache: Union[bool, ResponseCache] = True,
+        resume_dir: Optional[Union[str, Path]] = None,
+        batch_poll_seconds: float = 60.0,
+        chunk_size: int = 10_000,
+        return_df: bool = True,
+        pack_tokens: Optional[int] = None,
+        pack_max_rows: int = 50,
+        chunk_tokens: Optional[int] = None,
+        chunk_overlap_tokens: int = 200,
+        chunk_variable: Optional[str] = None,
+        chunk_dedup_field: Optional[str] = None,
+        warm_cache: bool = True,
+        prefix_order: bool = False,
+        fallback_models: Optional[list[str]] = None,
+        hedge: bool = True,
+        on_result: Optional[Callable[[dict], None]] = None,
+        output_dir: Optional[Union[str, Path]] = None,
+        output_format: str = "nested",
+        confidence: bool = False,
         **kwargs
     ) -> dict:
         """
         Parameters
         ----------
+        df : pd.DataFrame, str, Path, or iterable
+            Rows to label. Must contain a column/key for each of the prompt's variables. Can be a
+            df, a path to a parquet file (read `chunk_size` rows at a time), or an iterable of
+            dicts (one per row) or dfs (chunks of rows), e.g. a generator, so inputs never need
+            to fit in memory. Row ids are assigned in iteration order.
+        max_workers : int
+            Max number of api calls in flight at once. With engine="thread" this is the number of
+            threads. With engine="async" this is just a semaphore size, so values in the hundreds
+            or thousands are fine.
         cleanup : bool
-            If True, delete `batches` subdir when labeling completes IF a job completes without
-            keyboard interrupt. This can reclaim quite a bit of space for large runs and we have
-            this data in a parquet anyway.
+            If True, delete `batches` subdir (where results are appended to JSONL shards as rows
+            complete) when labeling completes IF a job completes without keyboard interrupt. This
+            can reclaim quite a bit of space for large runs and we have this data in a parquet
+            anyway.
+        engine : str
+            "thread" makes blocking api calls on a ThreadPoolExecutor. "async" makes all calls
+            through one AsyncOpenAI client (and therefore one connection pool) on a background
+            event loop, which is much cheaper per in-flight request. "batch" submits all rows
+            to openai's Batch API and polls until they finish (up to 24 hours), which is cheaper
+            and has much higher rate limits; use it for latency-insensitive jobs. All engines
+            return the same results.
+        requests_per_minute : float or None
+            Provider's request quota. Submissions are paced to stay just under it. If None, we
+            learn it from the provider's rate limit response headers after the first call.
+        tokens_per_minute : float or None
+            Provider's token quota, see `requests_per_minute`.
+        cache : bool or ResponseCache
+            If True, successful responses are stored in (and served from) the default on-disk
+            ResponseCache, keyed by a hash of the fully resolved api kwargs and response schema.
+            This makes it cheap to re-run a job after fixing a few failures or adding rows. Pass
+            False to always call the api (e.g. to draw fresh samples at temperature > 0), or a
+            ResponseCache instance to use a custom location or size limit.
+        resume_dir : str or Path or None
+            Output dir of a previous run that crashed or was interrupted (i.e. `output_path`'s
+            parent). We reuse that dir, index the rows it already labeled successfully (from
+            `batches` shards and/or `output.pq`), and only submit rows that are missing, failed,
+            or whose rendered api kwargs have changed since. `df` must be the same df (same row
+            order) used in the original run. With engine="batch", batches that were already
+            submitted are polled again rather than resubmitted.
+        batch_poll_seconds : float
+            How often to check batch status when engine="batch".
+        chunk_size : int
+            Number of input rows to read at a time, and number of results per parquet row group
+            when `return_df=False`.
+        return_df : bool
+            If True, load all results into a df sorted by id (returned as `df` and saved to
+            `output_path`). If False, results are streamed from the shards to `output_path`
+            without ever holding them all in memory and `df` is None. Use this for very large
+            jobs.
+        pack_tokens : int or None
+            If provided, pack multiple consecutive rows into each api call, up to this many tokens
+            of rendered input per call (the static messages are only sent once per call). The
+            model tags every item it returns with the input it came from and we split the response
+            back into one result per row, so results look the same as unpacked ones. Worth it for
+            short inputs where the developer message dominates the cost. Not supported with
+            engine="batch".
+        pack_max_rows : int
+            Max rows per packed call, regardless of tokens. Keeps responses from growing too long.
+        chunk_tokens : int or None
+            If provided, split `chunk_variable` values longer than this many tokens into
+            overlapping windows (see `aeon.tokens.split_by_tokens`) and label each window with
+            its own api call, in parallel. Once every window of a row has finished, their
+            responses are merged into a single result for the row: list fields are concatenated
+            and items extracted twice from the overlap between windows are dropped (see
+            `Prompt.merge_windows`). This keeps per-call latency and output length down for very
+            long inputs (e.g. transcripts), and since windows are cached separately, a failed
+            window only costs that window when the row is re-run. A row fails if any of its
+            windows does. Merged rows have no logprobs, and their `response_raw` holds each
+            window's raw response under `windows`. Requires a pydantic response_format. Not
+            supported with engine="batch", pack_tokens, or confidence.
+        chunk_overlap_tokens : int
+            About how many tokens consecutive windows share, so a joke (or whatever we're
+            extracting) cut in half by one window boundary appears whole in a window.
+        chunk_variable : str or None
+            Prompt variable to split. Defaults to the prompt's only variable.
+        chunk_dedup_field : str or None
+            Field of list items to compare when dropping duplicates from the overlap, e.g.
+            "joke". Defaults to the item's first str field.
+        warm_cache : bool
+            If True and the prompt's static messages are long enough for the provider to cache,
+            send a single request and wait for it before fanning out. Otherwise the first wave of
+            concurrent requests all miss the provider's prompt cache because none of them has
+            finished writing it yet. Doesn't apply to engine="batch".
+        prefix_order : bool
+            If True, submit rows within each input chunk sorted by their rendered dynamic message
+            so that rows sharing a long common beginning (e.g. several questions about the same
+            document) run back to back and extend the cached prefix. Row ids and results are
+            unchanged, only the order in which rows complete.
+        fallback_models : list[str] or None
+            Other endpoints for the same logical model, in priority order, e.g.
+            ["openai/gpt-4.1-nano"] to fall back to openrouter when openai is down. The provider is
+            inferred from each name (see `aeon.prompt.infer_provider`). Calls fail over to the
+            next endpoint on 5xx, 429, and connection errors, and endpoints that keep failing are
+            skipped for a while. Responses from fallbacks are cached under the primary model's
+            cache key; each row's `endpoint` says who actually answered. Not supported with
+            engine="batch".
+        hedge : bool
+            If True, once an endpoint has some latency history, a call that takes longer than its
+            p95 gets a duplicate request (on the next healthy endpoint, or the same one) and the
+            first answer wins. Bounds tail latency at the cost of ~5% more requests.
+        on_result : callable or None
+            Called with each row result as soon as it's saved, including cache hits but not rows
+            skipped because we're resuming. Calls never overlap, but they come from whichever
+            thread finished the row (with engine="async", the shared event loop), so keep it
+            quick and non-blocking, e.g. put rows on a queue (see `Pipeline`).
+        output_dir : str or Path or None
+            Where to save results. Defaults to a new `{parent_dir}/{prompt_name}/{timestamp}-{git
+            hash}` dir. Ignored if `resume_dir` is provided.
+        output_format : str
+            "nested" stores each row's raw response, parsed content, and fully rendered api
+            kwargs as nested dicts, plus the rendered dynamic message as `last_message`.
+            "columnar" stores one typed column per response_format field, a `logprobs` list
+            column, and the prompt variables instead of rendered messages, with the prompt itself
+            stored once in the file's metadata (see `aeon.columnar`). Much smaller and faster to
+            load, e.g. into pandas or `datasets`, and results are always streamed to
+            `output_path` (then loaded if `return_df`).
+        confidence : bool
+            If True, add `{field}_logprob_mean` and `{field}_logprob_min` columns for every field
+            of the response_format (e.g. `items.joke_logprob_min`), computed from the token
+            logprobs of the whole run at once (see `aeon.confidence`). Handy for filtering out
+            low-confidence labels. Requires a pydantic response_format and logprobs.
         kwargs : any
             Forwarded to Prompt (e.g. temperature, model, logprobs).
         """
+        if engine not in ("thread", "async", "batch"):
+            raise ValueError(f"engine must be 'thread', 'async', or 'batch', got {engine!r}.")
+        if output_format not in ("nested", "columnar"):
+            raise ValueError(
+                f"output_format must be 'nested' or 'columnar', got {output_format!r}."
+            )
+
         self.prompt = Prompt(self.prompt_name, **kwargs)
-        self.output_dir = self.parent_dir/f"{self.prompt_name}/{timestamp()}-{git_hash()}"
+        if engine == "batch" and self.prompt.provider != "openai":
+            raise ValueError(
+                f"engine='batch' is only supported for openai models, not {self.prompt.provider}."
+            )
+        if pack_tokens and engine == "batch":
+            raise ValueError("pack_tokens is not supported with engine='batch'.")
+        if fallback_models and engine == "batch":
+            raise ValueError("fallback_models is not supported with engine='batch'.")
+        if chunk_tokens:
+            if engine == "batch" or pack_tokens or confidence:
+                raise ValueError(
+                    "chunk_tokens is not supported with engine='batch', pack_tokens, or "
+                    "confidence."
+                )
+            if chunk_variable is None:
+                if len(self.prompt.variables) != 1:
+                    raise ValueError(
+                        f"Prompt {self.prompt_name} has several variables, pass chunk_variable."
+                    )
+                chunk_variable = self.prompt.variables[0]
+            if chunk_variable not in self.prompt.variables:
+                raise ValueError(
+                    f"chunk_variable {chunk_variable!r} is not one of the prompt's variables "
+                    f"{self.prompt.variables}."
+                )
+            response_format = self.prompt.default_kwargs.get("response_format")
+            if not (isinstance(response_format, type) and issubclass(response_format, BaseModel)):
+                raise ValueError("chunk_tokens requires a pydantic response_format.")
+        if confidence:
+            response_format = self.prompt.default_kwargs.get("response_format")
+            if not (isinstance(response_format, type) and issubclass(response_format, BaseModel)):
+                raise ValueError("confidence requires a pydantic response_format.")
+            if not self.prompt.default_kwargs.get("logprobs"):
+                logger.warning("confidence=True but logprobs aren't enabled, columns will be NaN.")
+        self.pack_tokens = pack_tokens
+        self.chunking = {
+            "tokens": chunk_tokens,
+            "overlap_tokens": chunk_overlap_tokens,
+            "variable": chunk_variable,
+            "dedup_field": chunk_dedup_field,
+        } if chunk_tokens else None
+        self.columnar = ColumnarFormat(self.prompt) if output_format == "columnar" else None
+        if resume_dir:
+            self.output_dir = Path(resume_dir)
+            if not self.output_dir.is_dir():
+                raise FileNotFoundError(f"Can't resume from {self.output_dir}, it doesn't exist.")
+            previous_output = self.output_dir/"output.pq"
+            if previous_output.exists():
+                previous_format = "nested" if read_metadata(previous_output) is None \
+                    else "columnar"
+                if previous_format != output_format:
+                    raise ValueError(
+                        f"Can't resume a run with output_format={previous_format!r} using "
+                        f"output_format={output_format!r}."
+                    )
+        else:
+            self.output_dir = Path(output_dir) if output_dir else \
+                self.parent_dir/f"{self.prompt_name}/{timestamp()}-{git_hash()}"
         self.batch_dir = self.output_dir/"batches"
-        self.client = get_client(self.prompt.provider)
+        if engine == "batch":
+            self.client = get_client(self.prompt.provider)
+            self.router = None
+        else:
+            self.router = self._build_router(
+                fallback_models or [], engine, max_workers, requests_per_minute,
+                tokens_per_minute, hedge
+            )
 
         logger.info(f"Labels will be saved in {self.output_dir}")
-        self.batch_dir.mkdir(parents=True, exist_ok=False)
-        schema_cls = self.prompt.default_kwargs["response_format"]
-        with open(self.output_dir/"response_format.json", "w") as f:
-            json.dump(schema_cls.model_json_schema(), f)
+        self.batch_dir.mkdir(parents=True, exist_ok=bool(resume_dir))
+        schema = self.prompt.default_kwargs["response_format"].model_json_schema()
+        schema_path = self.output_dir/"response_format.json"
+        if resume_dir and schema_path.exists():
+            with open(schema_path, "r") as f:
+                if json.load(f) != schema:
+                    logger.warning(
+                        "response_format has changed since the run we're resuming. Previously "
+                        "labeled rows will keep the old format."
+                    )
+        with open(schema_path, "w") as f:
+            json.dump(schema, f)
 
-        missing_vars = set(self.prompt.variables) - set(df.columns)
-        if missing_vars:
-            raise ValueError(f"df is missing variable(s): {missing_vars}")
+        records, n_rows = iter_input_rows(df, self.prompt.variables, chunk_size=chunk_size)
 
-        futures = []
-        responses = []
+        # Maps row id to cache key for rows a previous run labeled successfully.
+        previous = {}
+        if resume_dir:
+            for res in self._iter_results():
+                if res["success"]:
+                    previous[res["id"]] = res.get("cache_key")
+                else:
+                    previous.pop(res["id"], None)
         # Pre-fill with dummy values mostly to illustrate to user what values to expect.
         results = {
             "completed": True,
             "duration_seconds": 0.0,
             "df": None,
             "n_errors": 0,
+            "rate_limit_wait_seconds": 0.0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "n_resumed": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "cached_token_fraction": 0.0,
+            "mean_latency_seconds": None,
+            "cost_usd": None,
+            "metrics": {},
             "output_path": str(self.output_dir/"output.pq"),
         }
-        rows = df[self.prompt.variables].to_dict(orient='records')
-        progress_bar = tqdm(total=len(rows), desc="Labeling rows")
-        with timer() as time:
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                try:
-                    for i, row in enumerate(rows):
-                        futures.append(executor.submit(self._label_one_row, i, **row))
-                    for future in as_completed(futures):
-                        responses.append(future.result())
-                        progress_bar.update(1)  
-                except KeyboardInterrupt:
-                    logger.info(
-                        "Canceling labeling job. Previously launched API calls will still run."
-                    )
-                    results["completed"] = False
-                    for future in futures:
-                        future.cancel()
-        results["duration_seconds"] = time["duration"]
-
-        # Construct df of results.
-        df_labeled = pd.DataFrame(responses)
-        df_labeled = df_labeled.sort_values("id", ascending=True).reset_index(drop=True)
-        # This is the dynamic message so it's the one we most often want to examine in results.
-        df_labeled["last_message"] = df_labeled.api_kwargs.apply(
-            lambda x: x['messages'][-1]['content']
+        progress_bar = tqdm(total=n_rows, desc="Labeling rows")
+        counts = {"done": 0, "cached": 0}
+
+        # Openai's batch api costs half as much.
+        self.metrics = RunMetrics(
+            self.prompt.default_kwargs["model"], cost_discount=0.5 if engine == "batch" else 1.0
         )
-        results["n_errors"] = df_labeled.shape[0] - df_labeled.success.sum()
-        results["df"] = df_labeled
-        df_labeled.to_parquet(results["output_path"])
+        last_postfix = [0.0]
+        # Cache hits are reported from the engine's input thread, everything else from wherever
+        # the api call finished.
+        result_lock = threading.Lock()
+        user_on_result = on_result
+
+        def on_result(res: dict):
+            with result_lock:
+                progress_bar.update(1)
+                counts["done"] += 1
+                counts["cached"] += res["cached"]
+                self.metrics.record_row(res)
+                if time.monotonic() - last_postfix[0] >= 1.0:
+                    progress_bar.set_postfix(self.metrics.postfix(), refresh=False)
+                    last_postfix[0] = time.monotonic()
+                if user_on_result is not None:
+                    user_on_result(res)
+
+        def _pending_results():
+            # Lazy so that at most one chunk plus the engine's in-flight window are ever held in
+            # memory. Cache hits are saved right away so they never take up space in a request.
+            # Rows are only buffered a chunk at a time when we need to sort them, otherwise a
+            # streamed input (e.g. from a `Pipeline`) would wait for a whole chunk to arrive.
+            for chunk in chunked(enumerate(records), chunk_size if prefix_order else 1):
+                pending = []
+                for i, row in chunk:
+                    if self._is_done(previous, i, row):
+                        with result_lock:
+                            results["n_resumed"] += 1
+                            progress_bar.update(1)
+                        continue
+                    res = self._init_row_result(i, **row)
+                    if self._load_cached(res):
+                        on_result(self._save_row_result(res))
+                        continue
+                    windows = self._init_windows(res, row) if self.chunking else None
+                    if windows is None:
+                        pending.append(res)
+                        continue
+                    for window in windows:
+                        if self._load_cached(window):
+                            for finished in self._finish_request([window]):
+                                on_result(finished)
+                        else:
+                            pending.append(window)
+                if prefix_order:
+                    pending.sort(key=lambda res: res["api_kwargs"]["messages"][-1]["content"])
+                yield from pending
+
+        # Each request is a list of row results that will be filled in by a single api call.
+        if pack_tokens:
+            model = self.prompt.default_kwargs["model"]
+            requests = pack_by_tokens(
+                _pending_results(),
+                lambda res: count_tokens(res["api_kwargs"]["messages"][-1]["content"], model),
+                max_tokens=pack_tokens,
+                max_items=pack_max_rows,
+            )
+        else:
+            requests = ([res] for res in _pending_results())
+
+        warm_up = warm_cache and self.prompt.prefix_tokens >= MIN_CACHEABLE_PREFIX_TOKENS
+        # A cache we open ourselves is closed once the run finishes, otherwise every run (e.g. in
+        # a notebook) would leak a sqlite connection. Caches passed in belong to the caller.
+        owns_cache = cache is True
+        if owns_cache:
+            cache = ResponseCache()
+        self.cache = cache if isinstance(cache, ResponseCache) else None
+        self.writer = ShardWriter(self.batch_dir)
+        try:
+            with timer() as timing:
+                if engine == "thread":
+                    results["completed"] = self._label_rows_threaded(
+                        requests, on_result, max_workers=max_workers, warm_up=warm_up
+                    )
+                elif engine == "async":
+                    results["completed"] = self._label_rows_async(
+                        requests, on_result, max_workers=max_workers, warm_up=warm_up
+                    )
+                else:
+                    results["completed"] = self._label_rows_batch(
+                        requests, on_result, poll_seconds=batch_poll_seconds
+                    )
+        finally:
+            self._stopping.clear()
+            self.writer.close()
+            # on_result throttles the postfix, so the last update may be stale.
+            with result_lock:
+                progress_bar.set_postfix(self.metrics.postfix())
+            progress_bar.close()
+            if self.router is not None:
+                self.router.close()
+            if owns_cache:
+                self.cache.close()
+        if resume_dir:
+            logger.info(
+                f"Resumed: {results['n_resumed']} rows were already labeled, labeled "
+                f"{counts['done']} more."
+            )
+        results["duration_seconds"] = timing["duration"]
+        if self.router is not None:
+            limiters = {id(e.rate_limiter): e.rate_limiter for e in self.router.endpoints}
+            results["rate_limit_wait_seconds"] = sum(
+                limiter.wait_seconds for limiter in limiters.values()
+            )
+        if self.cache is not None:
+            results["cache_hits"] = counts["cached"]
+            results["cache_misses"] = counts["done"] - counts["cached"]
+        metrics = self.metrics.summary()
+        if self.router is not None:
+            metrics["router"] = self.router.summary()
+        results["metrics"] = metrics
+        results["prompt_tokens"] = metrics["prompt_tokens"]
+        results["cached_tokens"] = metrics["cached_tokens"]
+        results["cached_token_fraction"] = metrics["cached_token_fraction"]
+        results["mean_latency_seconds"] = metrics["latency_seconds"]["mean"]
+        results["cost_usd"] = metrics["cost_usd"]
+        if metrics["prompt_tokens"]:
+            logger.info(
+                f"Provider prompt cache served {metrics['cached_token_fraction']:.1%} of "
+                f"{metrics['prompt_tokens']:,} prompt tokens."
+            )
+        with open(self.output_dir/"metrics.json", "w") as f:
+            json.dump(metrics, f, indent=2)
+
+        paths = field_paths(self.prompt.default_kwargs["response_format"]) if confidence else None
+        if self.columnar is not None or not return_df:
+            results["n_errors"] = self._write_output(results["output_path"], chunk_size)
+            if confidence:
+                add_field_confidence(results["output_path"], paths)
+            if return_df:
+                results["df"] = pd.read_parquet(results["output_path"])\
+                    .sort_values("id", ascending=True).reset_index(drop=True)
+        else:
+            # Construct df of results. This is the first time we hold every row's response in
+            # memory at once, during the run they only live in the shards.
+            df_labeled = pd.DataFrame(list(self._load_results().values()))
+            df_labeled = df_labeled.sort_values("id", ascending=True).reset_index(drop=True)
+            # This is the dynamic message so it's the one we most often want to examine in results.
+            df_labeled["last_message"] = df_labeled.api_kwargs.apply(
+                lambda x: x['messages'][-1]['content']
+            )
+            if confidence:
+                df_labeled = pd.concat([df_labeled, field_confidence(df_labeled, paths)], axis=1)
+            results["n_errors"] = df_labeled.shape[0] - df_labeled.success.sum()
+            results["df"] = df_labeled
+            df_labeled.to_parquet(results["output_path"])
 
-        logger.info("Removing intermediate results dir since job completed without interruption.")
         if results["completed"] and cleanup:
+            logger.info(
+                "Removing intermediate results dir since job completed without interruption."
+            )
             shutil.rmtree(self.batch_dir)
         return results
 
+    def stop(self):
+        """Ask a `label` call running in another thread to stop submitting requests. It returns
+        soon after with `completed=False`, having saved whatever finished so far. If no call is
+        running, the next one stops right away. Only supported with the thread and async engines.
+        """
+        self._stopping.set()
+
+    def _build_router(
+        self,
+        fallback_models: list[str],
+        engine: str,
+        max_workers: int,
+        requests_per_minute: Optional[float],
+        tokens_per_minute: Optional[float],
+        hedge: bool,
+    ) -> Router:
+        """Router over the prompt's model followed by `fallback_models`. Quotas are per provider
+        (really per api key), so endpoints on the same provider share a rate limiter (and, via
+        the client registry, a connection pool), and the explicit rpm/tpm limits apply to the
+        primary model's provider.
+        """
+        limiters = {self.prompt.provider: RateLimiter(requests_per_minute, tokens_per_minute)}
+        endpoints = []
+        for model in [self.prompt.default_kwargs["model"], *fallback_models]:
+            provider = infer_provider(model)
+            endpoint = Endpoint(
+                provider, model, rate_limiter=limiters.setdefault(provider, RateLimiter())
+            )
+            # Each worker can have an original and a hedged request in flight.
+            endpoint.clients = get_clients(
+                provider, max_connections=2 * max_workers, is_async=engine == "async"
+            )
+            endpoints.append(endpoint)
+        # Every worker thread may be waiting on an original and a hedged request at once.
+        return Router(endpoints, hedge=hedge, max_threads=2 * max_workers)
+
+    def _iter_results(self) -> Iterator[dict]:
+        """Yield row results written so far in `self.output_dir`: first `output.pq` from a previous
+        run (if we're resuming one that already finished), then the shards in `batches` in the
+        order they were written. A row can appear more than once, in which case the latest result
+        is the one that counts.
+        """
+        output_path = self.output_dir/"output.pq"
+        if output_path.exists():
+            for batch in pq.ParquetFile(output_path).iter_batches():
+                for res in batch.to_pylist():
+                    res.pop("last_message", None)
+                    yield res
+        yield from read_shards(self.batch_dir)
+
+    def _load_results(self) -> dict[int, dict]:
+        """Load the latest result for every row into memory (see `_iter_results`).
+
+        Returns
+        -------
+        dict[int, dict]
+            Maps row id to row result.
+        """
+        return {res["id"]: res for res in self._iter_results()}
+
+    def _write_output(self, path: Union[str, Path], chunk_size: int) -> int:
+        """Memory-bounded alternative to building a df of all results: write the latest result
+        for every row to a parquet file `chunk_size` rows at a time. Rows are sorted by id within
+        each chunk, and since rows complete roughly in submission order the file is close to
+        sorted overall, but sort by id after loading if exact order matters. Uses the columnar
+        format if `self.columnar` is set.
+
+        Returns
+        -------
+        int
+            Number of failed rows.
+        """
+        # First pass: find rows that were labeled more than once (only happens when resuming) and
+        # the position of their latest result. A bytearray keeps this at 1 byte per row.
+        seen = bytearray()
+        latest = {}
+        for pos, res in enumerate(self._iter_results()):
+            i = res["id"]
+            if i >= len(seen):
+                seen.extend(bytes(max(i + 1, 2 * len(seen)) - len(seen)))
+            if seen[i]:
+                latest[i] = pos
+            seen[i] = 1
+        del seen
+
+        n_errors = 0
+
+        def _chunks():
+            nonlocal n_errors
+            n_errors = 0
+            rows = (
+                res for pos, res in enumerate(self._iter_results())
+                if latest.get(res["id"], pos) == pos
+            )
+            for chunk in chunked(rows, chunk_size):
+                chunk.sort(key=lambda res: res["id"])
+                for res in chunk:
+                    n_errors += not res["success"]
+                    if self.columnar is None:
+                        res["last_message"] = res["api_kwargs"]["messages"][-1]["content"]
+                if self.columnar is not None:
+                    chunk = [self.columnar.record(res) for res in chunk]
+                yield chunk
+
+        # We may be reading a previous output.pq while writing the new one.
+        tmp_path = Path(f"{path}.tmp")
+        write_parquet_chunks(
+            _chunks, tmp_path, schema=None if self.columnar is None else self.columnar.schema
+        )
+        os.replace(tmp_path, path)
+        return n_errors
+
+    def _is_done(self, previous: dict[int, Optional[str]], i: int, row: dict) -> bool:
+        """Check if a previous result can be reused for a row, i.e. it exists and was generated
+        from the same api kwargs.
+        """
+        if i not in previous:
+            return False
+        if previous[i] is None:
+            return True
+        return previous[i] == self._cache_key(self.prompt.kwargs(**row))
+
+    def _cache_key(self, api_kwargs: dict, window: bool = False) -> str:
+        """Cache key for one row's api kwargs. Rows answered as part of a packed request are
+        cached separately from rows answered on their own, and so are rows merged from windows
+        (which depend on how they were split). Windows themselves are cached like regular rows.
+        """
+        if self.pack_tokens:
+            return cache_key({**api_kwargs, "packed": True})
+        if self.chunking and not window:
+            return cache_key({**api_kwargs, "chunking": self.chunking})
+        return cache_key(api_kwargs)
+
+    def _label_rows_threaded(
+        self,
+        requests: Iterable[list[dict]],
+        on_result: Callable[[dict], None],
+        max_workers: int,
+        warm_up: bool = False,
+    ) -> bool:
+        """Label rows with blocking api calls on a thread pool. Each request is a list of row
+        results (from `_init_row_result`) to fill in with one api call. `on_result` is called with
+        each row result as it completes (results are already saved to the shard writer by then).
+        Requests are pulled lazily on a background thread (see `Prefetcher`), so a slow input
+        never holds up finished requests, and at most `2 * IN_FLIGHT_PER_WORKER * max_workers` of
+        them are held in memory at once, however many there are in total. If `warm_up` is True,
+        the first request runs on its own so later ones can hit the provider's prompt cache.
+
+        Returns
+        -------
+        bool
+            True if all rows were submitted and completed, False if the job was interrupted (or
+            stopped, see `stop`).
+        """
+        window = IN_FLIGHT_PER_WORKER * max_workers
+        feed = Prefetcher(requests, max_ready=window, name="aeon-request-feed")
+        in_flight = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                while not self._stopping.is_set():
+                    limit = 1 if warm_up else window
+                    # Only block on the input when there's nothing else to wait for.
+                    for request in feed.take(
+                        limit - len(in_flight), timeout=0 if in_flight else None
+                    ):
+                        in_flight.add(
+                            executor.submit(self._label_request, request, time.perf_counter())
+                        )
+                    if not in_flight:
+                        break
+                    # If the input is slow (e.g. streamed from another stage), wake up now and
+                    # then to submit whatever has arrived in the meantime.
+                    starved = len(in_flight) < limit and not feed.done
+                    done, in_flight = wait(
+                        in_flight,
+                        timeout=FEED_POLL_SECONDS if starved else None,
+                        return_when=FIRST_COMPLETED,
+                    )
+                    warm_up = warm_up and not done
+                    for future in done:
+                        for res in future.result():
+                            on_result(res)
+            except KeyboardInterrupt:
+                logger.info(
+                    "Canceling labeling job. Previously launched API calls will still run."
+                )
+                for future in in_flight:
+                    future.cancel()
+                return False
+            finally:
+                feed.close()
+            if self._stopping.is_set():
+                logger.info(
+                    "Labeling job was stopped. Previously launched API calls will still run."
+                )
+                for future in in_flight:
+                    future.cancel()
+                return False
+        return True
+
+    def _label_rows_async(
+        self,
+        requests: Iterable[list[dict]],
+        on_result: Callable[[dict], None],
+        max_workers: int,
+        warm_up: bool = False,
+    ) -> bool:
+        """Label rows concurrently on a background event loop with at most `max_workers` requests
+        in flight. Same contract as `_label_rows_threaded`.
+        """
+        async def _run() -> bool:
+            window = IN_FLIGHT_PER_WORKER * max_workers
+            feed = Prefetcher(requests, max_ready=window, name="aeon-request-feed")
+            semaphore = asyncio.Semaphore(max_workers)
+            in_flight = set()
+            warming = warm_up
+            try:
+                while not self._stopping.is_set():
+                    limit = 1 if warming else window
+                    # Never block the event loop waiting on the input, see `Prefetcher`.
+                    for request in feed.take(limit - len(in_flight)):
+                        in_flight.add(asyncio.create_task(
+                            self._alabel_request(request, semaphore, time.perf_counter())
+                        ))
+                    if not in_flight:
+                        if feed.done:
+                            return True
+                        await asyncio.sleep(FEED_POLL_SECONDS)
+                        continue
+                    starved = len(in_flight) < limit and not feed.done
+                    done, in_flight = await asyncio.wait(
+                        in_flight,
+                        timeout=FEED_POLL_SECONDS if starved else None,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    warming = warming and not done
+                    for task in done:
+                        for res in task.result():
+                            on_result(res)
+                logger.info("Labeling job was stopped. In-flight API calls will be abandoned.")
+                return False
+            finally:
+                feed.close()
+                # Only does anything if we were cancelled or stopped partway through.
+                for task in in_flight:
+                    task.cancel()
+
+        try:
+            return run_coroutine(_run())
+        except KeyboardInterrupt:
+            logger.info("Canceling labeling job. In-flight API calls will be abandoned.")
+            return False
+
+    def _label_rows_batch(
+        self,
+        requests: Iterable[list[dict]],
+        on_result: Callable[[dict], None],
+        poll_seconds: float,
+    ) -> bool:
+        """Label rows with openai's Batch API. Every row result in `requests` is uploaded as part
+        of one or more batches, which we poll until they reach a terminal status. Batch
+        ids are recorded in `batches/batch_jobs.json` so an interrupted job can be resumed
+        without paying for the same requests twice. Same contract as `_label_rows_threaded`,
+        except that pending requests are held in memory until their batch is collected.
+        """
+        # Maps custom_id (stringified row id) to row results that still need a response.
+        pending = {str(res["id"]): res for request in requests for res in request}
+
+        jobs_path = self.batch_dir/"batch_jobs.json"
+        jobs = []
+        if jobs_path.exists():
+            with open(jobs_path, "r") as f:
+                jobs = [job for job in json.load(f) if not job["collected"]]
+        submitted = {custom_id for job in jobs for custom_id in job["custom_ids"]}
+        if jobs:
+            logger.info(f"Re-attaching to {len(jobs)} previously submitted batch(es).")
+        jobs.extend(self._submit_batches(
+            {custom_id: res for custom_id, res in pending.items() if custom_id not in submitted}
+        ))
+        self._save_batch_jobs(jobs, jobs_path)
+
+        try:
+            while True:
+                for job in jobs:
+                    if job["collected"]:
+                        continue
+                    batch = self.client.batches.retrieve(job["id"])
+                    if batch.status in TERMINAL_STATUSES:
+                        self._collect_batch(batch, job["custom_ids"], pending, on_result)
+                        job["collected"] = True
+                        self._save_batch_jobs(jobs, jobs_path)
+                    else:
+                        counts = batch.request_counts
+                        logger.info(
+                            f"Batch {job['id']} is {batch.status}"
+                            + (f" ({counts.completed}/{counts.total} requests)." if counts else ".")
+                        )
+                if all(job["collected"] for job in jobs):
+                    return True
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            logger.info(
+                "Stopped polling. Submitted batches will keep running, pass this run's output "
+                "dir as `resume_dir` to collect them later."
+            )
+            return False
+
+    def _submit_batches(self, pending: dict[str, dict]) -> list[dict]:
+        """Upload batch input files for `pending` row results and create one batch per file.
+
+        Returns
+        -------
+        list[dict]
+            One job record per batch, containing the batch id and custom_ids it covers.
+        """
+        if not pending:
+            return []
+        files = write_batch_files(
+            (to_batch_request(custom_id, res["api_kwargs"]) for custom_id, res in pending.items()),
+            self.batch_dir/"inputs",
+        )
+        jobs = []
+        for path, custom_ids in files:
+            with open(path, "rb") as f:
+                input_file = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=ENDPOINT,
+                completion_window="24h",
+                metadata={"prompt": self.prompt_name, "output_dir": str(self.output_dir)},
+            )
+            logger.info(f"Created batch {batch.id} with {len(custom_ids)} requests.")
+            jobs.append({"id": batch.id, "custom_ids": custom_ids, "collected": False})
+        return jobs
+
+    @staticmethod
+    def _save_batch_jobs(jobs: list[dict], path: Path):
+        with open(path, "w") as f:
+            json.dump(jobs, f)
+
+    def _collect_batch(
+        self,
+        batch: Batch,
+        custom_ids: list[str],
+        pending: dict[str, dict],
+        on_result: Callable[[dict], None],
+    ):
+        """Download a finished batch's output and error files and save a result for every row it
+        covered. Rows the batch never got to (e.g. because it expired) are marked as failed so a
+        later resume will pick them up.
+        """
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for raw_line in self.client.files.content(file_id).text.splitlines():
+                if not raw_line.strip():
+                    continue
+                line = json.loads(raw_line)
+                res = pending.pop(line["custom_id"], None)
+                if res is None:
+                    continue
+                response = line.get("response") or {}
+                try:
+                    if line.get("error") or response.get("status_code") != 200:
+                        raise RuntimeError(batch_error_message(line))
+                    res["response_raw"], res["response_content"] = parse_batch_response(
+                        response["body"], self.prompt.default_kwargs.get("response_format")
+                    )
+                    self._record_request([res], {}, response["body"].get("usage"))
+                    self._store_cached(res)
+                except Exception as e:
+                    logger.error(f"[row {res['id']}] Batch request failed with error: {e}")
+                    res["success"] = False
+                    res["error"] = traceback.format_exc()
+                on_result(self._save_row_result(res))
+
+        for custom_id in custom_ids:
+            res = pending.pop(custom_id, None)
+            if res is None:
+                continue
+            res["success"] = False
+            res["error"] = f"Batch {batch.id} ended with status {batch.status!r} without a result."
+            on_result(self._save_row_result(res))
+
     # TODO: prob need to define openrouter version (they may not support parse() call; also read
     # it's critical to filter out some bad providers, need to check which again); then make cls
     # select the proper api call func from provider.
-    @retry(
-        stop=stop_after_attempt(3),
-        retry=retry_if_exception_type((RateLimitError, InternalServerError)),
-        wait=wait_chain(wait_fixed(6), wait_fixed(60)),
-        before_sleep=before_sleep_log(logger, logging.WARNING)
-    )
-    def retryable_api_call(self, **kwargs) -> tuple[dict, dict]:
-        """Wrapper to make api call retryable. To keep things simple, we just retry once after
-        6 seconds and again after 60 seconds.
+    @api_retry
+    def retryable_api_call(self, stats: Optional[dict] = None, **kwargs) -> tuple[dict, dict]:
+        """Wrapper to make api call retryable (see `api_retry` for the retry policy). Each attempt
+        is routed by `self.router`, which may fail over to another endpoint or hedge a slow call
+        before we ever get to retry.
 
         Parameters
         ----------
+        stats : dict or None
+            If provided, we count `attempts` here and record when the first request was `sent`
+            (after any rate limiter wait), plus the `latency_seconds` and `endpoint` of the call
+            that succeeded.
         kwargs : any
-            Forwarded to openai api call.
+            Forwarded to openai api call. `model` is replaced with each endpoint's own model.
 
         Returns
         -------
@@ -186,56 +1076,711 @@ class LLMLabeler:
         # https://ai.google.dev/gemini-api/docs/openai
         # And for anthropic:
         # https://docs.claude.com/en/api/openai-sdk
-        result = self.client.chat.completions.parse(**kwargs)
-        result_dict = result.model_dump(mode="json")
-        # TODO: if I often end up returning something like list[Response], second item will still
-        # nest response under an "items" key (for example). Could standardize this and ALWAYS
-        # return a list, even when unnecessary (api could
-        # always return a list of len 1). Or just leave as is? Or infer. idk
-        return result_dict, result_dict["choices"][0]["message"]["parsed"]
+        self._count_attempt(stats)
+        n_tokens = estimate_tokens(kwargs)
+        return self.router.call(
+            lambda endpoint: self._call_endpoint(endpoint, stats, kwargs, n_tokens), n_tokens
+        )
+
+    @api_retry
+    async def aretryable_api_call(
+        self,
+        stats: Optional[dict] = None,
+        **kwargs
+    ) -> tuple[dict, dict]:
+        """Async version of `retryable_api_call`, used by engine="async"."""
+        self._count_attempt(stats)
+        n_tokens = estimate_tokens(kwargs)
+        return await self.router.acall(
+            lambda endpoint: self._acall_endpoint(endpoint, stats, kwargs, n_tokens), n_tokens
+        )
 
-    def _label_one_row(self, i: int, **kwargs) -> dict:
+    def _call_endpoint(
+        self,
+        endpoint: Endpoint,
+        stats: Optional[dict],
+        kwargs: dict,
+        n_tokens: int,
+    ) -> tuple[dict, dict]:
+        """Make one api call on one endpoint. The router has already waited on the endpoint's rate
+        limiter for `n_tokens`.
         """
+        kwargs = self._endpoint_kwargs(endpoint, kwargs)
+        start = self._start_call(stats)
+        try:
+            response = endpoint.client.chat.completions.with_raw_response.parse(**kwargs)
+        except RateLimitError as e:
+            self._on_rate_limit_error(endpoint, e)
+            raise
+        return self._on_raw_response(endpoint, response, n_tokens, stats, start)
+
+    async def _acall_endpoint(
+        self,
+        endpoint: Endpoint,
+        stats: Optional[dict],
+        kwargs: dict,
+        n_tokens: int,
+    ) -> tuple[dict, dict]:
+        """Async version of `_call_endpoint`."""
+        kwargs = self._endpoint_kwargs(endpoint, kwargs)
+        start = self._start_call(stats)
+        try:
+            response = await endpoint.client.chat.completions.with_raw_response.parse(
+                **kwargs
+            )
+        except RateLimitError as e:
+            self._on_rate_limit_error(endpoint, e)
+            raise
+        return self._on_raw_response(endpoint, response, n_tokens, stats, start)
+
+    @staticmethod
+    def _endpoint_kwargs(endpoint: Endpoint, kwargs: dict) -> dict:
+        """Adapt api kwargs for the logical model to a specific endpoint."""
+        kwargs = {**kwargs, "model": endpoint.model}
+        if endpoint.provider != "openai":
+            kwargs.pop("prompt_cache_key", None)
+        return kwargs
+
+    @staticmethod
+    def _on_raw_response(
+        endpoint: Endpoint,
+        response: LegacyAPIResponse,
+        n_tokens: int,
+        stats: Optional[dict],
+        start: float,
+    ) -> tuple[dict, dict]:
+        """Feed rate limit headers and actual token usage back into the endpoint's rate limiter,
+        record timings, and return the parsed completion.
+        """
+        latency = time.perf_counter() - start
+        endpoint.rate_limiter.update(response.headers)
+        result = response.parse()
+        endpoint.rate_limiter.record_usage(n_tokens, result.usage and result.usage.total_tokens)
+        if stats is not None:
+            # With hedging a losing call can still finish later, so the first success wins.
+            stats.setdefault("latency_seconds", latency)
+            stats.setdefault("endpoint", endpoint.name)
+        return parse_completion(result)
+
+    @staticmethod
+    def _count_attempt(stats: Optional[dict]):
+        if stats is not None:
+            stats["attempts"] = stats.get("attempts", 0) + 1
+
+    @staticmethod
+    def _start_call(stats: Optional[dict]) -> float:
+        """Record when the first request was sent and return this call's start time."""
+        start = time.perf_counter()
+        if stats is not None:
+            stats.setdefault("sent", start)
+        return start
+
+    @staticmethod
+    def _on_rate_limit_error(endpoint: Endpoint, e: RateLimitError):
+        """Pause all new requests to this endpoint's provider (not just the one that failed)
+        after a 429.
+        """
+        endpoint.rate_limiter.update(e.response.headers)
+        endpoint.rate_limiter.backoff(
+            retry_after_seconds(e.response.headers) or DEFAULT_RATE_LIMIT_BACKOFF_SECONDS
+        )
+
+    def _label_request(
+        self,
+        results: list[dict],
+        submitted: Optional[float] = None,
+    ) -> list[dict]:
+        """Fill in row results (from `_init_row_result`) with a single api call: one row, or
+        several packed rows if `pack_tokens` was set. Results are saved and returned (see
+        `_finish_request`).
+
         Parameters
         ----------
-        i : int
-            Row index. Used for error messages and to ensure we can recover original row order in
-            results.
+        results : list[dict]
+            Row results to fill in.
+        submitted : float or None
+            `time.perf_counter()` when the request was handed to the engine, so we can tell how
+            long it waited for a worker. Defaults to now.
+        """
+        stats = {"submitted": submitted or time.perf_counter()}
+        response = None
+        try:
+            response = self.retryable_api_call(stats=stats, **self._request_kwargs(results))
+        except Exception as e:
+            self._mark_failed(results, e)
+        return self._complete_request(results, stats, response)
+
+    async def _alabel_request(
+        self,
+        results: list[dict],
+        semaphore: asyncio.Semaphore,
+        submitted: Optional[float] = None,
+    ) -> list[dict]:
+        """Async version of `_label_request`. `semaphore` bounds the number of in-flight calls."""
+        stats = {"submitted": submitted or time.perf_counter()}
+        response = None
+        async with semaphore:
+            try:
+                response = await self.aretryable_api_call(
+                    stats=stats, **self._request_kwargs(results)
+                )
+            except Exception as e:
+                self._mark_failed(results, e)
+        # Cache writes and serializing rows for the shards block, and on the event loop they'd
+        # stall every other in-flight request.
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._complete_request, results, stats, response
+        )
+
+    def _complete_request(
+        self,
+        results: list[dict],
+        stats: dict,
+        response: Optional[tuple[dict, Any]],
+    ) -> list[dict]:
+        """Fill in, record, and save the row results of a finished api call. `response` is the
+        call's (raw, content), or None if it failed (and `results` were already marked failed).
+        """
+        usage = None
+        if response is not None:
+            raw, content = response
+            usage = raw.get("usage")
+            try:
+                self._fill_results(results, raw, content)
+            except Exception as e:
+                self._mark_failed(results, e)
+        self._record_request(results, stats, usage)
+        return self._finish_request(results)
+
+    def _finish_request(self, results: list[dict]) -> list[dict]:
+        """Save the row results a request filled in and return them. Windows of a chunked row
+        aren't saved themselves: the row's merged result is saved and returned instead, once its
+        last window finishes.
+        """
+        finished = []
+        for res in results:
+            if "window" not in res:
+                finished.append(self._save_row_result(res))
+                continue
+            group, j = res.pop("window")
+            if group.add(j, res):
+                finished.append(self._save_row_result(self._merge_windows(group)))
+        return finished
+
+    def _init_windows(self, res: dict, row: dict) -> Optional[list[dict]]:
+        """Split a row result's chunk variable into windows (see `label`'s `chunk_tokens`).
+
+        Returns
+        -------
+        list[dict] or None
+            One row result per window, each tagged with its `_WindowGroup` and index, or None
+            if the row fits in a single window and can be labeled as is.
+        """
+        texts = split_by_tokens(
+            row[self.chunking["variable"]],
+            self.chunking["tokens"],
+            self.chunking["overlap_tokens"],
+            model=self.prompt.default_kwargs["model"],
+        )
+        if len(texts) == 1:
+            return None
+        group = _WindowGroup(res, len(texts))
+        windows = []
+        for j, text in enumerate(texts):
+            api_kwargs = self.prompt.kwargs(**{**row, self.chunking["variable"]: text})
+            windows.append({
+                **res,
+                "api_kwargs": api_kwargs,
+                "cache_key": self._cache_key(api_kwargs, window=True),
+                "window": (group, j),
+            })
+        return windows
+
+    def _merge_windows(self, group: "_WindowGroup") -> dict:
+        """Combine a chunked row's finished windows into the row's result."""
+        res, windows = group.res, group.windows
+        failed = [j for j, window in enumerate(windows) if not window["success"]]
+        res["response_content"] = self.prompt.merge_windows(
+            [window["response_content"] for window in windows if window["success"]],
+            dedup_field=self.chunking["dedup_field"],
+        )
+        res["response_raw"] = {"windows": [window["response_raw"] for window in windows]}
+        res["success"] = not failed
+        res["error"] = "\n".join(f"[window {j}] {windows[j]['error']}" for j in failed)
+        res["cached"] = all(window["cached"] for window in windows)
+        res["retries"] = sum(window["retries"] for window in windows)
+        res["endpoint"] = windows[0]["endpoint"]
+        for name, combine in [
+            ("queue_wait_seconds", max), ("latency_seconds", max),
+            ("prompt_tokens", sum), ("cached_tokens", sum), ("completion_tokens", sum),
+        ]:
+            values = [window[name] for window in windows if window[name] is not None]
+            res[name] = combine(values) if values else None
+        if res["success"]:
+            self._store_cached(res)
+        return res
+
+    def _request_kwargs(self, results: list[dict]) -> dict:
+        """Api kwargs for one request covering `results`."""
+        if not self.pack_tokens:
+            return results[0]["api_kwargs"]
+        return {
+            **self.prompt.default_kwargs,
+            "response_format": self.prompt.packed_response_format,
+            "messages": self.prompt.pack_messages(
+                [res["api_kwargs"]["messages"] for res in results]
+            ),
+        }
+
+    def _fill_results(self, results: list[dict], raw: dict, content: Any):
+        """Store an api response in the row results it answers and in the cache. Packed
+        responses are split back into one content per row, and any row the model skipped (or
+        answered more than once, for prompts with one item per row) is marked as failed.
+        """
+        contents = self.prompt.unpack(content, len(results)) if self.pack_tokens else [content]
+        for res, row_content in zip(results, contents):
+            res["response_raw"] = raw
+            if row_content is None:
+                error = "Packed response didn't have exactly one item for this row."
+                logger.error(f"[row {res['id']}] {error}")
+                res["success"] = False
+                res["error"] = error
+                continue
+            res["response_content"] = row_content
+            self._store_cached(res)
+
+    def _record_request(self, results: list[dict], stats: dict, usage: Optional[dict]):
+        """Add a finished request to the run metrics and copy its timings and token usage to the
+        row results it covered. Packed rows each get an equal share of the request's tokens.
+        """
+        now = time.perf_counter()
+        if "submitted" in stats:
+            stats["total_seconds"] = now - stats["submitted"]
+            if "sent" in stats:
+                stats["queue_wait_seconds"] = stats["sent"] - stats["submitted"]
+        self.metrics.record_request(stats, usage, n_rows=len(results))
+        for res in results:
+            res["queue_wait_seconds"] = stats.get("queue_wait_seconds")
+            res["latency_seconds"] = stats.get("latency_seconds")
+            res["retries"] = max(stats.get("attempts", 1) - 1, 0)
+            res["endpoint"] = stats.get("endpoint")
+            if usage:
+                cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+                res["prompt_tokens"] = usage.get("prompt_tokens", 0) / len(results)
+                res["cached_tokens"] = cached / len(results)
+                res["completion_tokens"] = usage.get("completion_tokens", 0) / len(results)
+
+    @staticmethod
+    def _mark_failed(results: list[dict], e: Exception):
+        """Record an api error on every row in a request. Call from inside an except block."""
+        ids = [res["id"] for res in results]
+        logger.error(
+            f"[row{'s' if len(ids) > 1 else ''} {', '.join(map(str, ids))}] API call failed with "
+            f"error: {e}"
+        )
+        error = traceback.format_exc()
+        for res in results:
+            res["success"] = False
+            res["error"] = error
+
+    def _init_row_result(self, i: int, **kwargs) -> dict:
+        """Row result with default values, to be filled in by the api call. With columnar output
+        it also keeps the prompt variables, since that's what we save instead of `api_kwargs`.
         """
+        api_kwargs = self.prompt.kwargs(**kwargs)
         res = {
             "id": i,
             "success": True,
             "error": "",
             "response_raw": {},
             "response_content": {},
-            "api_kwargs": self.prompt.kwargs(**kwargs),
+            "api_kwargs": api_kwargs,
+            "cache_key": self._cache_key(api_kwargs),
+            "cached": False,
+            "queue_wait_seconds": None,
+            "latency_seconds": None,
+            "retries": 0,
+            "endpoint": None,
+            "prompt_tokens": None,
+            "cached_tokens": None,
+            "completion_tokens": None,
         }
-        try:
-            res["response_raw"], res["response_content"] = self.retryable_api_call(
-                **res["api_kwargs"]
-            )
-        except Exception as e:
-            logger.error(f"[row {i}] API call failed with error: {e}")
-            res["success"] = False
-            res["error"] = traceback.format_exc()
+        if self.columnar is not None:
+            res["variables"] = kwargs
+        return res
+
+    def _load_cached(self, res: dict) -> bool:
+        """Fill in a row result from the response cache if possible. Returns True on a hit."""
+        if self.cache is None:
+            return False
+        hit = self.cache.get(res["cache_key"])
+        if hit is None:
+            return False
+        res["response_raw"], res["response_content"] = hit
+        res["cached"] = True
+        return True
+
+    def _store_cached(self, res: dict):
+        if self.cache is not None:
+            self.cache.put(res["cache_key"], [res["response_raw"], res["response_content"]])
 
+    def _save_row_result(self, res: dict) -> dict:
+        """Queue one row's result to be written to the batch dir shards and return it."""
         # This is annoying to save in parquet later and we don't need to re-save it for every row.
         res["api_kwargs"].pop("response_format", None)
+        # Columnar output only needs the variables, the rendered messages would repeat them.
+        saved = res if self.columnar is None else \
+            {k: v for k, v in res.items() if k != "api_kwargs"}
         try:
-            # Nice to have this if the job fails late or to let us peek at results early.
-            with open(self.batch_dir/f"{i}.json", "w") as f:
-                json.dump(res, f, default=json_dump_default)
+            # Serialize here rather than in the writer thread so a bad row only fails itself.
+            line = json.dumps(saved, default=json_dump_default)
         except Exception as e:
-            logger.error(f"[row {i}] Save failed with error: {e}")
+            logger.error(f"[row {res['id']}] Save failed with error: {e}")
             res["success"] = False
             res["error"] = traceback.format_exc()
+            line = json.dumps({**saved, "success": False, "error": res["error"]}, default=str)
+        # Nice to have this if the job fails late or to let us peek at results early.
+        self.writer.write(line)
         return res
 
 
+class _WindowGroup:
+    """Collects the window results of one chunked row until they've all finished. Windows finish
+    on whichever thread made their api call, hence the lock.
+    """
+
+    def __init__(self, res: dict, n: int):
+        self.res = res
+        self.windows = [None] * n
+        self._remaining = n
+        self._lock = threading.Lock()
+
+    def add(self, j: int, window: dict) -> bool:
+        """Record window `j`'s result. Returns True if it was the last one."""
+        with self._lock:
+            self.windows[j] = window
+            self._remaining -= 1
+            return self._remaining == 0
+
+
+class Stage:
+    """One step of a `Pipeline`: a prompt, how to build its input rows from the previous step's
+    results, and `LLMLabeler.label` kwargs specific to it.
+    """
+
+    def __init__(
+        self,
+        prompt_name: str,
+        explode: Optional[Union[str, Callable[[dict], Iterable[dict]]]] = None,
+        dedup: Optional[str] = None,
+        dedup_threshold: float = 0.8,
+        **label_kwargs,
+    ):
+        """
+        Parameters
+        ----------
+        prompt_name : str
+            Name of aeon prompt to run.
+        explode : str, callable, or None
+            How to turn one successful row result of the previous stage into rows for this one.
+            A str names a list field of its `response_content` (e.g. "items") whose items each
+            become a row. A callable takes the whole row result and returns an iterable of row
+            dicts. None uses `response_content` itself as the only row. Must be None for the
+            first stage.
+        dedup : str or None
+            If given, rows whose value for this field (e.g. "joke") is a near-duplicate of an
+            earlier row's are dropped instead of labeled (see `aeon.dedup`). Each row's cluster
+            is saved in `clusters.jsonl` in the stage's dir. Must be None for the first stage.
+        dedup_threshold : float
+            Similarity above which rows count as near-duplicates, see `MinHashLSH`.
+        label_kwargs : any
+            Forwarded to `LLMLabeler.label`, taking precedence over the kwargs passed to
+            `Pipeline.run` (e.g. a different `model` or `max_workers` for this stage).
+        """
+        self.prompt_name = prompt_name
+        self.explode = explode
+        self.dedup = dedup
+        self.dedup_threshold = dedup_threshold
+        self.label_kwargs = label_kwargs
+
+    def rows(self, res: dict) -> Iterable[dict]:
+        """Input rows for this stage derived from one of the previous stage's row results."""
+        if callable(self.explode):
+            return self.explode(res)
+        if self.explode is None:
+            return [res["response_content"]]
+        return res["response_content"].get(self.explode) or []
+
+
+class Pipeline:
+    """Chain prompts so that rows stream from one stage to the next as soon as they're labeled,
+    e.g. extract jokes from transcripts, then rewrite each joke:
+
+    pipeline = Pipeline([Stage("extract_jokes"), Stage("rewrite_joke_variant", explode="items")])
+    res = pipeline.run(df, max_workers=30)
+    res["df"]  # Last stage's results, with `parent_id` linking each row to its transcript.
+
+    Every stage runs at the same time in its own thread, so the whole thing takes about as long as
+    the slowest stage rather than the sum of all of them. Each stage is a regular `label` call
+    with its own output dir (`{output_dir}/{i}-{prompt_name}`), so partial results are
+    checkpointed per stage. Rows a stage hasn't gotten to yet wait in an unbounded in-memory
+    queue. Downstream row ids are assigned in arrival order; `lineage.jsonl` in each downstream
+    stage's dir maps them to `parent_id` (the previous stage's row id) and `item_index` (position
+    among the rows built from that parent). Stages with `dedup` drop near-duplicate rows before
+    labeling them and record every row's cluster in `clusters.jsonl`. Resuming isn't supported,
+    but re-running an interrupted pipeline is cheap since finished calls are served from the
+    response cache.
+    """
+
+    _done = object()
+
+    def __init__(self, stages: list[Stage], parent_dir: Union[str, Path] = DATA_DIR/"pipelines"):
+        """
+        Parameters
+        ----------
+        stages : list[Stage]
+            Stages in order. The first one labels the input passed to `run`.
+        parent_dir : str or Path
+            Each run's outputs go in a new `{timestamp}-{git hash}` subdir of this.
+        """
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        if stages[0].explode is not None or stages[0].dedup is not None:
+            raise ValueError(
+                "The first stage labels the pipeline's input, it can't explode or dedup."
+            )
+        self.stages = stages
+        self.parent_dir = Path(parent_dir)
+
+        # Will set these in `run` method.
+        self.labelers = None
+        self.output_dir = None
+
+    def run(
+        self,
+        df: Union[pd.DataFrame, str, Path, Iterable[Union[dict, pd.DataFrame]]],
+        **label_kwargs,
+    ) -> dict:
+        """
+        Parameters
+        ----------
+        df : pd.DataFrame, str, Path, or iterable
+            Input for the first stage, see `LLMLabeler.label`.
+        label_kwargs : any
+            Forwarded to every stage's `LLMLabeler.label` call, unless the stage overrides them.
+
+        Returns
+        -------
+        dict
+            `stages` (each stage's `label` results, in order), `df` (the last stage's df),
+            `completed` (False if any stage was interrupted), `duration_seconds`, and
+            `output_dir`.
+        """
+        if "resume_dir" in label_kwargs or any("resume_dir" in s.label_kwargs for s in self.stages):
+            raise ValueError("Pipelines can't be resumed, just re-run them to hit the cache.")
+        self.output_dir = self.parent_dir/f"{timestamp()}-{git_hash()}"
+        logger.info(f"Pipeline outputs will be saved in {self.output_dir}")
+        # Fresh labelers every run since a stopped labeler stays stopped until its next run.
+        self.labelers = [LLMLabeler(stage.prompt_name) for stage in self.stages]
+        queues = [queue.Queue() for _ in self.stages[1:]]
+        stopping = threading.Event()
+
+        def _run_stage(i: int) -> dict:
+            stage = self.stages[i]
+            stage_dir = self.output_dir/f"{i}-{stage.prompt_name}"
+            kwargs = {**label_kwargs, **stage.label_kwargs, "output_dir": stage_dir}
+            if i + 1 < len(self.stages):
+                kwargs["on_result"] = self._forwarder(queues[i], kwargs.get("on_result"))
+            try:
+                if i == 0:
+                    return self.labelers[i].label(df, **kwargs)
+                stage_dir.mkdir(parents=True)
+                index = None
+                if stage.dedup is not None:
+                    index = MinHashLSH(threshold=stage.dedup_threshold)
+                rows = self._stream(queues[i - 1], stage, stage_dir, stopping, index)
+                res = self.labelers[i].label(rows, **kwargs)
+                if index is not None:
+                    res["n_duplicates"] = index.n_duplicates
+                    logger.info(
+                        f"Skipped {index.n_duplicates:,} near-duplicate rows of {len(index):,} "
+                        f"in stage {i} ({stage.prompt_name})."
+                    )
+                if res["df"] is not None:
+                    res["df"] = self._add_lineage(res["df"], stage_dir/"lineage.jsonl")
+                return res
+            finally:
+                # Let the next stage finish once it's labeled everything we sent it.
+                if i + 1 < len(self.stages):
+                    queues[i].put(self._done)
+
+        with timer("Pipeline") as timing:
+            with ThreadPoolExecutor(
+                max_workers=len(self.stages), thread_name_prefix="aeon-pipeline"
+            ) as executor:
+                futures = [executor.submit(_run_stage, i) for i in range(len(self.stages))]
+                try:
+                    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                    if any(future.exception() is not None for future in done):
+                        logger.error("A pipeline stage failed, stopping the others.")
+                        self._stop(stopping, queues)
+                except KeyboardInterrupt:
+                    logger.info("Stopping pipeline. In-flight API calls will still run.")
+                    self._stop(stopping, queues)
+                    wait(futures)
+            stage_results = [future.result() for future in futures]
+        return {
+            "completed": all(res["completed"] for res in stage_results),
+            "duration_seconds": timing["duration"],
+            "stages": stage_results,
+            "df": stage_results[-1]["df"],
+            "output_dir": str(self.output_dir),
+        }
+
+    def _stop(self, stopping: threading.Event, queues: list[queue.Queue]):
+        stopping.set()
+        for labeler in self.labelers:
+            labeler.stop()
+        for q in queues:
+            q.put(self._done)
+
+    @staticmethod
+    def _forwarder(
+        q: queue.Queue,
+        on_result: Optional[Callable[[dict], None]] = None,
+    ) -> Callable[[dict], None]:
+        """`on_result` hook that hands successful row results to the next stage (and calls the
+        user's own hook, if any). Must not block since it may run on the shared event loop.
+        """
+        def _forward(res: dict):
+            if on_result is not None:
+                on_result(res)
+            if res["success"]:
+                q.put(res)
+
+        return _forward
+
+    def _stream(
+        self,
+        q: queue.Queue,
+        stage: Stage,
+        stage_dir: Path,
+        stopping: threading.Event,
+        index: Optional[MinHashLSH] = None,
+    ) -> Iterator[dict]:
+        """Yield `stage`'s input rows as the previous stage's results arrive on `q`, appending
+        each row's lineage to `lineage.jsonl` in `stage_dir` as we go. If `index` is given, rows
+        that are near-duplicates of earlier ones are skipped, and every row's cluster (the
+        parent_id and item_index of its first member) goes in `clusters.jsonl`.
+        """
+        i = 0
+        # Lineage of every row added to `index`, by index id.
+        parent_ids, item_indices = [], []
+        clusters_file = nullcontext()
+        if index is not None:
+            clusters_file = open(stage_dir/"clusters.jsonl", "w")
+        with open(stage_dir/"lineage.jsonl", "w", buffering=1) as f, clusters_file as f_clusters:
+            for res in iter(q.get, self._done):
+                if stopping.is_set():
+                    return
+                rows = list(stage.rows(res))
+                if index is not None and rows:
+                    first_id = len(index)
+                    roots = index.add([str(row.get(stage.dedup) or "") for row in rows]).tolist()
+                    parent_ids.extend([res["id"]] * len(rows))
+                    item_indices.extend(range(len(rows)))
+                    for j, root in enumerate(roots):
+                        duplicate = root != first_id + j
+                        f_clusters.write(json.dumps({
+                            "parent_id": res["id"],
+                            "item_index": j,
+                            "cluster_parent_id": parent_ids[root],
+                            "cluster_item_index": item_indices[root],
+                            "duplicate": duplicate,
+                        }) + "\n")
+                        if duplicate:
+                            rows[j] = None
+                    f_clusters.flush()
+                for j, row in enumerate(rows):
+                    if row is None:
+                        continue
+                    f.write(json.dumps({"id": i, "parent_id": res["id"], "item_index": j}) + "\n")
+                    i += 1
+                    yield row
+
+    @staticmethod
+    def _add_lineage(df: pd.DataFrame, lineage_path: Path) -> pd.DataFrame:
+        if not lineage_path.stat().st_size:
+            return df
+        lineage = pd.read_json(lineage_path, lines=True)
+        return df.merge(lineage, on="id", how="left")
+
+
+def parse_completion(result: ParsedChatCompletion) -> tuple[dict, dict]:
+    """Split an api response into the raw response dict and the parsed structured output.
+    """
+    result_dict = result.model_dump(mode="json")
+    # TODO: if I often end up returning something like list[Response], second item will still
+    # nest response under an "items" key (for example). Could standardize this and ALWAYS
+    # return a list, even when unnecessary (api could
+    # always return a list of len 1). Or just leave as is? Or infer. idk
+    return result_dict, result_dict["choices"][0]["message"]["parsed"]
+
+
+def iter_input_rows(
+    data: Union[pd.DataFrame, str, Path, Iterable[Union[dict, pd.DataFrame]]],
+    columns: list[str],
+    chunk_size: int = 10_000,
+) -> tuple[Iterator[dict], Optional[int]]:
+    """Lazily yield input rows (as dicts containing only `columns`) from any of the input types
+    `LLMLabeler.label` accepts, reading at most `chunk_size` rows into memory at a time.
+
+    Returns
+    -------
+    tuple[Iterator[dict], Optional[int]]
+        Row iterator and total number of rows, or None if we can't know that up front (e.g. a
+        generator).
+    """
+    def _check_columns(available: Iterable[str]):
+        missing = set(columns) - set(available)
+        if missing:
+            raise ValueError(f"Input is missing variable(s): {missing}")
+
+    if isinstance(data, pd.DataFrame):
+        _check_columns(data.columns)
+
+        def _rows():
+            for start in range(0, data.shape[0], chunk_size):
+                yield from data.iloc[start:start + chunk_size][columns].to_dict(orient="records")
+
+        return _rows(), data.shape[0]
+
+    if isinstance(data, (str, Path)):
+        parquet_file = pq.ParquetFile(data)
+        _check_columns(parquet_file.schema_arrow.names)
+
+        def _rows():
+            for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+                yield from batch.to_pylist()
+
+        return _rows(), parquet_file.metadata.num_rows
+
+    def _rows():
+        for item in data:
+            if isinstance(item, pd.DataFrame):
+                _check_columns(item.columns)
+                yield from item[columns].to_dict(orient="records")
+            else:
+                _check_columns(item)
+                yield {col: item[col] for col in columns}
+
+    return _rows(), len(data) if isinstance(data, Sized) else None
+
+
 def json_dump_default(obj: Any):
     """Pass to json.dump to handle objects that otherwise cannot be serialized.
     """
-    if issubclass(obj, BaseModel):
+    if isinstance(obj, type) and issubclass(obj, BaseModel):
         return obj.model_json_schema()
     logger.warning(f"Serializing obj of unexpected type {type(obj)!r}.")
     return str(obj)
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""Telemetry for labeling runs: latency percentiles, throughput, token usage, and cost.
+
+metrics = RunMetrics(model="gpt-4.1-nano")
+metrics.record_request(stats, usage=raw["usage"], n_rows=1)  # After each api call.
+metrics.record_row(row_result)  # After each row completes (including cache hits).
+progress_bar.set_postfix(metrics.postfix())
+metrics.summary()  # Dict of percentiles, totals, rows/s, tokens/s, cost.
+"""
+import math
+import threading
+import time
+from typing import Optional
+
+
+# USD per 1M tokens: (input, cached input, output). Standard (non-batch) openai pricing. Models
+# are matched by longest prefix so dated snapshots like "gpt-4.1-mini-2025-04-14" resolve too.
+PRICES_PER_MILLION_TOKENS = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-5": (1.25, 0.125, 10.00),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-5-nano": (0.05, 0.005, 0.40),
+}
+
+
+def model_prices(model: str) -> Optional[tuple[float, float, float]]:
+    """Look up (input, cached input, output) USD per 1M tokens for a model, or None if unknown."""
+    matches = [name for name in PRICES_PER_MILLION_TOKENS if model.startswith(name)]
+    if not matches:
+        return None
+    return PRICES_PER_MILLION_TOKENS[max(matches, key=len)]
+
+
+def request_cost(usage: dict, model: str, discount: float = 1.0) -> Optional[float]:
+    """Cost in USD of one api response. Uses the provider's own figure when it reports one
+    (openrouter's `usage.cost`), otherwise our price table. None if we can't tell.
+    """
+    if usage.get("cost") is not None:
+        return usage["cost"]
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    prompt = usage.get("prompt_tokens") or 0
+    completion = usage.get("completion_tokens") or 0
+    cost = (prompt - cached) * input_price + cached * cached_price + completion * output_price
+    return discount * cost / 1e6
+
+
+class Histogram:
+    """Fixed-size histogram with log-spaced buckets, so percentiles of millions of observations
+    take constant memory. Percentiles are accurate to within one bucket (~5% relative error with
+    the defaults).
+    """
+
+    def __init__(
+        self,
+        min_value: float = 1e-4,
+        max_value: float = 1e4,
+        buckets_per_decade: int = 50,
+    ):
+        self.min_value = min_value
+        self.buckets_per_decade = buckets_per_decade
+        n_buckets = math.ceil(math.log10(max_value / min_value) * buckets_per_decade) + 1
+        self.counts = [0] * n_buckets
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        idx = 0
+        if value > self.min_value:
+            idx = int(math.log10(value / self.min_value) * self.buckets_per_decade)
+        self.counts[min(idx, len(self.counts) - 1)] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Approximate q'th percentile (q in [0, 100]), or None if there are no observations."""
+        if not self.n:
+            return None
+        rank = q / 100 * self.n
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                # Geometric midpoint of the bucket, capped by the largest value we've seen.
+                value = self.min_value * 10 ** ((idx + 0.5) / self.buckets_per_decade)
+                return min(value, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "n": self.n,
+            "mean": self.total / self.n if self.n else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max if self.n else None,
+        }
+
+
+class RunMetrics:
+    """Thread-safe accumulator for one labeling run. Requests (api calls) and rows are recorded
+    separately since packing can answer several rows with one request.
+    """
+
+    def __init__(self, model: str, cost_discount: float = 1.0):
+        """
+        Parameters
+        ----------
+        model : str
+            Model name, used to look up prices.
+        cost_discount : float
+            Multiplier applied to price table costs, e.g. 0.5 for the batch api.
+        """
+        self.model = model
+        self.cost_discount = cost_discount
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.histograms = {
+            "queue_wait_seconds": Histogram(),
+            "latency_seconds": Histogram(),
+            "total_seconds": Histogram(),
+        }
+        self.counts = {
+            "rows": 0,
+            "errors": 0,
+            "cached_rows": 0,
+            "requests": 0,
+            "retries": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+        }
+        self.cost_usd = 0.0
+        self.cost_known = True
+
+    def record_request(self, stats: dict, usage: Optional[dict] = None, n_rows: int = 1):
+        """Record one api request.
+
+        Parameters
+        ----------
+        stats : dict
+            Timings for the request: any of `queue_wait_seconds`, `latency_seconds`,
+            `total_seconds`, and `attempts`.
+        usage : dict or None
+            `usage` from the api response, if it succeeded.
+        n_rows : int
+            Number of rows the request covered.
+        """
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["retries"] += max(stats.get("attempts", 1) - 1, 0)
+            for name, histogram in self.histograms.items():
+                if stats.get(name) is not None:
+                    histogram.add(stats[name])
+            if not usage:
+                return
+            self.counts["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            self.counts["completion_tokens"] += usage.get("completion_tokens") or 0
+            self.counts["cached_tokens"] += \
+                (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+            cost = request_cost(usage, self.model, self.cost_discount)
+            if cost is None:
+                self.cost_known = False
+            else:
+                self.cost_usd += cost
+
+    def record_row(self, res: dict):
+        """Record one finished row result."""
+        with self.lock:
+            self.counts["rows"] += 1
+            self.counts["errors"] += not res["success"]
+            self.counts["cached_rows"] += bool(res.get("cached"))
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def postfix(self) -> dict:
+        """Short live stats for a tqdm progress bar."""
+        with self.lock:
+            elapsed = max(self.elapsed, 1e-9)
+            latency = self.histograms["latency_seconds"]
+            tokens = self.counts["prompt_tokens"] + self.counts["completion_tokens"]
+            return {
+                "rows/s": f"{self.counts['rows'] / elapsed:.1f}",
+                "tok/s": f"{tokens / elapsed:,.0f}",
+                "p50": _format_seconds(latency.percentile(50)),
+                "p95": _format_seconds(latency.percentile(95)),
+                "retries": self.counts["retries"],
+                "errors": self.counts["errors"],
+            }
+
+    def summary(self) -> dict:
+        """All metrics as a json serializable dict."""
+        with self.lock:
+            elapsed = self.elapsed
+            counts = dict(self.counts)
+            tokens = counts["prompt_tokens"] + counts["completion_tokens"]
+            api_rows = counts["rows"] - counts["cached_rows"]
+            cost = self.cost_usd if self.cost_known else None
+            return {
+                "model": self.model,
+                "elapsed_seconds": elapsed,
+                **counts,
+                "cached_token_fraction": (
+                    counts["cached_tokens"] / counts["prompt_tokens"]
+                    if counts["prompt_tokens"] else 0.0
+                ),
+                "rows_per_second": counts["rows"] / elapsed if elapsed else None,
+                "tokens_per_second": tokens / elapsed if elapsed else None,
+                "cost_usd": cost,
+                "cost_per_row_usd": cost / api_rows if cost is not None and api_rows else None,
+                **{name: histogram.summary() for name, histogram in self.histograms.items()},
+            }
+
+
+def _format_seconds(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.1f}s"
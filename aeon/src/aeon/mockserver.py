@@ -0,0 +1,450 @@
+"""Local stand-in for the openai api, for testing and benchmarking labeling without spending money.
+
+server = MockLLMServer(latency="lognormal:0.5,0.6", error_rate=0.01, rate_limit_rate=0.01)
+server.start()  # Background thread. Or run `aeon mock-server` in another process.
+os.environ["OPENAI_BASE_URL"] = server.url  # See aeon.labeling.provider_url.
+LLMLabeler("extract_jokes").label(df)
+server.stop()
+
+Supports chat completions (with schema-valid structured outputs generated from the request's
+`response_format`, logprobs, packed requests, and cached prompt tokens for repeated prefixes),
+plus the files and batches endpoints used by engine="batch". Implemented on a bare asyncio server
+so one thread can hold thousands of slow requests open at once.
+"""
+import asyncio
+from email.parser import BytesParser
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Optional
+import uuid
+
+from aeon.logging import logger
+
+
+# Like openai's prompt cache: prefixes shorter than this aren't cached, longer ones are cached in
+# increments of `PROMPT_CACHE_INCREMENT_TOKENS`.
+MIN_CACHED_PREFIX_TOKENS = 1_024
+PROMPT_CACHE_INCREMENT_TOKENS = 128
+
+STATUS_TEXT = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+WORDS = (
+    "the a joke about my dog and cat who walked into bar said nothing funny because timing is "
+    "everything so I left early then came back late with punchline nobody expected"
+).split()
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Parse a latency distribution spec into a sampler.
+
+    Parameters
+    ----------
+    spec : str
+        One of "fixed:SECONDS", "uniform:LOW,HIGH", "exponential:MEAN", or
+        "lognormal:MEDIAN,SIGMA". Lognormal is the most realistic: most calls take about MEDIAN
+        seconds, with a long tail controlled by SIGMA.
+    """
+    name, _, args = spec.partition(":")
+    try:
+        params = [float(x) for x in args.split(",")] if args else []
+        if name == "fixed":
+            (seconds,) = params
+            return lambda rng: seconds
+        if name == "uniform":
+            low, high = params
+            return lambda rng: rng.uniform(low, high)
+        if name == "exponential":
+            (mean,) = params
+            return lambda rng: rng.expovariate(1 / mean)
+        if name == "lognormal":
+            median, sigma = params
+            return lambda rng: rng.lognormvariate(math.log(median), sigma)
+    except ValueError as e:
+        raise ValueError(f"Bad latency spec {spec!r}: {e}") from e
+    raise ValueError(
+        f"Unknown latency distribution {name!r}, expected fixed, uniform, exponential, or "
+        "lognormal."
+    )
+
+
+def fake_instance(
+    schema: dict,
+    rng: random.Random,
+    defs: Optional[dict] = None,
+    input_ids: Optional[list[int]] = None,
+) -> Any:
+    """Random value that validates against a json schema (the subset openai structured outputs
+    use). If `input_ids` is given, arrays of objects with an `input_id` field get one item per id,
+    which is what `aeon.prompt.Prompt.unpack` expects from a packed request.
+    """
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return fake_instance(defs[schema["$ref"].split("/")[-1]], rng, defs, input_ids)
+    if "anyOf" in schema or "oneOf" in schema:
+        options = schema.get("anyOf") or schema["oneOf"]
+        non_null = [option for option in options if option.get("type") != "null"]
+        return fake_instance((non_null or options)[0], rng, defs, input_ids)
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+
+    type_ = schema.get("type", "string")
+    if isinstance(type_, list):
+        type_ = next((t for t in type_ if t != "null"), "null")
+    if type_ == "object":
+        return {
+            name: fake_instance(prop, rng, defs, input_ids)
+            for name, prop in schema.get("properties", {}).items()
+        }
+    if type_ == "array":
+        items = schema.get("items", {})
+        resolved = defs[items["$ref"].split("/")[-1]] if "$ref" in items else items
+        if input_ids and "input_id" in resolved.get("properties", {}):
+            res = []
+            for input_id in input_ids:
+                item = fake_instance(resolved, rng, defs)
+                item["input_id"] = input_id
+                res.append(item)
+            return res
+        low = schema.get("minItems", 1)
+        high = schema.get("maxItems", low + 2)
+        return [fake_instance(items, rng, defs) for _ in range(rng.randint(low, high))]
+    if type_ == "integer":
+        return rng.randint(int(schema.get("minimum", 0)), int(schema.get("maximum", 10)))
+    if type_ == "number":
+        return rng.uniform(schema.get("minimum", 0.0), schema.get("maximum", 1.0))
+    if type_ == "boolean":
+        return rng.random() < 0.5
+    if type_ == "null":
+        return None
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+    return text[:schema["maxLength"]] if "maxLength" in schema else text
+
+
+def fake_logprobs(content: str, rng: random.Random, top_logprobs: int = 0) -> dict:
+    """Chat completion `logprobs` for `content`, pretending every ~4 chars is a token."""
+    tokens = [content[i:i + 4] for i in range(0, len(content), 4)]
+    res = []
+    for token in tokens:
+        logprob = -rng.expovariate(5.0)
+        alternatives = [{"token": token, "logprob": logprob, "bytes": list(token.encode())}]
+        for _ in range(max(top_logprobs - 1, 0)):
+            alt = rng.choice(WORDS)[:4]
+            alternatives.append({
+                "token": alt, "logprob": logprob - 1 - rng.expovariate(1.0),
+                "bytes": list(alt.encode())
+            })
+        res.append({**alternatives[0], "top_logprobs": alternatives[:top_logprobs]})
+    return {"content": res, "refusal": None}
+
+
+class MockLLMServer:
+    """Openai-compatible http server with configurable latency and failures. See module docstring.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: str = "lognormal:0.5,0.6",
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after_seconds: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        """
+        Parameters
+        ----------
+        host : str
+            Interface to listen on.
+        port : int
+            Port to listen on. 0 picks a free one (see `url` after `start`).
+        latency : str
+            Distribution of time to respond to each chat completion, see `parse_latency`.
+        error_rate : float
+            Fraction of chat completions that fail with a 500.
+        rate_limit_rate : float
+            Fraction of chat completions that fail with a 429 (with a retry-after-ms header).
+        retry_after_seconds : float
+            Value of the retry-after header on 429s.
+        seed : int or None
+            Seed for latencies, failures, and generated outputs.
+        """
+        self.host = host
+        self.port = port
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_seconds = retry_after_seconds
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.batches = {}
+        # Static message prefixes (all but the last message) we've seen, to report cached tokens.
+        self.prefixes = set()
+        self.counts = {"requests": 0, "completions": 0, "errors": 0, "rate_limited": 0}
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        """Serve on a background thread with its own event loop. Returns self once listening."""
+        ready = threading.Event()
+
+        def _run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self._listen())
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=_run, name="aeon-mock-server", daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        """Close the server and any open connections, then stop the background thread."""
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def _shutdown(self):
+        self.server.close()
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    def serve_forever(self):
+        """Serve on the current thread until interrupted."""
+        async def _run():
+            await self._listen()
+            logger.info(f"Mock LLM server listening on {self.url}")
+            await self.server.serve_forever()
+
+        asyncio.run(_run())
+
+    async def _listen(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Minimal HTTP/1.1 with keep-alive: read requests off the connection until it closes."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.counts["requests"] += 1
+                status, extra_headers, payload = await self._route(method, target, headers, body)
+                head = [
+                    f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+                    "Content-Type: application/json",
+                    f"Content-Length: {len(payload)}",
+                    *(f"{k}: {v}" for k, v in extra_headers.items()),
+                ]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # `stop` cancels open connections. Finishing normally rather than re-raising avoids
+            # asyncio logging an error for every one (its stream callback calls `task.exception()`).
+            pass
+        finally:
+            writer.close()
+
+    async def _route(
+        self,
+        method: str,
+        target: str,
+        headers: dict,
+        body: bytes,
+    ) -> tuple[int, dict, bytes]:
+        path = target.split("?", 1)[0].rstrip("/")
+        if method == "POST" and path.endswith("/chat/completions"):
+            return await self._chat_completion(json.loads(body))
+        if method == "POST" and path.endswith("/files"):
+            return self._upload_file(headers, body)
+        if method == "POST" and path.endswith("/batches"):
+            return self._create_batch(json.loads(body))
+        if method == "GET" and "/batches/" in path:
+            return self._retrieve_batch(path.rsplit("/", 1)[-1])
+        if method == "GET" and path.endswith("/content"):
+            file_id = path.split("/")[-2]
+            if file_id in self.files:
+                return 200, {}, self.files[file_id]
+        return _json_response(404, {"error": {"message": f"No route for {method} {path}."}})
+
+    async def _chat_completion(self, body: dict) -> tuple[int, dict, bytes]:
+        await asyncio.sleep(self.latency(self.rng))
+        draw = self.rng.random()
+        if draw < self.rate_limit_rate:
+            self.counts["rate_limited"] += 1
+            return _json_response(
+                429,
+                {"error": {"message": "Rate limit reached (mock).", "type": "requests"}},
+                {"retry-after-ms": str(int(self.retry_after_seconds * 1000))},
+            )
+        if draw < self.rate_limit_rate + self.error_rate:
+            self.counts["errors"] += 1
+            return _json_response(500, {"error": {"message": "Internal error (mock)."}})
+        self.counts["completions"] += 1
+        return _json_response(200, self.completion(body))
+
+    def completion(self, body: dict) -> dict:
+        """Chat completion response for a request body."""
+        messages = body["messages"]
+        schema = (body.get("response_format") or {}).get("json_schema", {}).get("schema")
+        if schema is None:
+            content = " ".join(self.rng.choice(WORDS) for _ in range(20))
+        else:
+            input_ids = [
+                int(i) for i in re.findall(r'<input id="(\d+)">', str(messages[-1]["content"]))
+            ]
+            content = json.dumps(fake_instance(schema, self.rng, input_ids=input_ids))
+        # Like openai, count the response format as part of the prompt, and cache it along with
+        # the static messages (everything but the last message).
+        response_format = json.dumps(body.get("response_format")) if schema is not None else ""
+        prefix = json.dumps(messages[:-1]) + response_format
+        prefix_tokens = (
+            sum(len(str(message.get("content", ""))) for message in messages[:-1])
+            + len(response_format)
+        ) // 4
+        prompt_tokens = prefix_tokens + len(str(messages[-1].get("content", ""))) // 4 + 1
+        cached_tokens = 0
+        if prefix in self.prefixes and prefix_tokens >= MIN_CACHED_PREFIX_TOKENS:
+            cached_tokens = prefix_tokens // PROMPT_CACHE_INCREMENT_TOKENS \
+                * PROMPT_CACHE_INCREMENT_TOKENS
+        self.prefixes.add(prefix)
+        completion_tokens = len(content) // 4 + 1
+        logprobs = None
+        if body.get("logprobs"):
+            logprobs = fake_logprobs(content, self.rng, body.get("top_logprobs") or 0)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "logprobs": logprobs,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    def _upload_file(self, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        message = BytesParser().parsebytes(
+            f"Content-Type: {headers['content-type']}\r\n\r\n".encode() + body
+        )
+        content = next(
+            part.get_payload(decode=True) for part in message.get_payload()
+            if part.get_param("name", header="content-disposition") == "file"
+        )
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self.files[file_id] = content
+        return _json_response(200, {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": "input.jsonl", "purpose": "batch", "status": "processed",
+        })
+
+    def _create_batch(self, body: dict) -> tuple[int, dict, bytes]:
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "input_file_id": body["input_file_id"],
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+            "n_requests": len(self.files[body["input_file_id"]].splitlines()),
+        }
+        return _json_response(200, self._batch_object(self.batches[batch_id]))
+
+    def _retrieve_batch(self, batch_id: str) -> tuple[int, dict, bytes]:
+        """Batches complete the first time they're polled after being created. Error injection
+        applies per request, as it would on the real batch api.
+        """
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return _json_response(404, {"error": {"message": f"No batch {batch_id}."}})
+        if batch["status"] == "in_progress":
+            outputs, errors = [], []
+            for line in self.files[batch["input_file_id"]].splitlines():
+                request = json.loads(line)
+                if self.rng.random() < self.error_rate:
+                    response = {"status_code": 500, "body": {"error": {"message": "mock"}}}
+                    errors.append({"custom_id": request["custom_id"], "response": response})
+                    continue
+                response = {"status_code": 200, "body": self.completion(request["body"])}
+                outputs.append({"custom_id": request["custom_id"], "response": response})
+            for key, rows in (("output_file_id", outputs), ("error_file_id", errors)):
+                if rows:
+                    file_id = f"file-{uuid.uuid4().hex[:12]}"
+                    self.files[file_id] = "\n".join(json.dumps(row) for row in rows).encode()
+                    batch[key] = file_id
+            batch["n_failed"] = len(errors)
+            batch["status"] = "completed"
+        return _json_response(200, self._batch_object(batch))
+
+    @staticmethod
+    def _batch_object(batch: dict) -> dict:
+        n_failed = batch.get("n_failed", 0)
+        return {
+            "id": batch["id"],
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "input_file_id": batch["input_file_id"],
+            "completion_window": "24h",
+            "status": batch["status"],
+            "created_at": 0,
+            "output_file_id": batch["output_file_id"],
+            "error_file_id": batch["error_file_id"],
+            "request_counts": {
+                "total": batch["n_requests"],
+                "completed": batch["n_requests"] - n_failed if batch["status"] == "completed"
+                else 0,
+                "failed": n_failed,
+            },
+        }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def _json_response(
+    status: int,
+    obj: dict,
+    headers: Optional[dict] = None,
+) -> tuple[int, dict, bytes]:
+    return status, headers or {}, json.dumps(obj).encode()
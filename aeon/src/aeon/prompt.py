@@ -1,12 +1,31 @@
+import copy
+from functools import cached_property, lru_cache
+import hashlib
 import importlib
-from openai import OpenAI
+import json
 from pathlib import Path
 from string import Template
-from typing import Callable
+from typing import TYPE_CHECKING, Optional, get_args, get_origin
 
 from aeon import prompts
 from aeon.decorators import tab_completion
 from aeon.logging import logger
+from aeon.tokens import count_tokens
+
+if TYPE_CHECKING:
+    # pydantic is only imported once a prompt is loaded so listing prompts (e.g. for CLI tab
+    # completion) stays fast.
+    from pydantic import BaseModel
+
+
+# Wraps several rendered inputs into one message when packing multiple rows into one request.
+# Deliberately identical for every pack size so it extends the prefix shared by all requests.
+PACK_INSTRUCTIONS = (
+    "This message contains one or more separate inputs, each wrapped in an <input> tag with an id. "
+    "Process each input independently, exactly as you would if it were the only input, and set "
+    "`input_id` on every item you return to the id of the input it came from."
+)
+PACK_INPUT_TEMPLATE = '<input id="{id}">\n{content}\n</input>'
 
 
 def template_varnames(template: Template) -> list[str]:
@@ -26,6 +45,14 @@ class Prompt:
     prompt.variables  # See what vars need to be provided to render prompt
     prompt.render(color="blue", shape="triangle")  # Get list of messages with variables filled in.
     prompt.kwargs(color="blue", shape="triangle")  # Get all kwargs to pass to openai api call.
+    prompt.prefix_hash  # Identifies the static messages shared by every request.
+
+    # Pack several rows into one request, then split the response back into one result per row.
+    api_kwargs = prompt.kwargs_packed([row_1, row_2])
+    row_contents = prompt.unpack(parsed_response, n=2)
+
+    # Label a long input in overlapping windows, then merge the responses back into one.
+    row_content = prompt.merge_windows([window_content_1, window_content_2], dedup_field="joke")
     """
 
     _default_kwargs = {
@@ -73,8 +100,20 @@ class Prompt:
                 f"{self.provider!r}."
             )
 
-        # Last message is dynamic, preceding messages are static.
-        self.static_messages = self.prompt.messages[:-1]
+        # Last message is dynamic, preceding messages are static. Providers cache prompts by exact
+        # prefix match, so we freeze our own copy of the static messages: every request starts
+        # with the same bytes even if the prompt module's list is mutated later.
+        self.static_messages = copy.deepcopy(self.prompt.messages[:-1])
+        self.prefix_hash = hashlib.sha256(
+            json.dumps(self.static_messages, ensure_ascii=False).encode()
+        ).hexdigest()
+        # Openai routes requests with the same key to the same cache. Doesn't affect outputs.
+        if self.provider == "openai":
+            self.default_kwargs.setdefault(
+                "prompt_cache_key", f"aeon-{name}-{self.prefix_hash[:16]}"
+            )
+        if self.default_kwargs.get("prompt_cache_key", "") is None:
+            del self.default_kwargs["prompt_cache_key"]
         self.last_role = self.prompt.messages[-1]["role"]
         self.last_template = Template(self.prompt.messages[-1]["content"])
 
@@ -108,7 +147,21 @@ class Prompt:
             "role": self.last_role,
             "content": self.last_template.substitute(**kwargs)
         }
-        return self.static_messages + [last_message]
+        return self._static_prefix() + [last_message]
+
+    def _static_prefix(self) -> list[dict]:
+        """Copies of the static messages, so callers can't accidentally change what later requests
+        send.
+        """
+        return [dict(message) for message in self.static_messages]
+
+    @cached_property
+    def prefix_tokens(self) -> int:
+        """Approximate number of tokens in the static messages."""
+        return sum(
+            count_tokens(str(message["content"]), self.default_kwargs["model"])
+            for message in self.static_messages
+        )
 
     def kwargs(self, **kwargs) -> dict:
         """Get all kwargs for api call, including rendered `messages`. User must provide kwargs for
@@ -116,16 +169,185 @@ class Prompt:
         """
         return {**self.default_kwargs, "messages": self.render(**kwargs)}
 
+    @cached_property
+    def _pack_spec(self) -> "tuple[str, type[BaseModel], bool]":
+        """Figure out how to pack this prompt's response_format.
+
+        Returns
+        -------
+        tuple[str, type[BaseModel], bool]
+            Name of the list field in the packed response, the item model, and whether each input
+            can produce many items (response_format is already a single `list[Model]` field, like
+            extract_jokes' BatchResponse) rather than exactly one (like rewrite_joke_variant).
+        """
+        response_format = self.default_kwargs.get("response_format")
+        if not is_model(response_format):
+            raise ValueError(
+                f"Packing requires a pydantic response_format, prompt {self.name} has "
+                f"{response_format!r}."
+            )
+        fields = response_format.model_fields
+        if len(fields) == 1:
+            name, field = next(iter(fields.items()))
+            args = get_args(field.annotation)
+            if get_origin(field.annotation) is list and args and is_model(args[0]):
+                return name, args[0], True
+        return "items", response_format, False
+
+    @cached_property
+    def packed_response_format(self) -> "type[BaseModel]":
+        """Response format for packed requests: a list of items, each of which has an extra
+        `input_id` field recording which input it came from.
+        """
+        from pydantic import Field, create_model
+
+        field_name, item_model, _ = self._pack_spec
+        item = create_model(
+            f"Packed{item_model.__name__}",
+            input_id=(int, Field(..., description="Id of the <input> this item came from.")),
+            **{name: (field.annotation, field) for name, field in item_model.model_fields.items()},
+        )
+        return create_model(
+            f"Packed{self.default_kwargs['response_format'].__name__}",
+            **{field_name: (list[item], ...)},
+        )
+
+    def pack_messages(self, messages: list[list[dict]]) -> list[dict]:
+        """Combine the rendered messages of several rows (i.e. outputs of `render`) into the
+        messages for a single packed request. Static messages are shared so they're only sent
+        once.
+        """
+        inputs = [
+            PACK_INPUT_TEMPLATE.format(id=i, content=row_messages[-1]["content"])
+            for i, row_messages in enumerate(messages)
+        ]
+        last_message = {
+            "role": self.last_role,
+            "content": "\n\n".join([PACK_INSTRUCTIONS] + inputs),
+        }
+        return self._static_prefix() + [last_message]
+
+    def render_packed(self, rows: list[dict]) -> list[dict]:
+        """Like `render`, but for several rows at once. Each item in `rows` contains kwargs for
+        all variables in `self.variables`.
+        """
+        return self.pack_messages([self.render(**row) for row in rows])
+
+    def kwargs_packed(self, rows: list[dict]) -> dict:
+        """Like `kwargs`, but for several rows at once. Parse the response with `unpack`."""
+        return {
+            **self.default_kwargs,
+            "response_format": self.packed_response_format,
+            "messages": self.render_packed(rows),
+        }
+
+    def unpack(self, content: dict, n: int) -> list[Optional[dict]]:
+        """Split the parsed content of a packed response into per-row contents in the same format
+        an unpacked request would have returned.
+
+        Parameters
+        ----------
+        content : dict
+            Parsed response (as a dict) from a request made with `kwargs_packed`.
+        n : int
+            Number of rows that were packed into the request.
+
+        Returns
+        -------
+        list[dict or None]
+            One item per input row. None means the model didn't return exactly one item for that
+            row (only possible when each row should produce exactly one item): we can't tell
+            which of several answers is the real one.
+        """
+        field_name, _, many = self._pack_spec
+        by_input = [[] for _ in range(n)]
+        for item in content[field_name]:
+            item = dict(item)
+            input_id = item.pop("input_id")
+            if 0 <= input_id < n:
+                by_input[input_id].append(item)
+            else:
+                logger.warning(f"Dropping item with unknown input_id {input_id}.")
+        if many:
+            return [{field_name: items} for items in by_input]
+        return [items[0] if len(items) == 1 else None for items in by_input]
+
+    def merge_windows(
+        self,
+        contents: list[dict],
+        dedup_field: Optional[str] = None,
+        threshold: float = 0.8,
+    ) -> dict:
+        """Merge the parsed responses to several overlapping windows of one input into the
+        response for the whole input. List fields are concatenated in window order, dropping
+        items that are near-duplicates of earlier ones (the same item extracted from the overlap
+        of two windows, see `aeon.dedup`). Other fields keep their value from the first window.
+
+        Parameters
+        ----------
+        contents : list[dict]
+            Parsed responses, in window order.
+        dedup_field : str or None
+            Field of list items to compare, e.g. "joke". Defaults to the item model's first str
+            field, or the whole item for lists of non-models.
+        threshold : float
+            See `MinHashLSH`.
+        """
+        from aeon.dedup import MinHashLSH
+
+        response_format = self.default_kwargs.get("response_format")
+        if not is_model(response_format):
+            raise ValueError(
+                f"Merging windows requires a pydantic response_format, prompt {self.name} has "
+                f"{response_format!r}."
+            )
+        merged = {}
+        for name, field in response_format.model_fields.items():
+            values = [content.get(name) for content in contents]
+            if get_origin(field.annotation) is not list:
+                merged[name] = next((v for v in values if v is not None), None)
+                continue
+            items = [item for value in values for item in value or []]
+            key = dedup_field or _first_str_field(get_args(field.annotation))
+            texts = [
+                str(item.get(key)) if key and isinstance(item, dict) else json.dumps(item)
+                for item in items
+            ]
+            clusters = MinHashLSH(threshold=threshold).add(texts) if items else []
+            merged[name] = [item for i, item in enumerate(items) if clusters[i] == i]
+        return merged
+
     def __str__(self):
         return f"{type(self).__name__}(name={self.name})"
 
 
+def is_model(obj) -> bool:
+    """Check if obj is a pydantic model class (e.g. a response_format)."""
+    from pydantic import BaseModel
+
+    return isinstance(obj, type) and issubclass(obj, BaseModel)
+
+
+def _first_str_field(args: tuple) -> Optional[str]:
+    """Name of the first str field of a list's item model (from `get_args` of the list
+    annotation), if it has one.
+    """
+    if args and is_model(args[0]):
+        for name, field in args[0].model_fields.items():
+            if field.annotation is str:
+                return name
+    return None
+
+
 def infer_provider(model: str) -> str:
     """
     Infer LLM provider name based on model. For now we keep it simple and support just openai and
     openrouter (technically can call openai through openrouter but I believe it's more expensive).
+    Openrouter names are namespaced by their creator ("openai/gpt-4.1-nano"), openai's aren't.
     """
-    if "gpt" in model:
+    if "/" in model:
+        provider = "openrouter"
+    elif "gpt" in model:
         provider = "openai"
     else:
         provider = "openrouter"
@@ -133,14 +355,17 @@ def infer_provider(model: str) -> str:
     return provider
 
 
-def list_prompts() -> list[str]:
-    """Return aeon's available prompt names."""
+@lru_cache(maxsize=None)
+def list_prompts() -> tuple[str, ...]:
+    """Return aeon's available prompt names. Cached, so add new prompts before the first call
+    (or call `list_prompts.cache_clear()`).
+    """
     prompt_dir = Path(__file__).parent/"prompts"
-    return [
+    return tuple(sorted(
         path.stem for path in prompt_dir.iterdir()
         if path.suffix == ".py"
         and not path.stem.startswith("_")  # internal lib files
-    ]
+    ))
 
 
 @tab_completion(list_prompts)
@@ -0,0 +1,265 @@
+"""Client-side rate limiting for LLM api calls.
+
+limiter = RateLimiter(requests_per_minute=500, tokens_per_minute=200_000)
+limiter.wait(estimate_tokens(api_kwargs))  # Blocks until we're allowed to send the request.
+response = client.chat.completions.with_raw_response.parse(**api_kwargs)
+limiter.update(response.headers)  # Learn the provider's actual limits/remaining quota.
+"""
+import asyncio
+from collections.abc import Mapping
+from datetime import datetime
+import threading
+import time
+from typing import Optional
+
+from aeon.logging import logger
+
+
+class TokenBucket:
+    """Continuously refilling bucket, refilled at `limit` units per `period` seconds. A limit of
+    None means unlimited (e.g. we haven't seen any rate limit headers yet). Not thread safe on its
+    own, `RateLimiter` handles locking.
+    """
+
+    def __init__(
+        self,
+        limit: Optional[float] = None,
+        period: float = 60.0,
+        burst_seconds: Optional[float] = None,
+    ):
+        """
+        Parameters
+        ----------
+        limit : float or None
+            Units allowed per `period`.
+        period : float
+            Length of the rate limit window in seconds.
+        burst_seconds : float or None
+            If provided, the bucket only holds `burst_seconds` worth of refills (at least 1 unit)
+            instead of a whole period's worth. Smaller values spread requests evenly over the
+            period rather than sending a burst at the start of it.
+        """
+        self.limit = limit
+        self.period = period
+        self.burst_seconds = burst_seconds
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> Optional[float]:
+        """Units refilled per second."""
+        return None if self.limit is None else self.limit / self.period
+
+    @property
+    def capacity(self) -> Optional[float]:
+        """Max units the bucket can hold."""
+        if self.limit is None or self.burst_seconds is None:
+            return self.limit
+        return min(self.limit, max(1.0, self.rate * self.burst_seconds))
+
+    def _refill(self, now: float):
+        if self.limit is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take `amount` units from the bucket, going into debt if necessary.
+
+        Returns
+        -------
+        float
+            Number of seconds the caller must wait before the units it just reserved are actually
+            available. 0 if they're available immediately.
+        """
+        self._refill(now)
+        if self.limit is None:
+            return 0.0
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], now: float):
+        """Adjust the bucket to match what the provider reported. We only ever lower our level in
+        response to `remaining`: requests we reserved after the provider sent its response aren't
+        reflected in the header yet, so our own count is usually the more up to date of the two.
+        """
+        self._refill(now)
+        if limit is not None and limit != self.limit:
+            was_unlimited = self.limit is None
+            self.limit = limit
+            self.level = self.capacity if was_unlimited else min(self.level, self.capacity)
+        if remaining is not None and self.limit is not None:
+            self.level = min(self.level, remaining)
+
+    def drain(self, now: float, seconds: float = 0.0):
+        """Empty the bucket such that it won't have capacity for another `seconds` seconds."""
+        self._refill(now)
+        if self.limit is not None:
+            self.level = min(self.level, -seconds * self.rate)
+
+
+class RateLimiter:
+    """Token bucket limiter covering both requests/min and tokens/min. Limits can be passed in
+    explicitly but are also learned from the `x-ratelimit-*` headers that openai and openrouter
+    return, so in practice you can usually leave them as None and let the first response fill
+    them in. Can be shared across threads and across coroutines on an event loop.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        headroom: float = 0.9,
+        burst_seconds: Optional[float] = 2.0,
+    ):
+        """
+        Parameters
+        ----------
+        requests_per_minute : float or None
+            Initial request limit. None means unknown until we see response headers.
+        tokens_per_minute : float or None
+            Initial token limit. None means unknown until we see response headers.
+        headroom : float
+            Fraction of the provider's quota we let ourselves use, so that small errors in our
+            token estimates don't push us over the limit.
+        burst_seconds : float or None
+            See `TokenBucket`. The default keeps throughput smooth rather than spending a whole
+            minute's quota up front and then stalling.
+        """
+        if not 0 < headroom <= 1:
+            raise ValueError(f"headroom must be in (0, 1], got {headroom}.")
+        self.headroom = headroom
+        self.requests = TokenBucket(
+            self._scale(requests_per_minute), burst_seconds=burst_seconds
+        )
+        self.tokens = TokenBucket(self._scale(tokens_per_minute), burst_seconds=burst_seconds)
+        self.paused_until = 0.0
+        self.wait_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def _scale(self, value: Optional[float]) -> Optional[float]:
+        return None if value is None else value * self.headroom
+
+    def reserve(self, n_tokens: int) -> float:
+        """Reserve one request and `n_tokens` tokens. Returns number of seconds to wait before
+        sending the request.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.reserve(1, now),
+                self.tokens.reserve(n_tokens, now),
+                self.paused_until - now,
+            )
+            self.wait_seconds += wait
+        return wait
+
+    def wait(self, n_tokens: int) -> float:
+        """Blocking version: sleep until a request of `n_tokens` tokens can be sent."""
+        wait = self.reserve(n_tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def async_wait(self, n_tokens: int) -> float:
+        """Async version of `wait`."""
+        wait = self.reserve(n_tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Correct our token bucket once we know how many tokens a request actually used."""
+        if actual_tokens is None:
+            return
+        with self.lock:
+            if self.tokens.limit is not None:
+                self.tokens.level -= actual_tokens - estimated_tokens
+
+    def update(self, headers: Mapping[str, str]):
+        """Sync buckets with rate limit headers from an api response (success or 429). Headers
+        we don't recognize are ignored.
+        """
+        limits = parse_rate_limit_headers(headers)
+        with self.lock:
+            now = time.monotonic()
+            for name, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+                if name not in limits:
+                    continue
+                limit, remaining = limits[name]
+                # Reserve part of the remaining quota too so we stay below the limit.
+                margin = 0 if limit is None else limit * (1 - self.headroom)
+                bucket.sync(
+                    self._scale(limit),
+                    None if remaining is None else remaining - margin,
+                    now
+                )
+            # Openrouter uses fixed windows rather than a continuously refilling quota, so once a
+            # window is used up nothing frees up until it resets.
+            window_reset = limits.get("window_reset")
+            if window_reset and limits["requests"][1] == 0:
+                self.requests.drain(now, window_reset)
+
+    def backoff(self, seconds: float):
+        """Pause all callers for `seconds`, e.g. after a 429 with a retry-after header."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        logger.warning(f"Rate limited, pausing new requests for {seconds:.1f}s.")
+
+
+def parse_rate_limit_headers(headers: Mapping[str, str]) -> dict:
+    """Extract rate limits from response headers.
+
+    Returns
+    -------
+    dict
+        Maps "requests" and/or "tokens" to a (limit, remaining) tuple where either item may be None
+        if the provider didn't send it. For providers with fixed rate limit windows (openrouter),
+        "window_reset" maps to the number of seconds until the current window resets.
+    """
+    headers = {k.lower(): v for k, v in headers.items()}
+    res = {}
+    # openai: x-ratelimit-{limit,remaining,reset}-{requests,tokens}. Openai's reset headers just
+    # tell us how long until the bucket is full again which we can already infer from the limit.
+    for name in ("requests", "tokens"):
+        limit = _to_float(headers.get(f"x-ratelimit-limit-{name}"))
+        remaining = _to_float(headers.get(f"x-ratelimit-remaining-{name}"))
+        if limit is not None or remaining is not None:
+            res[name] = (limit, remaining)
+    # openrouter: x-ratelimit-{limit,remaining,reset}, where reset is a unix timestamp in ms.
+    if "requests" not in res and "x-ratelimit-remaining" in headers:
+        res["requests"] = (
+            _to_float(headers.get("x-ratelimit-limit")),
+            _to_float(headers.get("x-ratelimit-remaining")),
+        )
+        reset = _to_float(headers.get("x-ratelimit-reset"))
+        if reset is not None:
+            res["window_reset"] = max(0.0, reset / 1000 - datetime.now().timestamp())
+    return res
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    """Get the wait time suggested by a 429 response, if any."""
+    headers = {k.lower(): v for k, v in headers.items()}
+    if "retry-after-ms" in headers:
+        ms = _to_float(headers["retry-after-ms"])
+        return None if ms is None else ms / 1000
+    if "retry-after" in headers:
+        return _to_float(headers["retry-after"])
+    return None
+
+
+def estimate_tokens(api_kwargs: dict) -> int:
+    """Rough token count for a chat completion request (~4 chars per token), plus the completion
+    budget if one was set. Only used for pacing so it doesn't need to be exact: `RateLimiter`
+    corrects itself once it sees actual usage.
+    """
+    n_chars = sum(len(str(message.get("content", ""))) for message in api_kwargs["messages"])
+    max_completion = api_kwargs.get("max_completion_tokens") or api_kwargs.get("max_tokens") or 0
+    return n_chars // 4 + max_completion
+
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,400 @@
+"""Route api calls for one logical model across several provider endpoints, with failover and
+hedged requests.
+
+endpoints = [Endpoint("openai", "gpt-4.1-nano"), Endpoint("openrouter", "openai/gpt-4.1-nano")]
+router = Router(endpoints)
+# Waits on the chosen endpoint's rate limiter, then calls the function (or `await router.acall`).
+result = router.call(lambda endpoint: call_api(endpoint, **kwargs), n_tokens=1_000)
+router.summary()  # Per-endpoint health, latency percentiles, hedge and failover counts.
+
+Endpoints are tried in priority order. An endpoint that keeps failing with retryable errors (5xx,
+429, connection errors) is benched for a while and its calls fail over to the next one. Once an
+endpoint has enough latency samples, a call that runs past its p95 gets a duplicate (hedged)
+request on the next healthy endpoint (or the same one if there's no other) and whichever
+answers first wins, so a few stuck requests can't hold up the tail of a long job.
+"""
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import itertools
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from openai._exceptions import APIConnectionError, InternalServerError, RateLimitError
+
+from aeon.logging import logger
+from aeon.metrics import Histogram
+from aeon.ratelimit import RateLimiter, retry_after_seconds
+
+
+# Errors that say something about the endpoint rather than the request, so another endpoint (or
+# the same one later) may well succeed. Anything else (bad request, schema validation) is raised
+# straight away since every endpoint would fail the same way.
+FAILOVER_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
+
+class Endpoint:
+    """One provider/model pair plus everything we track about it: its clients, its rate
+    limiter (quotas are per provider), and health stats.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
+        """
+        Parameters
+        ----------
+        provider : str
+            Key of `aeon.labeling.PROVIDER_URLS`, e.g. "openrouter".
+        model : str
+            Model name as this provider spells it, e.g. "openai/gpt-4.1-nano" on openrouter.
+        rate_limiter : RateLimiter or None
+            Defaults to one that learns its limits from response headers.
+        """
+        self.provider = provider
+        self.model = model
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # Sync or async clients, set by whoever owns the endpoint (LLMLabeler creates them per
+        # engine). Several clients split up a big connection pool, see `client`.
+        self.clients = []
+        self._next_client = itertools.count()
+        self.latency = Histogram()
+        self.n_calls = 0
+        self.n_errors = 0
+        self.consecutive_errors = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def client(self):
+        """Next client, round robin."""
+        return self.clients[next(self._next_client) % len(self.clients)]
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}:{self.model}"
+
+    def healthy(self, now: Optional[float] = None) -> bool:
+        return (now or time.monotonic()) >= self.unhealthy_until
+
+    def summary(self) -> dict:
+        return {
+            "calls": self.n_calls,
+            "errors": self.n_errors,
+            "healthy": self.healthy(),
+            "latency_seconds": self.latency.summary(),
+        }
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name})"
+
+
+class Router:
+    """Picks endpoints for api calls and tracks their health. Thread safe, and `acall` can be used
+    concurrently from coroutines on one event loop.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        hedge: bool = True,
+        hedge_quantile: float = 95.0,
+        hedge_min_samples: int = 20,
+        max_hedge_fraction: float = 0.1,
+        max_consecutive_errors: int = 3,
+        cooldown_seconds: float = 30.0,
+        max_threads: int = 64,
+    ):
+        """
+        Parameters
+        ----------
+        endpoints : list[Endpoint]
+            In priority order: calls go to the first healthy endpoint.
+        hedge : bool
+            If True, send a duplicate request when a call is slower than `hedge_quantile` of its
+            endpoint's latencies so far.
+        hedge_quantile : float
+            Latency percentile (0-100) after which we hedge. 95 means ~5% extra requests.
+        hedge_min_samples : int
+            Don't hedge on an endpoint until we've seen this many of its calls succeed, since the
+            percentile is meaningless before then.
+        max_hedge_fraction : float
+            Cap on hedged requests as a fraction of all calls. When a provider slows down across
+            the board, hedging everything would just double the load on it.
+        max_consecutive_errors : int
+            Bench an endpoint for `cooldown_seconds` after this many retryable errors in a row.
+        cooldown_seconds : float
+            How long a benched endpoint is skipped (unless every endpoint is benched). 429s with a
+            retry-after header bench the endpoint for that long instead.
+        max_threads : int
+            Threads available to `call` for running the original and hedged requests side by
+            side. Should be at least twice the number of threads calling `call`.
+        """
+        if not endpoints:
+            raise ValueError("Router needs at least one endpoint.")
+        self.endpoints = list(endpoints)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedge_fraction = max_hedge_fraction
+        self.max_consecutive_errors = max_consecutive_errors
+        self.cooldown_seconds = cooldown_seconds
+        self.max_threads = max_threads
+        self.n_calls = 0
+        self.n_hedges = 0
+        self.n_hedge_wins = 0
+        self.n_failovers = 0
+        self.lock = threading.Lock()
+        self._executor = None
+
+    def choose(self, exclude: tuple = ()) -> Optional[Endpoint]:
+        """Highest priority healthy endpoint not in `exclude`. If all of those are benched, the
+        one that comes back soonest. None if every endpoint is excluded.
+        """
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        for endpoint in candidates:
+            if endpoint.healthy(now):
+                return endpoint
+        return min(candidates, key=lambda endpoint: endpoint.unhealthy_until)
+
+    def hedge_delay(self, endpoint: Endpoint) -> Optional[float]:
+        """Seconds to wait on `endpoint` before hedging, or None if we shouldn't hedge yet."""
+        if not self.hedge or endpoint.latency.n < self.hedge_min_samples:
+            return None
+        with self.lock:
+            return endpoint.latency.percentile(self.hedge_quantile)
+
+    def _take_hedge(self) -> bool:
+        """Count a hedged request if it fits within `max_hedge_fraction`."""
+        with self.lock:
+            if self.n_hedges >= self.max_hedge_fraction * self.n_calls:
+                return False
+            self.n_hedges += 1
+            return True
+
+    def record_success(self, endpoint: Endpoint, latency: float):
+        with self.lock:
+            endpoint.n_calls += 1
+            endpoint.consecutive_errors = 0
+            endpoint.unhealthy_until = 0.0
+            endpoint.latency.add(latency)
+
+    def record_failure(self, endpoint: Endpoint, e: Exception):
+        """Count a retryable error and bench the endpoint if it's had too many in a row."""
+        cooldown = None
+        if isinstance(e, RateLimitError):
+            cooldown = retry_after_seconds(e.response.headers)
+        with self.lock:
+            endpoint.n_calls += 1
+            endpoint.n_errors += 1
+            endpoint.consecutive_errors += 1
+            if cooldown is None and endpoint.consecutive_errors >= self.max_consecutive_errors:
+                cooldown = self.cooldown_seconds
+            if cooldown:
+                was_healthy = endpoint.healthy()
+                endpoint.unhealthy_until = max(
+                    endpoint.unhealthy_until, time.monotonic() + cooldown
+                )
+        if cooldown and was_healthy and len(self.endpoints) > 1:
+            logger.warning(
+                f"Endpoint {endpoint.name} is unhealthy ({type(e).__name__}), routing around it "
+                f"for {cooldown:.0f}s."
+            )
+
+    def call(self, fn: Callable[[Endpoint], Any], n_tokens: int = 0) -> Any:
+        """Call `fn(endpoint)` on the best endpoint, hedging if it's slow and failing over to the
+        next endpoint on retryable errors. Raises the last error if every endpoint failed.
+
+        Parameters
+        ----------
+        fn : callable
+            Makes the actual request on the endpoint it's given.
+        n_tokens : int
+            Estimated tokens for the request. We wait on the endpoint's rate limiter before
+            calling `fn`, so that time spent queueing locally doesn't count towards the
+            endpoint's latency (or trigger hedges).
+        """
+        with self.lock:
+            self.n_calls += 1
+        tried = []
+        while (endpoint := self.choose(exclude=tuple(tried))) is not None:
+            tried.append(endpoint)
+            try:
+                return self._hedged(fn, endpoint, tried, n_tokens)
+            except FAILOVER_ERRORS as e:
+                error = e
+                if len(tried) < len(self.endpoints):
+                    with self.lock:
+                        self.n_failovers += 1
+                    logger.info(f"{endpoint.name} failed ({type(e).__name__}), failing over.")
+        raise error
+
+    async def acall(self, fn: Callable[[Endpoint], Awaitable[Any]], n_tokens: int = 0) -> Any:
+        """Async version of `call`, where `fn(endpoint)` returns an awaitable."""
+        with self.lock:
+            self.n_calls += 1
+        tried = []
+        while (endpoint := self.choose(exclude=tuple(tried))) is not None:
+            tried.append(endpoint)
+            try:
+                return await self._ahedged(fn, endpoint, tried, n_tokens)
+            except FAILOVER_ERRORS as e:
+                error = e
+                if len(tried) < len(self.endpoints):
+                    with self.lock:
+                        self.n_failovers += 1
+                    logger.info(f"{endpoint.name} failed ({type(e).__name__}), failing over.")
+        raise error
+
+    def _backup(self, tried: list[Endpoint]) -> Endpoint:
+        """Endpoint for a hedged request. Prefers one we haven't tried, otherwise duplicates the
+        request on the last endpoint (a second try on the same provider still cuts tail latency).
+        """
+        backup = self.choose(exclude=tuple(tried))
+        if backup is None or not backup.healthy():
+            return tried[-1]
+        return backup
+
+    def _timed(
+        self,
+        fn: Callable[[Endpoint], Any],
+        endpoint: Endpoint,
+        n_tokens: Optional[int] = None,
+    ) -> Any:
+        """Call `fn` and record the outcome. Waits on the rate limiter first unless `n_tokens` is
+        None (meaning the caller already did).
+        """
+        if n_tokens is not None:
+            endpoint.rate_limiter.wait(n_tokens)
+        start = time.perf_counter()
+        try:
+            res = fn(endpoint)
+        except FAILOVER_ERRORS as e:
+            self.record_failure(endpoint, e)
+            raise
+        self.record_success(endpoint, time.perf_counter() - start)
+        return res
+
+    async def _atimed(
+        self,
+        fn: Callable[[Endpoint], Awaitable[Any]],
+        endpoint: Endpoint,
+        n_tokens: Optional[int] = None,
+    ) -> Any:
+        if n_tokens is not None:
+            await endpoint.rate_limiter.async_wait(n_tokens)
+        start = time.perf_counter()
+        try:
+            res = await fn(endpoint)
+        except FAILOVER_ERRORS as e:
+            self.record_failure(endpoint, e)
+            raise
+        except asyncio.CancelledError:
+            # Lost a hedge race. It took at least this long, and leaving it out would bias the
+            # percentile (and so the hedge delay) towards fast calls until we hedge everything.
+            with self.lock:
+                endpoint.latency.add(time.perf_counter() - start)
+            raise
+        self.record_success(endpoint, time.perf_counter() - start)
+        return res
+
+    def _hedged(
+        self,
+        fn: Callable[[Endpoint], Any],
+        endpoint: Endpoint,
+        tried: list,
+        n_tokens: int,
+    ) -> Any:
+        endpoint.rate_limiter.wait(n_tokens)
+        delay = self.hedge_delay(endpoint)
+        if delay is None:
+            return self._timed(fn, endpoint)
+
+        # Run the original request in the pool too so we can stop waiting on it. We can't cancel
+        # a blocking http call, so a losing request finishes in the background and is discarded.
+        executor = self._get_executor()
+        primary = executor.submit(self._timed, fn, endpoint)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result()
+        backup = self._backup(tried)
+        futures = {primary: False, executor.submit(self._timed, fn, backup, n_tokens): True}
+        pending = set(futures)
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if futures[future]:
+                        with self.lock:
+                            self.n_hedge_wins += 1
+                    return future.result()
+                errors.append(future.exception())
+        raise errors[0]
+
+    async def _ahedged(
+        self,
+        fn: Callable[[Endpoint], Awaitable[Any]],
+        endpoint: Endpoint,
+        tried: list,
+        n_tokens: int,
+    ) -> Any:
+        await endpoint.rate_limiter.async_wait(n_tokens)
+        delay = self.hedge_delay(endpoint)
+        if delay is None:
+            return await self._atimed(fn, endpoint)
+
+        primary = asyncio.create_task(self._atimed(fn, endpoint))
+        tasks = {primary: False}
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done or not self._take_hedge():
+                return await primary
+            backup = self._backup(tried)
+            tasks[asyncio.create_task(self._atimed(fn, backup, n_tokens))] = True
+            pending = set(tasks)
+            errors = []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if tasks[task]:
+                            with self.lock:
+                                self.n_hedge_wins += 1
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+        finally:
+            # Unlike threads, the losing coroutine can actually be cancelled.
+            for task in tasks:
+                task.cancel()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self.lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_threads, thread_name_prefix="aeon-hedge"
+                )
+            return self._executor
+
+    def close(self):
+        """Release hedging threads. Requests still running in them are abandoned."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def summary(self) -> dict:
+        """Json serializable routing stats."""
+        with self.lock:
+            return {
+                "calls": self.n_calls,
+                "hedges": self.n_hedges,
+                "hedge_wins": self.n_hedge_wins,
+                "failovers": self.n_failovers,
+                "endpoints": {endpoint.name: endpoint.summary() for endpoint in self.endpoints},
+            }
@@ -1,11 +1,30 @@
+"""Secrets (api keys etc.), resolved lazily and cached so importing aeon never touches the network.
+
+api_key = get_secret("OPENAI_API_KEY")
+
+Sources, in order: env vars, `.env` files in the aeon lib root and project root, a local cache of
+previously fetched Infisical secrets (permission-restricted, expires after a TTL), and finally
+Infisical itself.
+"""
+import json
 import os
+from pathlib import Path
+import threading
+import time
 from typing import Optional
 
-from infisical_sdk import InfisicalSDKClient
-
+from aeon.config import CACHE_DIR, LIB_ROOT, PROJECT_ROOT
 from aeon.logging import logger
 
 
+DOTENV_PATHS = [LIB_ROOT/".env", PROJECT_ROOT/".env"]
+# In its own dir so we can lock that down without touching the rest of the cache dir.
+SECRETS_CACHE_PATH = CACHE_DIR/"secrets"/"secrets.json"
+SECRETS_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+_lock = threading.Lock()
+
+
 class SecretManager:
 
 
@@ -22,6 +41,9 @@ class SecretManager:
             )
         self.client_id = client_id
         self.project_slug = project_slug
+        # Imported here because it's slow and only needed when the local sources come up empty.
+        from infisical_sdk import InfisicalSDKClient
+
         self.client = InfisicalSDKClient(host="https://app.infisical.com")
         self.client.auth.universal_auth.login(
             client_id=self.client_id,
@@ -45,3 +67,100 @@ class SecretManager:
         """Set secrets as env vars."""
         for k, v in self.get_secrets().items():
             os.environ[k] = v
+
+
+def get_secret(name: str, ttl_seconds: float = SECRETS_CACHE_TTL_SECONDS) -> str:
+    """Look up a secret, checking cheap local sources before Infisical (see module docstring).
+    Whatever we find is also exported as an env var so later lookups (and subprocesses) get it
+    for free.
+
+    Parameters
+    ----------
+    name : str
+        Secret name, e.g. "OPENAI_API_KEY".
+    ttl_seconds : float
+        Max age of the local Infisical cache before we fetch fresh values. If Infisical can't be
+        reached, an expired cache is still used rather than failing.
+    """
+    if name in os.environ:
+        return os.environ[name]
+    with _lock:
+        # Another thread may have resolved it while we waited.
+        if name in os.environ:
+            return os.environ[name]
+        for path in DOTENV_PATHS:
+            value = read_dotenv(path).get(name)
+            if value is not None:
+                os.environ[name] = value
+                return value
+
+        cached, fetched_at = _read_cache()
+        if name not in cached or time.time() - fetched_at > ttl_seconds:
+            try:
+                cached = SecretManager().get_secrets()
+                _write_cache(cached)
+            except Exception as e:
+                if name not in cached:
+                    raise KeyError(
+                        f"Secret {name} not found in env vars, {DOTENV_PATHS}, or the local "
+                        f"cache, and fetching from Infisical failed: {e}"
+                    ) from e
+                logger.warning(f"Failed to refresh secrets from Infisical ({e}), using cache.")
+        if name not in cached:
+            raise KeyError(f"Secret {name} not found in any secrets source.")
+        os.environ[name] = cached[name]
+        return cached[name]
+
+
+def read_dotenv(path: Path) -> dict:
+    """Parse simple KEY=VALUE lines from a .env file (comments, blank lines, `export` prefixes
+    and surrounding quotes are handled). Returns an empty dict if the file doesn't exist.
+    """
+    try:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return {}
+    res = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        key = key.strip().removeprefix("export ").strip()
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+            value = value[1:-1]
+        res[key] = value
+    return res
+
+
+def _read_cache() -> tuple[dict, float]:
+    """Cached Infisical secrets and the unix time they were fetched, or ({}, 0) if there's no
+    usable cache.
+    """
+    try:
+        with open(SECRETS_CACHE_PATH, "r") as f:
+            data = json.load(f)
+        return data["secrets"], data["fetched_at"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return {}, 0.0
+
+
+def _write_cache(secrets: dict):
+    """Atomically write secrets to the local cache, readable only by the current user. Only the
+    cache's own dir is restricted, the shared cache dir above it keeps its permissions.
+    """
+    SECRETS_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    os.chmod(SECRETS_CACHE_PATH.parent, 0o700)
+    tmp_path = SECRETS_CACHE_PATH.with_suffix(".tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # In case a stale tmp file already existed with looser permissions.
+    with os.fdopen(fd, "w") as f:
+        json.dump({"fetched_at": time.time(), "secrets": secrets}, f)
+    os.replace(tmp_path, SECRETS_CACHE_PATH)
+
+
+def clear_secrets_cache():
+    """Delete the local cache, e.g. after rotating a key."""
+    SECRETS_CACHE_PATH.unlink(missing_ok=True)
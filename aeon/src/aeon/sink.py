@@ -0,0 +1,191 @@
+"""Append-only JSONL shard storage for intermediate labeling results.
+
+with ShardWriter(output_dir/"batches") as writer:
+    writer.write(json.dumps(row_result))  # Thread safe, returns immediately.
+rows = list(read_shards(output_dir/"batches"))
+# Or, without loading every row at once (see aeon.utils.chunked):
+make_chunks = lambda: chunked(read_shards(output_dir/"batches"), 10_000)
+write_parquet_chunks(make_chunks, output_dir/"output.pq")
+"""
+import json
+import os
+from pathlib import Path
+import queue
+import threading
+import time
+from typing import Callable, Iterator, Optional, Union
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from aeon.logging import logger
+
+
+class ShardWriter:
+    """Single background thread that appends lines to rotating JSONL shards
+    (`shard-00000.jsonl`, `shard-00001.jsonl`, ...). Many threads or coroutines can call `write`
+    concurrently without touching the filesystem themselves. Shards are flushed after every batch
+    of lines and fsynced periodically, so a crash loses at most the last `fsync_seconds` of
+    results (and at worst leaves one partially written line, which `read_shards` skips).
+    """
+
+    _stop = object()
+
+    def __init__(
+        self,
+        dir_: Union[str, Path],
+        rows_per_shard: int = 10_000,
+        fsync_seconds: float = 5.0,
+    ):
+        """
+        Parameters
+        ----------
+        dir_ : str or Path
+            Dir to write shards to. If it already contains shards (e.g. we're resuming a run),
+            numbering continues after the last existing shard.
+        rows_per_shard : int
+            Start a new shard after this many lines.
+        fsync_seconds : float
+            Max time between fsyncs of the current shard.
+        """
+        self.dir = Path(dir_)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.rows_per_shard = rows_per_shard
+        self.fsync_seconds = fsync_seconds
+        self.shard_idx = len(shard_paths(self.dir))
+        self.n_written = 0
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="aeon-shard-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, line: str):
+        """Queue one line (no trailing newline) to be written."""
+        if self.error is not None:
+            raise RuntimeError("ShardWriter thread failed.") from self.error
+        self.queue.put(line)
+
+    def close(self):
+        """Write any queued lines, fsync, and stop the background thread."""
+        self.queue.put(self._stop)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("ShardWriter thread failed.") from self.error
+
+    def _run(self):
+        f = None
+        n_in_shard = 0
+        last_sync = time.monotonic()
+        try:
+            while True:
+                # Block for the first line, then grab whatever else has piled up so we write in
+                # batches instead of issuing a syscall per line.
+                try:
+                    lines = [self.queue.get(timeout=self.fsync_seconds)]
+                except queue.Empty:
+                    lines = []
+                while True:
+                    try:
+                        lines.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = self._stop in lines
+                for line in lines:
+                    if line is self._stop:
+                        continue
+                    if f is None or n_in_shard >= self.rows_per_shard:
+                        if f is not None:
+                            self._sync_and_close(f)
+                        f = open(self.dir/f"shard-{self.shard_idx:05d}.jsonl", "a")
+                        self.shard_idx += 1
+                        n_in_shard = 0
+                    f.write(line + "\n")
+                    n_in_shard += 1
+                    self.n_written += 1
+
+                if f is not None:
+                    f.flush()
+                    if stop or time.monotonic() - last_sync >= self.fsync_seconds:
+                        os.fsync(f.fileno())
+                        last_sync = time.monotonic()
+                if stop:
+                    break
+        except Exception as e:
+            logger.error(f"ShardWriter failed with error: {e}")
+            self.error = e
+        finally:
+            if f is not None and not f.closed:
+                f.close()
+
+    @staticmethod
+    def _sync_and_close(f):
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def shard_paths(dir_: Union[str, Path]) -> list[Path]:
+    """Shard files in a dir, in the order they were written."""
+    return sorted(Path(dir_).glob("shard-*.jsonl"))
+
+
+def read_shards(dir_: Union[str, Path]) -> Iterator[dict]:
+    """Yield json rows from all shards in a dir in the order they were written. Lines that can't
+    be parsed (e.g. the last line of a shard when the process was killed mid-write) are skipped.
+    """
+    for path in shard_paths(dir_):
+        with open(path, "r") as f:
+            for line_num, line in enumerate(f):
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping unreadable line {line_num} in {path}.")
+
+
+def write_parquet_chunks(
+    make_chunks: Callable[[], Iterator[list[dict]]],
+    path: Union[str, Path],
+    schema: Optional[pa.Schema] = None,
+) -> int:
+    """Write rows to a single parquet file without holding them all in memory. Nested dict
+    columns can have different keys from row to row (e.g. an empty response for a failed row), so
+    unless a schema is provided we make one pass to infer a schema covering every chunk and a
+    second pass to write each chunk as a row group with that schema.
+
+    Parameters
+    ----------
+    make_chunks : callable
+        Returns a fresh iterator of row chunks each time it's called (it's called twice unless
+        `schema` is provided).
+    path : str or Path
+        Output parquet path.
+    schema : pa.Schema or None
+        Schema of the rows, if known up front. Saves a pass over the data.
+
+    Returns
+    -------
+    int
+        Number of rows written.
+    """
+    if schema is None:
+        schemas = [pa.Table.from_pylist(chunk).schema for chunk in make_chunks() if chunk]
+        if not schemas:
+            pq.write_table(pa.table({}), path)
+            return 0
+        schema = pa.unify_schemas(schemas, promote_options="permissive")
+    n_rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in make_chunks():
+            if chunk:
+                # Converting with the schema (rather than casting) also fills in keys that are
+                # missing from every row in this chunk, e.g. fields added since a resumed run.
+                writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                n_rows += len(chunk)
+    return n_rows
@@ -0,0 +1,144 @@
+"""Token counting, token-budget packing, and splitting long texts into windows.
+
+count_tokens("Some text", model="gpt-4.1-nano")
+for group in pack_by_tokens(texts, n_tokens=count_tokens, max_tokens=4_000, max_items=50):
+    ...  # Each group's texts sum to at most 4k tokens (unless one text is longer on its own).
+windows = split_by_tokens(transcript, max_tokens=4_000, overlap_tokens=200)
+"""
+from functools import lru_cache
+import re
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+from aeon.logging import logger
+
+
+T = TypeVar("T")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: Optional[str]):
+    """tiktoken encoding for a model, or None if tiktoken isn't installed or can't load its
+    encoding files (they're downloaded on first use). Non-openai models (and models tiktoken
+    doesn't know yet) fall back to o200k_base, which is close enough for budgeting.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken is not installed, estimating token counts as ~4 chars/token.")
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except (KeyError, TypeError):
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(
+            f"Failed to load tiktoken encoding ({e}), estimating token counts as ~4 chars/token."
+        )
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Number of tokens in `text` for `model`. Uses tiktoken if available, otherwise ~4 chars per
+    token.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def pack_by_tokens(
+    items: Iterable[T],
+    n_tokens: Callable[[T], int],
+    max_tokens: int,
+    max_items: Optional[int] = None,
+) -> Iterator[list[T]]:
+    """Lazily group consecutive items such that each group's total token count is at most
+    `max_tokens`. An item that exceeds the budget by itself gets a group of its own.
+
+    Parameters
+    ----------
+    items : iterable
+        Items to group. Order is preserved.
+    n_tokens : callable
+        Maps an item to its token count.
+    max_tokens : int
+        Token budget per group.
+    max_items : int or None
+        Optional cap on group size regardless of tokens, e.g. to bound the size of the response.
+    """
+    group = []
+    group_tokens = 0
+    for item in items:
+        item_tokens = n_tokens(item)
+        if group and (
+            group_tokens + item_tokens > max_tokens
+            or (max_items is not None and len(group) >= max_items)
+        ):
+            yield group
+            group = []
+            group_tokens = 0
+        group.append(item)
+        group_tokens += item_tokens
+    if group:
+        yield group
+
+
+def split_by_tokens(
+    text: str,
+    max_tokens: int,
+    overlap_tokens: int = 0,
+    model: Optional[str] = None,
+) -> list[str]:
+    """Split text into overlapping windows of about `max_tokens` tokens each, cutting at line
+    breaks (or failing that, spaces) where possible so windows rarely start or end mid-sentence.
+    Window sizes are estimated from the text's overall chars per token, so they can be off by a
+    few percent either way.
+
+    Parameters
+    ----------
+    text : str
+        Text to split. Returned as the only window if it fits in `max_tokens`.
+    max_tokens : int
+        Target window size.
+    overlap_tokens : int
+        About how many tokens at the end of each window are repeated at the start of the next, so
+        anything cut in half by a window boundary appears whole in one of them.
+    model : str or None
+        Tokenizer to count with, see `count_tokens`.
+    """
+    if not 0 <= overlap_tokens < max_tokens:
+        raise ValueError(
+            f"overlap_tokens must be in [0, max_tokens), got {overlap_tokens} for max_tokens "
+            f"{max_tokens}."
+        )
+    n_tokens = count_tokens(text, model)
+    if n_tokens <= max_tokens:
+        return [text]
+    chars_per_token = len(text) / n_tokens
+    size = max(int(max_tokens * chars_per_token), 1)
+    overlap = int(overlap_tokens * chars_per_token)
+    windows = []
+    start = 0
+    while start + size < len(text):
+        end = start + size
+        # Don't cut so early that the next window wouldn't move past this one's overlap.
+        earliest = start + overlap + (size - overlap) // 2
+        cut = text.rfind("\n", earliest, end)
+        if cut == -1:
+            cut = text.rfind(" ", earliest, end)
+        if cut != -1:
+            end = cut + 1
+        windows.append(text[start:end])
+        # Start the next window on a word boundary too.
+        next_start = end - overlap
+        if overlap:
+            boundary = _WHITESPACE.search(text, next_start, end)
+            if boundary:
+                next_start = boundary.end()
+        start = max(next_start, start + 1)
+    windows.append(text[start:])
+    return windows
@@ -1,7 +1,12 @@
+import asyncio
 from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
+import queue
 import subprocess
+import threading
 import time
+from typing import Any, Coroutine, Iterable, Iterator, Optional
 
 from aeon.logging import logger
 
@@ -45,4 +50,111 @@ def timer(name: str = "BLOCK") -> dict:
         yield res
     finally:
         res["duration"] = time.perf_counter() - res["start"]
-        logger.info(f"[TIMER] {name} executed in {res['duration']:.3f} s.")
\ No newline at end of file
+        logger.info(f"[TIMER] {name} executed in {res['duration']:.3f} s.")
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Lazily split an iterable into lists of `size` items (the last one may be shorter)."""
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+class Prefetcher:
+    """Iterate over `items` in a background thread, staying up to `max_ready` items ahead of the
+    consumer. Lets a loop that is also waiting on other work take whatever items are ready
+    without blocking on a slow or blocking iterable (e.g. rows streamed from another labeling
+    stage). Exceptions raised while iterating are re-raised by `take`.
+
+    prefetcher = Prefetcher(rows, max_ready=100)
+    batch = prefetcher.take(10)  # Up to 10 rows that are ready now, maybe none.
+    batch = prefetcher.take(10, timeout=None)  # Wait for at least one, unless exhausted.
+    prefetcher.done  # True once every item has been taken.
+    """
+
+    _end = object()
+
+    def __init__(self, items: Iterable, max_ready: int, name: str = "aeon-prefetcher"):
+        self.done = False
+        self.error = None
+        self._items = items
+        self._queue = queue.Queue(max(max_ready, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for item in self._items:
+                if not self._put(item):
+                    return
+        except BaseException as e:
+            self.error = e
+        self._put(self._end)
+
+    def _put(self, item: Any) -> bool:
+        # Poll so that `close` can stop us even if the consumer never takes another item.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def take(self, n: int, timeout: Optional[float] = 0.0) -> list:
+        """Take up to `n` items. Waits up to `timeout` seconds (forever if None) for the first
+        one, then takes whatever else is ready. Returns an empty list once `done`.
+        """
+        items = []
+        while len(items) < n and not self.done:
+            try:
+                if items or timeout == 0:
+                    item = self._queue.get_nowait()
+                else:
+                    item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is self._end:
+                self.done = True
+                if self.error is not None:
+                    raise self.error
+            else:
+                items.append(item)
+        return items
+
+    def close(self):
+        """Stop iterating. The thread exits once the iterable yields its next item (right away
+        unless the iterable itself is blocked).
+        """
+        self._stop.set()
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def background_event_loop() -> asyncio.AbstractEventLoop:
+    """Get a long-lived event loop running in a daemon thread, starting it on first use. Lets sync
+    code run coroutines even when the calling thread already has a running loop (e.g. Jupyter).
+    """
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_background_loop.run_forever, name="aeon-event-loop", daemon=True
+            ).start()
+    return _background_loop
+
+
+def run_coroutine(coro: Coroutine) -> Any:
+    """Run a coroutine to completion on the background event loop and return its result. If the
+    caller is interrupted (e.g. KeyboardInterrupt), the coroutine is cancelled before re-raising.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, background_event_loop())
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
@@ -0,0 +1,61 @@
+"""Startup time of the `aeon` CLI. Each check runs in a fresh interpreter since imports are
+cached per process.
+"""
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+
+# Modules that take tens to hundreds of ms to import and that no CLI startup path should need.
+HEAVY_MODULES = ["openai", "pandas", "pyarrow", "numpy", "pydantic", "httpx", "torch"]
+# Run against the source tree, whether or not aeon is installed.
+SRC_DIR = Path(__file__).parent.parent/"src"
+ENV = {
+    **os.environ,
+    "PYTHONPATH": os.pathsep.join(filter(None, [str(SRC_DIR), os.environ.get("PYTHONPATH")])),
+}
+
+
+def _run(code: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True, env=ENV
+    )
+
+
+def _best_seconds(args: list[str], n: int = 5) -> float:
+    """Fastest of `n` runs, which is the least noisy estimate of the real startup cost."""
+    best = float("inf")
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.run(args, capture_output=True, check=True, env=ENV)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def test_cli_imports_are_lazy():
+    code = (
+        "import sys, aeon, aeon.cli, aeon.prompt\n"
+        "aeon.prompt.Prompts.EXTRACT_JOKES\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    assert _run(code).stdout.strip() == ""
+
+
+def test_package_exports_resolve():
+    code = (
+        "import aeon\n"
+        "assert 'LLMLabeler' in dir(aeon)\n"
+        "assert aeon.Prompt is aeon.prompt.Prompt\n"
+        "print(aeon.LLMLabeler.__module__)"
+    )
+    assert _run(code).stdout.strip() == "aeon.labeling"
+
+
+def test_version_startup_time():
+    # What the CLI adds on top of starting the interpreter, which alone can take most of 100ms
+    # on a slow machine or with many site-packages.
+    interpreter_seconds = _best_seconds([sys.executable, "-c", "pass"])
+    seconds = _best_seconds([sys.executable, "-m", "aeon.cli", "version"]) - interpreter_seconds
+    assert seconds < 0.1, f"`aeon version` took {seconds * 1000:.0f}ms over interpreter startup"
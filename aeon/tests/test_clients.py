@@ -0,0 +1,59 @@
+"""Process-wide openai client registry. Creating clients doesn't make any requests."""
+import pandas as pd
+import pytest
+
+from aeon import labeling
+from aeon.labeling import LLMLabeler, close_clients, get_client, get_clients
+from aeon.mockserver import MockLLMServer
+
+
+@pytest.fixture(autouse=True)
+def fresh_clients(monkeypatch):
+    # A unique base url keeps these clients apart from those of other tests.
+    monkeypatch.setenv("OPENAI_BASE_URL", "http://127.0.0.1:1/test-clients/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "mock")
+    yield
+    close_clients()
+
+
+def _pool_size(client) -> int:
+    return client._client._transport._pool._max_connections
+
+
+def test_clients_are_reused():
+    assert get_client("openai") is get_client("openai")
+    # Pool sizes are rounded up to a power of 2, so similar sizes share clients.
+    assert get_clients("openai", 100) == get_clients("openai", 128)
+    assert get_clients("openai", 100) != get_clients("openai", 129)
+    assert get_clients("openai", 100, is_async=True) != get_clients("openai", 100)
+
+
+def test_big_pools_are_sharded():
+    clients = get_clients("openai", max_connections=1000)
+    assert len(clients) == 1024 // labeling.POOL_SHARD_SIZE == 16
+    assert len({id(client) for client in clients}) == 16
+    assert all(_pool_size(client) == 64 for client in clients)
+    assert _pool_size(get_client("openai", max_connections=10)) == 16
+    async_clients = get_clients("openai", max_connections=1000, is_async=True)
+    assert [_pool_size(client) for client in async_clients] == [64] * 16
+
+
+def test_close_clients_clears_registry():
+    client = get_client("openai")
+    close_clients()
+    assert labeling._clients == {}
+    assert get_client("openai") is not client
+
+
+def test_label_runs_share_clients(tmp_path, monkeypatch):
+    df = pd.DataFrame({"transcript": ["transcript 0", "transcript 1"]})
+    with MockLLMServer(latency="fixed:0", seed=0) as server:
+        monkeypatch.setenv("OPENAI_BASE_URL", server.url)
+        labeler = LLMLabeler("extract_jokes", parent_dir=tmp_path)
+        clients = []
+        for _ in range(2):
+            res = labeler.label(df, model="gpt-4.1-nano", cache=False, max_workers=4)
+            assert res["n_errors"] == 0
+            clients.append(labeler.router.endpoints[0].clients)
+
+    assert clients[0] == clients[1] == get_clients("openai", max_connections=8)
@@ -0,0 +1,41 @@
+"""Per-field confidence from hand written token logprobs."""
+import numpy as np
+import pandas as pd
+
+from aeon.confidence import confidence_columns, field_confidence, field_paths
+from aeon.prompts.extract_jokes import BatchResponse
+
+
+def _logprobs(tokens: list[tuple[str, float]]) -> list[dict]:
+    return [
+        {"token": token, "bytes": list(token.encode()), "logprob": logprob, "top_logprobs": []}
+        for token, logprob in tokens
+    ]
+
+
+def test_field_confidence_attributes_tokens_to_fields():
+    tokens = [
+        ('{"items": [{"joke": ', 0.0),
+        ('"ha', -2.0),
+        (' \\"ha\\""', -1.0),
+        (', "prompt": ', 0.0),
+        ('"why?"', -0.5),
+        ("}]}", 0.0),
+    ]
+    paths = field_paths(BatchResponse)
+    df = pd.DataFrame({"logprobs": [_logprobs(tokens), None]}, index=[10, 11])
+    conf = field_confidence(df, paths)
+
+    assert paths == [
+        "items", "items.joke", "items.prompt", "items.subtext", "items.unfunny_variant"
+    ]
+    assert conf.columns.tolist() == confidence_columns(paths)
+    assert conf.index.tolist() == [10, 11]
+    # Escaped quotes don't end the string.
+    assert conf.loc[10, "items.joke_logprob_mean"] == -1.5
+    assert conf.loc[10, "items.joke_logprob_min"] == -2.0
+    assert conf.loc[10, "items.prompt_logprob_min"] == -0.5
+    assert conf.loc[10, "items_logprob_min"] == -2.0
+    # Fields the response doesn't have, and rows without logprobs, are NaN.
+    assert np.isnan(conf.loc[10, "items.subtext_logprob_min"])
+    assert conf.loc[11].isna().all()
@@ -0,0 +1,67 @@
+"""Near-duplicate detection. Indexes are seeded, so results are deterministic."""
+import pandas as pd
+import pytest
+
+from aeon.dedup import MinHashLSH, deduplicate, lsh_params
+
+
+JOKE = "Why did the chicken cross the road? To get to the other side, obviously."
+# Same joke after normalizing case and punctuation.
+SHOUTED = JOKE.upper() + "!!"
+# About 0.74 Jaccard similarity to JOKE.
+REWORDED = "Why did the chicken cross the road? To get to the other side, apparently."
+UNRELATED = "Knock knock. Who's there? Interrupting cow."
+
+
+@pytest.mark.parametrize(
+    "threshold, text, duplicate",
+    [
+        (1.0, SHOUTED, True),
+        (0.5, REWORDED, True),
+        (0.95, REWORDED, False),
+        (0.5, UNRELATED, False),
+    ],
+)
+def test_threshold(threshold, text, duplicate):
+    index = MinHashLSH(threshold=threshold)
+    assert index.add([JOKE, text]).tolist() == [0, 0 if duplicate else 1]
+    assert index.n_duplicates == int(duplicate)
+
+
+def test_duplicates_found_across_batches():
+    index = MinHashLSH(batch_size=2)
+    assert index.add([JOKE, UNRELATED, "Something else entirely."]).tolist() == [0, 1, 2]
+    assert index.add([SHOUTED, UNRELATED.lower()]).tolist() == [0, 1]
+    assert len(index) == 5
+    assert index.clusters().tolist() == [0, 1, 2, 0, 1]
+
+
+def test_lsh_params_fit_signature():
+    for threshold in (0.3, 0.5, 0.8, 0.95):
+        bands, rows = lsh_params(threshold, 64)
+        assert bands * rows <= 64
+    # Higher thresholds need longer exact matches (rows per band) to become candidates.
+    assert lsh_params(0.95, 64)[1] > lsh_params(0.3, 64)[1]
+
+
+def test_invalid_threshold():
+    with pytest.raises(ValueError):
+        MinHashLSH(threshold=0)
+
+
+def test_empty_texts():
+    index = MinHashLSH()
+    # Empty texts are duplicates of each other and nothing else, wherever they are in a batch.
+    assert index.add(["", "abcde", ""]).tolist() == [0, 1, 0]
+    assert index.add(["", "abcdef"]).tolist() == [0, 4]
+
+
+def test_deduplicate_df(tmp_path):
+    df = pd.DataFrame({"joke": [JOKE, UNRELATED, SHOUTED, None]}, index=[5, 6, 7, 8])
+    res = deduplicate(df, "joke", output_path=tmp_path/"clusters.pq")
+
+    assert res.cluster.tolist() == [0, 1, 0, 3]
+    assert res.duplicate.tolist() == [False, False, True, False]
+    saved = pd.read_parquet(tmp_path/"clusters.pq")
+    assert saved.index.tolist() == [5, 6, 7, 8]
+    assert saved.columns.tolist() == ["cluster", "duplicate"]
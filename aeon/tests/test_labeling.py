@@ -0,0 +1,479 @@
+"""LLMLabeler end to end against a local `MockLLMServer`, so no network or api key is needed."""
+import json
+from pathlib import Path
+import re
+import sqlite3
+import threading
+
+import pandas as pd
+import pytest
+from tenacity import wait_none
+
+from aeon import labeling
+from aeon.cache import ResponseCache
+from aeon.columnar import read_metadata, render_messages
+from aeon.confidence import confidence_columns, field_paths
+from aeon.labeling import LLMLabeler, Pipeline, Stage
+from aeon.mockserver import MockLLMServer
+from aeon.prompts.extract_jokes import BatchResponse
+from aeon.tokens import count_tokens, pack_by_tokens, split_by_tokens
+
+
+# extract_jokes defaults to a gpt-5 model, which doesn't support logprobs.
+MODEL = "gpt-4.1-nano"
+
+
+class PackingServer(MockLLMServer):
+    """Mock server that records the inputs of every packed request and lets a test tamper with
+    packed responses, e.g. to drop or duplicate a row's items.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.packs = []
+        # Called with a packed response's items and a dict mapping each input_id to its input's
+        # text, returns the items to send back.
+        self.edit = None
+
+    def completion(self, body: dict) -> dict:
+        res = super().completion(body)
+        inputs = dict(
+            (int(i), text) for i, text in re.findall(
+                r'<input id="(\d+)">\n(.*?)\n</input>', body["messages"][-1]["content"], re.S
+            )
+        )
+        if not inputs:
+            return res
+        self.packs.append(inputs)
+        if self.edit is not None:
+            message = res["choices"][0]["message"]
+            content = json.loads(message["content"])
+            content["items"] = self.edit(content["items"], inputs)
+            message["content"] = json.dumps(content)
+        return res
+
+
+class RateLimitFirstServer(MockLLMServer):
+    """Mock server that rate limits the first `n_rate_limited` chat completions, then serves the
+    rest normally.
+    """
+
+    def __init__(self, n_rate_limited: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.n_rate_limited = n_rate_limited
+
+    async def _chat_completion(self, body: dict) -> tuple[int, dict, bytes]:
+        self.rate_limit_rate = float(self.counts["rate_limited"] < self.n_rate_limited)
+        return await super()._chat_completion(body)
+
+
+def _serve(server: MockLLMServer, monkeypatch) -> MockLLMServer:
+    monkeypatch.setenv("OPENAI_BASE_URL", server.url)
+    monkeypatch.setenv("OPENAI_API_KEY", "mock")
+    return server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    with MockLLMServer(latency="fixed:0", seed=0) as server:
+        yield _serve(server, monkeypatch)
+
+
+@pytest.fixture
+def packing_server(monkeypatch):
+    with PackingServer(latency="fixed:0", seed=0) as server:
+        yield _serve(server, monkeypatch)
+
+
+def _transcripts(n: int) -> pd.DataFrame:
+    return pd.DataFrame({"transcript": [f"transcript {i}" for i in range(n)]})
+
+
+def _label(tmp_path, df: pd.DataFrame, **kwargs) -> dict:
+    return LLMLabeler("extract_jokes", parent_dir=tmp_path).label(
+        df, model=MODEL, **{"cache": False, **kwargs}
+    )
+
+
+def test_batch_engine_matches_thread_engine(server, tmp_path):
+    df = _transcripts(5)
+    batch = _label(tmp_path, df, engine="batch", batch_poll_seconds=0)
+    thread = _label(tmp_path, df, engine="thread")
+
+    assert batch["n_errors"] == 0
+    assert batch["df"].columns.tolist() == thread["df"].columns.tolist()
+    assert batch["df"].id.tolist() == list(range(5))
+    for res in (batch, thread):
+        assert res["df"].last_message.tolist() == df.transcript.tolist()
+        assert res["df"].response_content.map(lambda content: "items" in content).all()
+
+
+def test_async_engine_labels_every_row(server, tmp_path):
+    df = _transcripts(20)
+    res = _label(tmp_path, df, engine="async", max_workers=4)
+
+    assert res["completed"]
+    assert res["n_errors"] == 0
+    assert res["df"].id.tolist() == list(range(20))
+    assert res["df"].last_message.tolist() == df.transcript.tolist()
+    assert server.counts["completions"] == 20
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_generator_input_is_read_a_bounded_window_ahead(engine, tmp_path, monkeypatch):
+    max_workers = 2
+    # Up to a window in flight plus a window ready in the prefetcher, and one more that the
+    # prefetcher has read but can't hand over yet.
+    bound = 2 * labeling.IN_FLIGHT_PER_WORKER * max_workers + 1
+    n_rows = 5 * bound
+    leads = []
+
+    def rows():
+        for i in range(n_rows):
+            # Rows read so far minus rows the server has answered.
+            leads.append(i - server.counts["completions"])
+            yield {"transcript": f"transcript {i}"}
+
+    with MockLLMServer(latency="fixed:0.01", seed=0) as server:
+        _serve(server, monkeypatch)
+        res = _label(tmp_path, rows(), engine=engine, max_workers=max_workers)
+
+    assert res["n_errors"] == 0
+    assert len(leads) == n_rows
+    assert max(leads) <= bound
+    assert res["df"].id.tolist() == list(range(n_rows))
+    assert res["df"].last_message.tolist() == [f"transcript {i}" for i in range(n_rows)]
+
+
+def test_second_run_hits_cache(server, tmp_path):
+    df = _transcripts(5)
+    cache = ResponseCache(tmp_path/"responses.sqlite")
+    first = _label(tmp_path, df, cache=cache)
+    second = _label(tmp_path, df, cache=cache)
+
+    assert (first["cache_hits"], first["cache_misses"]) == (0, 5)
+    assert (second["cache_hits"], second["cache_misses"]) == (5, 0)
+    assert server.counts["completions"] == 5
+    assert second["df"].cached.all()
+    assert second["df"].response_content.tolist() == first["df"].response_content.tolist()
+
+    # Any change to the rendered request is a miss.
+    third = _label(tmp_path, df, cache=cache, temperature=0.5)
+    assert third["cache_misses"] == 5
+
+
+def test_default_cache_is_closed_after_each_run(server, tmp_path, monkeypatch):
+    opened = []
+
+    class DefaultCache(ResponseCache):
+        def __init__(self):
+            super().__init__(tmp_path/"responses.sqlite")
+            opened.append(self)
+
+    monkeypatch.setattr(labeling, "ResponseCache", DefaultCache)
+    df = _transcripts(3)
+    _label(tmp_path, df, cache=True)
+    second = _label(tmp_path, df, cache=True)
+
+    assert second["cache_hits"] == 3
+    assert len(opened) == 2
+    for cache in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            len(cache)
+    # A cache passed in belongs to the caller and stays open.
+    cache = ResponseCache(tmp_path/"responses.sqlite")
+    _label(tmp_path, df, cache=cache)
+    assert len(cache) == 3
+
+
+def test_resume_skips_finished_rows(server, tmp_path):
+    df = _transcripts(5)
+    # Stand in for a run that was interrupted after labeling the first 3 rows.
+    first = _label(tmp_path, df.head(3), cleanup=False)
+    resumed = _label(tmp_path, df, resume_dir=Path(first["output_path"]).parent)
+
+    assert resumed["n_resumed"] == 3
+    assert server.counts["completions"] == 5
+    assert resumed["df"].id.tolist() == list(range(5))
+    assert resumed["df"].last_message.tolist() == df.transcript.tolist()
+    assert resumed["df"].head(3).response_content.tolist() \
+        == first["df"].response_content.tolist()
+
+
+def test_fails_over_to_fallback_model(server, tmp_path, monkeypatch):
+    with MockLLMServer(latency="fixed:0", error_rate=1.0, seed=0) as down:
+        monkeypatch.setenv("OPENAI_BASE_URL", down.url)
+        monkeypatch.setenv("OPENROUTER_BASE_URL", server.url)
+        monkeypatch.setenv("OPENROUTER_API_KEY", "mock")
+        res = _label(
+            tmp_path, _transcripts(5), fallback_models=["openai/gpt-4.1-nano"], max_workers=1
+        )
+
+    assert res["n_errors"] == 0
+    assert (res["df"].endpoint == "openrouter:openai/gpt-4.1-nano").all()
+    assert res["df"].retries.eq(0).all()
+    assert server.counts["completions"] == 5
+    # The primary is benched after a few 500s rather than being retried on every row.
+    assert down.counts["errors"] == 3
+    assert res["metrics"]["router"]["failovers"] == 3
+
+
+def test_metrics_record_timings_and_retries(tmp_path, monkeypatch):
+    # Retry right away rather than after api_retry's usual multi-second backoff.
+    monkeypatch.setattr(LLMLabeler.retryable_api_call.retry, "wait", wait_none())
+    with RateLimitFirstServer(latency="fixed:0.01", retry_after_seconds=0.01, seed=0) as server:
+        _serve(server, monkeypatch)
+        res = _label(tmp_path, _transcripts(4), max_workers=1)
+
+    df = res["df"]
+    with open(Path(res["output_path"]).parent/"metrics.json") as f:
+        metrics = json.load(f)
+    assert res["n_errors"] == 0
+    assert server.counts["rate_limited"] == 1
+    assert df.retries.tolist() == [1, 0, 0, 0]
+    assert (df.queue_wait_seconds >= 0).all()
+    assert (df.latency_seconds >= 0.01).all()
+    assert metrics == json.loads(json.dumps(res["metrics"]))
+    assert metrics["rows"] == metrics["requests"] == 4
+    assert metrics["errors"] == metrics["cached_rows"] == 0
+    assert metrics["retries"] == 1
+    assert metrics["prompt_tokens"] == df.prompt_tokens.sum()
+    assert metrics["completion_tokens"] == df.completion_tokens.sum()
+    for name in ("queue_wait_seconds", "latency_seconds", "total_seconds"):
+        assert metrics[name]["n"] == 4
+        assert metrics[name]["p50"] <= metrics[name]["p99"] <= metrics[name]["max"]
+    # The retried row waited out the 429 before it was answered.
+    assert metrics["total_seconds"]["max"] >= 0.02
+    assert metrics["rows_per_second"] > 0 and metrics["tokens_per_second"] > 0
+    assert metrics["cost_usd"] > 0
+    assert metrics["cost_per_row_usd"] == pytest.approx(metrics["cost_usd"] / 4)
+
+
+def test_static_prefix_is_identical_across_rows(server, tmp_path):
+    labeler = LLMLabeler("extract_jokes", parent_dir=tmp_path)
+    res = labeler.label(_transcripts(3), model=MODEL, cache=False)
+
+    prompt = labeler.prompt
+    kwargs = res["df"].api_kwargs.tolist()
+    prefixes = {json.dumps(row["messages"][:-1]) for row in kwargs}
+    assert prefixes == {json.dumps(prompt.static_messages)}
+    assert {row["prompt_cache_key"] for row in kwargs} == {
+        f"aeon-extract_jokes-{prompt.prefix_hash[:16]}"
+    }
+    # The hash only depends on the static messages, not on the instance.
+    assert LLMLabeler("extract_jokes", parent_dir=tmp_path).label(
+        _transcripts(1), model=MODEL, cache=False
+    )["df"].api_kwargs[0]["prompt_cache_key"] == kwargs[0]["prompt_cache_key"]
+
+
+def test_cached_tokens_reach_row_results(server, tmp_path):
+    res = _label(tmp_path, _transcripts(3), max_workers=1)
+
+    df = res["df"]
+    usage_cached = [
+        raw["usage"]["prompt_tokens_details"]["cached_tokens"] for raw in df.response_raw
+    ]
+    # The mock server caches a prefix once it's seen it, like openai does.
+    assert usage_cached[0] == 0
+    assert usage_cached[1] == usage_cached[2] > 0
+    assert df.cached_tokens.tolist() == usage_cached
+    assert res["cached_tokens"] == res["metrics"]["cached_tokens"] == sum(usage_cached)
+    assert res["cached_token_fraction"] == pytest.approx(
+        sum(usage_cached) / df.prompt_tokens.sum()
+    )
+
+
+def test_pipeline_links_rows_to_parents(server, tmp_path):
+    pipeline = Pipeline(
+        [Stage("extract_jokes"), Stage("rewrite_joke_variant", explode="items")],
+        parent_dir=tmp_path,
+    )
+    res = pipeline.run(_transcripts(5), model=MODEL, cache=False)
+
+    assert res["completed"]
+    extracted, rewritten = res["stages"][0]["df"], res["df"]
+    items = extracted.set_index("id").response_content.map(lambda content: content["items"])
+    assert len(rewritten) == items.map(len).sum() > 0
+    assert rewritten.id.tolist() == list(range(len(rewritten)))
+    for row in rewritten.itertuples():
+        assert items[row.parent_id][row.item_index]["joke"] in row.last_message
+
+
+def test_columnar_output_matches_nested(server, tmp_path):
+    df = _transcripts(5)
+    cache = ResponseCache(tmp_path/"responses.sqlite")
+    nested = _label(tmp_path, df, cache=cache)["df"]
+    res = _label(tmp_path, df, cache=cache, output_format="columnar")
+    columnar = res["df"]
+
+    assert "api_kwargs" not in columnar and "response_content" not in columnar
+    assert columnar.transcript.tolist() == df.transcript.tolist()
+    for items, content in zip(columnar["items"], nested.response_content):
+        assert [dict(item) for item in items] == content["items"]
+    assert columnar.logprobs.map(len).gt(0).all()
+    metadata = read_metadata(res["output_path"])
+    for row, api_kwargs in zip(columnar.to_dict("records"), nested.api_kwargs):
+        assert render_messages(metadata, row) == list(api_kwargs["messages"])
+
+
+def test_confidence_columns_match_across_formats(server, tmp_path):
+    df = _transcripts(5)
+    cache = ResponseCache(tmp_path/"responses.sqlite")
+    nested = _label(tmp_path, df, cache=cache, confidence=True)["df"]
+    columnar = _label(tmp_path, df, cache=cache, confidence=True, output_format="columnar")["df"]
+
+    columns = confidence_columns(field_paths(BatchResponse))
+    assert nested[columns].notna().all().all()
+    pd.testing.assert_frame_equal(nested[columns], columnar[columns])
+
+
+def test_pipeline_stage_drops_near_duplicates(server, tmp_path):
+    # Every extracted joke shows up twice, as if it had been extracted from two transcripts.
+    stage = Stage(
+        "rewrite_joke_variant",
+        explode=lambda res: res["response_content"]["items"] * 2,
+        dedup="joke",
+    )
+    res = Pipeline([Stage("extract_jokes"), stage], parent_dir=tmp_path)\
+        .run(_transcripts(3), model=MODEL, cache=False)
+
+    n_items = res["stages"][0]["df"].response_content.map(lambda content: len(content["items"]))
+    assert res["stages"][1]["n_duplicates"] == len(res["df"]) == n_items.sum()
+    clusters = pd.read_json(
+        Path(res["output_dir"])/"1-rewrite_joke_variant/clusters.jsonl", lines=True
+    )
+    assert len(clusters) == 2 * len(res["df"])
+    assert clusters.duplicate.sum() == len(res["df"])
+
+
+def test_long_inputs_are_labeled_in_windows(server, tmp_path):
+    long = "\n".join(
+        f"Line {i}: so my dog walks into a bar and orders a drink." for i in range(200)
+    )
+    df = pd.DataFrame({"transcript": [long, "A short transcript."]})
+    n_windows = len(split_by_tokens(long, 300, 50, model=MODEL))
+    cache = ResponseCache(tmp_path/"responses.sqlite")
+    kwargs = dict(cache=cache, chunk_tokens=300, chunk_overlap_tokens=50)
+    res = _label(tmp_path, df, **kwargs)
+
+    assert n_windows > 1
+    assert res["n_errors"] == 0
+    assert server.counts["completions"] == n_windows + 1
+    # One merged result per input row.
+    assert res["df"].id.tolist() == [0, 1]
+    assert res["df"].last_message.tolist() == df.transcript.tolist()
+    windows = res["df"].response_raw[0]["windows"]
+    assert len(windows) == n_windows
+    assert isinstance(res["df"].response_content[0]["items"], list)
+    assert "windows" not in res["df"].response_raw[1]
+
+    again = _label(tmp_path, df, **kwargs)
+    assert again["cache_hits"] == 2
+    assert server.counts["completions"] == n_windows + 1
+
+
+def test_packed_items_route_back_by_input_id(packing_server, tmp_path):
+    def edit(items: list[dict], inputs: dict) -> list[dict]:
+        # Tag every item with its input's text, answer the first input twice and the last one
+        # not at all, and return everything out of order.
+        for item in items:
+            item["joke"] = inputs[item["input_id"]]
+        items = [item for item in items if item["input_id"] != len(inputs) - 1]
+        return (items + items[:1])[::-1]
+
+    packing_server.edit = edit
+    res = _label(tmp_path, _transcripts(6), pack_tokens=10_000)
+
+    assert [len(inputs) for inputs in packing_server.packs] == [6]
+    assert res["n_errors"] == 0
+    assert res["df"].last_message.tolist() == _transcripts(6).transcript.tolist()
+    items = res["df"].response_content.map(lambda content: content["items"]).tolist()
+    # extract_jokes can return any number of jokes per input, so none of this is an error.
+    assert [len(row_items) for row_items in items] == [2, 1, 1, 1, 1, 0]
+    for i, row_items in enumerate(items):
+        assert all(f"transcript {i}" in item["joke"] for item in row_items)
+        assert all("input_id" not in item for item in row_items)
+
+
+def test_packed_rows_skipped_or_duplicated_fail(packing_server, tmp_path):
+    # rewrite_joke_variant expects exactly one item per input.
+    packing_server.edit = lambda items, inputs: [
+        item for item in items if item["input_id"] != 1
+    ] + [item for item in items if item["input_id"] == 2]
+    df = pd.DataFrame({
+        "joke": [f"joke {i}" for i in range(4)], "prompt": "Any jokes?", "subtext": "Dogs."
+    })
+    cache = ResponseCache(tmp_path/"responses.sqlite")
+    res = LLMLabeler("rewrite_joke_variant", parent_dir=tmp_path).label(
+        df, model=MODEL, cache=cache, pack_tokens=10_000
+    )
+
+    assert len(packing_server.packs) == 1
+    assert res["df"].success.tolist() == [True, False, False, True]
+    assert res["df"].error[1] == res["df"].error[2] != ""
+    assert set(res["df"].response_content[0]) == {"joke_2", "joke_3", "ranking"}
+    # Only rows that got an answer are cached.
+    assert (res["cache_hits"], res["cache_misses"]) == (0, 4)
+    assert sum(cache.get(key) is not None for key in res["df"].cache_key) == 2
+
+
+def test_packs_are_cut_at_token_budget(packing_server, tmp_path):
+    df = pd.DataFrame({"transcript": [f"transcript {i} " + "ha " * (10 * i) for i in range(12)]})
+    labeler = LLMLabeler("extract_jokes", parent_dir=tmp_path)
+    res = labeler.label(df, model=MODEL, cache=False, pack_tokens=200, pack_max_rows=4)
+
+    messages = res["df"].last_message.tolist()
+    n_tokens = [count_tokens(message, MODEL) for message in messages]
+    assert sum(n_tokens) > 200
+    expected = [len(group) for group in pack_by_tokens(n_tokens, lambda n: n, 200, 4)]
+    # Packs run concurrently, so put them back in submission order.
+    packs = sorted(packing_server.packs, key=lambda inputs: messages.index(inputs[0]))
+    assert [len(inputs) for inputs in packs] == expected
+    i = 0
+    for inputs in packs:
+        group = messages[i:i + len(inputs)]
+        assert [inputs[j] for j in range(len(inputs))] == group
+        # A row that's over budget by itself goes alone, otherwise packs stay within it.
+        assert len(group) == 1 or sum(n_tokens[i:i + len(inputs)]) <= 200
+        i += len(inputs)
+    assert res["n_errors"] == 0
+
+
+def test_single_row_pack_matches_unpacked(packing_server, tmp_path):
+    df = _transcripts(3)
+    # Every row is over a 1 token budget, so each one is packed alone.
+    packed = _label(tmp_path, df, pack_tokens=1)
+    unpacked = _label(tmp_path, df)
+
+    assert [len(inputs) for inputs in packing_server.packs] == [1, 1, 1]
+    assert packed["n_errors"] == 0
+    assert packed["df"].columns.tolist() == unpacked["df"].columns.tolist()
+    assert packed["df"].last_message.tolist() == unpacked["df"].last_message.tolist()
+    contents = zip(packed["df"].response_content, unpacked["df"].response_content)
+    for packed_content, content in contents:
+        assert set(packed_content) == set(content) == {"items"}
+        assert all(set(item) == set(content["items"][0]) for item in packed_content["items"])
+    # The whole request's usage belongs to its only row.
+    assert packed["df"].prompt_tokens.gt(0).all()
+    assert packed["prompt_tokens"] == packed["df"].prompt_tokens.sum()
+
+
+def test_async_engine_saves_rows_off_the_event_loop(server, tmp_path, monkeypatch):
+    threads = []
+
+    def record_thread(method):
+        def wrapper(self, res):
+            threads.append(threading.current_thread().name)
+            return method(self, res)
+        return wrapper
+
+    for name in ("_store_cached", "_save_row_result"):
+        monkeypatch.setattr(LLMLabeler, name, record_thread(getattr(LLMLabeler, name)))
+    cache = ResponseCache(tmp_path/"responses.sqlite")
+    res = _label(tmp_path, _transcripts(10), engine="async", cache=cache)
+
+    assert res["n_errors"] == 0
+    assert len(cache) == 10
+    # Each row is stored in the cache and saved to the shards once.
+    assert len(threads) == 20
+    assert "aeon-event-loop" not in threads
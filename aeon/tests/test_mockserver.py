@@ -0,0 +1,72 @@
+"""The mock openai server on its own, talked to over plain http."""
+import httpx
+import pytest
+
+from aeon.mockserver import MockLLMServer, parse_latency
+from aeon.prompt import Prompt
+from aeon.prompts.extract_jokes import BatchResponse
+from aeon.ratelimit import retry_after_seconds
+
+
+def _body() -> dict:
+    kwargs = Prompt("extract_jokes", model="gpt-4.1-nano").kwargs(transcript="A dog walks in.")
+    kwargs["response_format"] = {
+        "type": "json_schema",
+        "json_schema": {"name": "BatchResponse", "schema": BatchResponse.model_json_schema()},
+    }
+    return kwargs
+
+
+def _post(server: MockLLMServer, n: int = 1) -> list[httpx.Response]:
+    with httpx.Client(base_url=server.url) as client:
+        return [client.post("/chat/completions", json=_body()) for _ in range(n)]
+
+
+def test_rate_limited_responses_say_when_to_retry():
+    with MockLLMServer(latency="fixed:0", rate_limit_rate=1.0, retry_after_seconds=2.5) as server:
+        (response,) = _post(server)
+
+    assert response.status_code == 429
+    assert response.headers["retry-after-ms"] == "2500"
+    assert retry_after_seconds(response.headers) == 2.5
+    assert "error" in response.json()
+    assert server.counts == {"requests": 1, "completions": 0, "errors": 0, "rate_limited": 1}
+
+
+def test_injected_failures_follow_rates():
+    with MockLLMServer(latency="fixed:0", error_rate=0.2, rate_limit_rate=0.3, seed=0) as server:
+        responses = _post(server, 200)
+
+    statuses = [response.status_code for response in responses]
+    assert server.counts["requests"] == 200
+    assert statuses.count(429) == server.counts["rate_limited"]
+    assert statuses.count(500) == server.counts["errors"]
+    assert statuses.count(200) == server.counts["completions"]
+    # Loose bounds: with 200 draws these hold for any reasonable seed.
+    assert 40 <= server.counts["rate_limited"] <= 80
+    assert 20 <= server.counts["errors"] <= 60
+    # Successful responses don't carry a retry header.
+    assert all(
+        "retry-after-ms" not in response.headers for response in responses
+        if response.status_code == 200
+    )
+
+
+def test_completions_match_response_format():
+    with MockLLMServer(latency="fixed:0", seed=0) as server:
+        (response,) = _post(server)
+
+    completion = response.json()
+    content = completion["choices"][0]["message"]["content"]
+    assert response.status_code == 200
+    assert BatchResponse.model_validate_json(content).items
+    assert completion["usage"]["total_tokens"] == \
+        completion["usage"]["prompt_tokens"] + completion["usage"]["completion_tokens"]
+
+
+def test_parse_latency():
+    with pytest.raises(ValueError):
+        parse_latency("gaussian:1")
+    with pytest.raises(ValueError):
+        parse_latency("uniform:1")
+    assert parse_latency("fixed:0.25")(None) == 0.25
@@ -0,0 +1,69 @@
+"""Rate limits learned from provider response headers. Nothing here sleeps: we only check how long
+the limiter says to wait.
+"""
+import time
+
+import pytest
+
+from aeon.ratelimit import RateLimiter, parse_rate_limit_headers, retry_after_seconds
+
+
+def test_parse_openai_headers():
+    headers = {
+        "X-RateLimit-Limit-Requests": "500",
+        "X-RateLimit-Remaining-Requests": "499",
+        "x-ratelimit-limit-tokens": "200000",
+        "x-ratelimit-remaining-tokens": "not a number",
+    }
+    assert parse_rate_limit_headers(headers) == {
+        "requests": (500.0, 499.0),
+        "tokens": (200_000.0, None),
+    }
+
+
+def test_parse_openrouter_headers():
+    reset_ms = (time.time() + 30) * 1000
+    limits = parse_rate_limit_headers({
+        "x-ratelimit-limit": "20",
+        "x-ratelimit-remaining": "0",
+        "x-ratelimit-reset": str(reset_ms),
+    })
+    assert limits["requests"] == (20.0, 0.0)
+    assert limits["window_reset"] == pytest.approx(30, abs=1)
+
+
+def test_limiter_learns_limits_from_headers():
+    limiter = RateLimiter(headroom=1.0, burst_seconds=None)
+    # Unlimited until we've seen a response.
+    assert limiter.reserve(1_000) == 0
+
+    limiter.update({"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "0"})
+    assert limiter.requests.limit == 60
+    assert limiter.tokens.limit is None
+    # Out of requests, and they refill at one per second.
+    assert limiter.reserve(1_000) == pytest.approx(1, abs=0.05)
+
+
+def test_limiter_keeps_headroom():
+    limiter = RateLimiter(headroom=0.5, burst_seconds=None)
+    limiter.update({"x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "1000"})
+    assert limiter.tokens.limit == 500
+    assert limiter.reserve(500) == 0
+    assert limiter.reserve(500) > 0
+
+
+def test_openrouter_window_drains_requests():
+    limiter = RateLimiter(headroom=1.0, burst_seconds=None)
+    limiter.update({
+        "x-ratelimit-limit": "60",
+        "x-ratelimit-remaining": "0",
+        "x-ratelimit-reset": str((time.time() + 10) * 1000),
+    })
+    # Nothing frees up until the window resets.
+    assert limiter.reserve(0) == pytest.approx(11, abs=0.5)
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds({"retry-after-ms": "1500"}) == 1.5
+    assert retry_after_seconds({"Retry-After": "2"}) == 2.0
+    assert retry_after_seconds({}) is None
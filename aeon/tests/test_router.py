@@ -0,0 +1,57 @@
+"""Failover between endpoints. Calls are plain functions that fail on demand, no network needed."""
+import httpx
+from openai import BadRequestError, InternalServerError
+import pytest
+
+from aeon.router import Endpoint, Router
+
+
+def _error(cls: type, status: int) -> Exception:
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    return cls("mock error", response=httpx.Response(status, request=request), body=None)
+
+
+def _call(down: set):
+    """Request function that fails with a 500 on any endpoint whose provider is in `down`."""
+    def fn(endpoint: Endpoint) -> str:
+        if endpoint.provider in down:
+            raise _error(InternalServerError, 500)
+        return endpoint.name
+    return fn
+
+
+def _endpoints() -> list[Endpoint]:
+    return [Endpoint("openai", "gpt-4.1-nano"), Endpoint("openrouter", "openai/gpt-4.1-nano")]
+
+
+def test_fails_over_on_5xx():
+    primary, fallback = _endpoints()
+    router = Router([primary, fallback], max_consecutive_errors=2, cooldown_seconds=60)
+
+    assert router.call(_call({"openai"})) == fallback.name
+    assert router.call(_call({"openai"})) == fallback.name
+    assert router.n_failovers == 2
+    assert (primary.n_errors, fallback.n_errors) == (2, 0)
+    # Benched after 2 errors in a row, so the next call goes straight to the fallback.
+    assert not primary.healthy()
+    assert router.call(_call(set())) == fallback.name
+    assert primary.n_calls == 2
+
+
+def test_raises_last_error_when_every_endpoint_fails():
+    router = Router(_endpoints())
+    with pytest.raises(InternalServerError):
+        router.call(_call({"openai", "openrouter"}))
+    assert router.n_failovers == 1
+
+
+def test_does_not_fail_over_on_bad_request():
+    def fn(endpoint: Endpoint):
+        raise _error(BadRequestError, 400)
+
+    primary, fallback = _endpoints()
+    router = Router([primary, fallback])
+    with pytest.raises(BadRequestError):
+        router.call(fn)
+    assert router.n_failovers == 0
+    assert fallback.n_calls == 0
@@ -0,0 +1,123 @@
+"""Secret lookup order and the local secrets cache. Infisical is replaced by a fake so nothing
+here touches the network.
+"""
+import json
+import os
+import stat
+import time
+
+import pytest
+
+from aeon import secrets
+
+
+NAME = "AEON_TEST_SECRET"
+
+
+class FakeSecretManager:
+    """Stands in for Infisical. Set `secrets` to what it should return, or None to fail."""
+
+    secrets = None
+    n_calls = 0
+
+    def get_secrets(self) -> dict:
+        type(self).n_calls += 1
+        if self.secrets is None:
+            raise ConnectionError("Infisical is unreachable (fake).")
+        return dict(self.secrets)
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    """Point every secrets source at tmp_path and start with all of them empty."""
+    monkeypatch.delenv(NAME, raising=False)
+    dotenv_paths = [tmp_path/"lib.env", tmp_path/"project.env"]
+    monkeypatch.setattr(secrets, "DOTENV_PATHS", dotenv_paths)
+    monkeypatch.setattr(secrets, "SECRETS_CACHE_PATH", tmp_path/"cache"/"secrets"/"secrets.json")
+    monkeypatch.setattr(FakeSecretManager, "secrets", None)
+    monkeypatch.setattr(FakeSecretManager, "n_calls", 0)
+    monkeypatch.setattr(secrets, "SecretManager", FakeSecretManager)
+    return dotenv_paths
+
+
+def _write_cache(path, values: dict, age_seconds: float = 0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"fetched_at": time.time() - age_seconds, "secrets": values}, f)
+
+
+def test_env_var_comes_first(sources, monkeypatch):
+    sources[0].write_text(f"{NAME}=from-dotenv\n")
+    monkeypatch.setenv(NAME, "from-env")
+    assert secrets.get_secret(NAME) == "from-env"
+
+
+def test_dotenv_files_in_order_then_exported(sources):
+    sources[1].write_text(f"{NAME}=from-project\n")
+    assert secrets.get_secret(NAME) == "from-project"
+
+    del os.environ[NAME]
+    sources[0].write_text(f"{NAME}=from-lib\n")
+    assert secrets.get_secret(NAME) == "from-lib"
+    assert os.environ[NAME] == "from-lib"
+    assert FakeSecretManager.n_calls == 0
+
+
+def test_fresh_cache_before_infisical(sources):
+    _write_cache(secrets.SECRETS_CACHE_PATH, {NAME: "from-cache"})
+    FakeSecretManager.secrets = {NAME: "from-infisical"}
+    assert secrets.get_secret(NAME) == "from-cache"
+    assert FakeSecretManager.n_calls == 0
+
+
+def test_expired_cache_is_refreshed_from_infisical(sources):
+    _write_cache(secrets.SECRETS_CACHE_PATH, {NAME: "stale"}, age_seconds=100)
+    FakeSecretManager.secrets = {NAME: "from-infisical"}
+    assert secrets.get_secret(NAME, ttl_seconds=10) == "from-infisical"
+    assert FakeSecretManager.n_calls == 1
+    assert secrets._read_cache()[0] == {NAME: "from-infisical"}
+
+
+def test_expired_cache_is_used_if_infisical_fails(sources):
+    _write_cache(secrets.SECRETS_CACHE_PATH, {NAME: "stale"}, age_seconds=100)
+    assert secrets.get_secret(NAME, ttl_seconds=10) == "stale"
+    assert FakeSecretManager.n_calls == 1
+
+
+def test_missing_everywhere(sources):
+    with pytest.raises(KeyError):
+        secrets.get_secret(NAME)
+    FakeSecretManager.secrets = {"SOME_OTHER_SECRET": "value"}
+    with pytest.raises(KeyError):
+        secrets.get_secret(NAME)
+
+
+def test_cache_permissions(sources):
+    cache_dir = secrets.SECRETS_CACHE_PATH.parent.parent
+    cache_dir.mkdir(parents=True)
+    os.chmod(cache_dir, 0o755)
+    FakeSecretManager.secrets = {NAME: "from-infisical"}
+    secrets.get_secret(NAME)
+
+    assert stat.S_IMODE(os.stat(secrets.SECRETS_CACHE_PATH).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(secrets.SECRETS_CACHE_PATH.parent).st_mode) == 0o700
+    # The shared cache dir (which also holds e.g. the response cache) is left alone.
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0o755
+    secrets.clear_secrets_cache()
+    assert not secrets.SECRETS_CACHE_PATH.exists()
+
+
+def test_read_dotenv(tmp_path):
+    path = tmp_path/".env"
+    path.write_text(
+        "# comment\n"
+        "\n"
+        "PLAIN=value\n"
+        "export EXPORTED = 'single quoted'\n"
+        'QUOTED="has = sign"\n'
+        "not a pair\n"
+    )
+    assert secrets.read_dotenv(path) == {
+        "PLAIN": "value", "EXPORTED": "single quoted", "QUOTED": "has = sign"
+    }
+    assert secrets.read_dotenv(tmp_path/"missing.env") == {}
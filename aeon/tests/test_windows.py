@@ -0,0 +1,65 @@
+"""Splitting long inputs into overlapping token windows and merging their responses."""
+import pytest
+
+from aeon.prompt import Prompt
+from aeon.tokens import count_tokens, split_by_tokens
+
+
+TRANSCRIPT = "\n".join(
+    f"Line {i}: so my dog walks into a bar and orders a drink, and the bartender says nothing."
+    for i in range(200)
+)
+
+
+def _item(joke: str) -> dict:
+    return {"joke": joke, "prompt": "Any jokes?", "subtext": "Dogs.", "unfunny_variant": "A dog."}
+
+
+def test_short_text_is_one_window():
+    assert split_by_tokens("Just a short bit.", max_tokens=100, overlap_tokens=10) == [
+        "Just a short bit."
+    ]
+
+
+def test_windows_overlap_and_cover_text():
+    windows = split_by_tokens(TRANSCRIPT, max_tokens=300, overlap_tokens=50)
+
+    # Line numbers make every window's position in the transcript unique.
+    starts = [TRANSCRIPT.find(window) for window in windows]
+    ends = [start + len(window) for start, window in zip(starts, windows)]
+    assert len(windows) > 1
+    assert -1 not in starts
+    assert starts[0] == 0 and ends[-1] == len(TRANSCRIPT)
+    for i in range(1, len(windows)):
+        # Cut at line breaks, and each window picks up a little before where the last one ended.
+        assert windows[i - 1].endswith("\n")
+        assert starts[i - 1] < starts[i] < ends[i - 1]
+    # Windows are estimated from the text's average chars per token, so allow some slack.
+    assert max(count_tokens(window) for window in windows) <= 300 * 1.1
+
+
+def test_invalid_overlap():
+    with pytest.raises(ValueError):
+        split_by_tokens(TRANSCRIPT, max_tokens=100, overlap_tokens=100)
+
+
+def test_merge_windows_drops_items_from_overlap():
+    prompt = Prompt("extract_jokes", model="gpt-4.1-nano")
+    cut_off = "So my dog walks into a bar and orders a drink."
+    merged = prompt.merge_windows([
+        {"items": [_item("First joke, about cats and their many opinions."), _item(cut_off)]},
+        # The overlap repeats the second joke, with slightly different transcription.
+        {"items": [_item(cut_off.lower().rstrip(".")), _item("Third joke, about airline food.")]},
+        {"items": []},
+    ])
+
+    assert [item["joke"] for item in merged["items"]] == [
+        "First joke, about cats and their many opinions.",
+        cut_off,
+        "Third joke, about airline food.",
+    ]
+
+
+def test_merge_windows_requires_pydantic_response_format():
+    with pytest.raises(ValueError):
+        Prompt("extract_jokes", response_format={"type": "json_object"}).merge_windows([{}])
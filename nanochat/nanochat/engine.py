@@ -7,6 +7,9 @@ Everything works around token sequences:
 
 Notes:
 - The engine knows nothing about tokenization, it's purely token id sequences.
+- Engine.generate serves one prompt (optionally many samples of it) at a time.
+  For serving many users at once, BatchScheduler does continuous batching:
+  requests join and leave a single running decode batch at every step.
 
 The whole thing is made as efficient as possible.
 """
@@ -14,6 +17,9 @@ The whole thing is made as efficient as possible.
 import torch
 import torch.nn.functional as F
 import signal
+import heapq
+import queue
+import threading
 import warnings
 from contextlib import contextmanager
 from collections import deque
@@ -80,23 +86,45 @@ def use_calculator(expr):
     return eval_with_timeout(expr)
 
 # -----------------------------------------------------------------------------
+KV_BLOCK_SIZE = 16 # tokens per page of a PagedKVCache
+
 class KVCache:
     """
     Works hand-in-hand with the GPT model to maintain the KV cache.
     Note that the .pos advances automatically after the last layer of the Transformer inserts.
+
+    All rows are normally at the same position, and attention reads a plain slice of the cache.
+    Once truncate() rolls a row back (e.g. to a tool call), every row is at its own position:
+    keys/values are written at each row's position and get_attn_mask() hides the slots a row
+    must not see. This is the contiguous counterpart of PagedKVCache, for a single request.
     """
 
     def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers):
         # Each of K/V is of shape (B, H, T, D) and we have one per layer of the Transformer.
         self.kv_shape = (num_layers, 2, batch_size, num_heads, seq_len, head_dim)
         self.kv_cache = None
-        self.pos = 0 # current position in time in the cache
+        self.pos = 0 # current position in time in the cache (of the rows furthest ahead, if they differ)
+        self.row_pos = None # (B,) position of every row once they differ, else None
+        self.attn_mask = None # (B, 1, T, pos + T) while rows are at different positions
+        self.write_idx = None # (rows, positions) where the current forward pass writes, with row_pos
 
     def reset(self):
         self.pos = 0
+        self.row_pos = None
+        self.attn_mask = None
 
     def get_pos(self):
-        return self.pos
+        return self.pos if self.row_pos is None else self.row_pos
+
+    def get_attn_mask(self):
+        return self.attn_mask
+
+    def truncate(self, row, length):
+        """Roll a row back to its first length tokens, the slots past that are overwritten by the next ones."""
+        assert length <= self.pos
+        if self.row_pos is None:
+            self.row_pos = torch.full((self.kv_shape[2],), self.pos, dtype=torch.long, device=self.kv_cache.device)
+        self.row_pos[row] = length
 
     def prefill(self, other):
         """
@@ -120,7 +148,7 @@ class KVCache:
                 assert dim1 >= dim2, f"Seq len mismatch: {dim1} < {dim2}"
         # 2) initialize the cache
         dtype, device = other.kv_cache.dtype, other.kv_cache.device
-        self.kv_cache = torch.empty(self.kv_shape, dtype=dtype, device=device)
+        self.kv_cache = torch.zeros(self.kv_shape, dtype=dtype, device=device) # see insert_kv for the zeros
         # 3) copy the data over
         self.kv_cache[:, :, :, :, :other.pos, :] = other.kv_cache
         # 4) update the pos
@@ -129,7 +157,9 @@ class KVCache:
     def insert_kv(self, layer_idx, k, v):
         # Lazy initialize the cache here because we need to know the dtype/device
         if self.kv_cache is None:
-            self.kv_cache = torch.empty(self.kv_shape, dtype=k.dtype, device=k.device)
+            # zeros, not empty: slots masked out for a row that was rolled back are still multiplied
+            # by 0 in attention, and garbage could be NaN
+            self.kv_cache = torch.zeros(self.kv_shape, dtype=k.dtype, device=k.device)
         # Insert new keys/values to the cache and return the full cache so far
         B, H, T_add, D = k.size()
         t0, t1 = self.pos, self.pos + T_add
@@ -139,39 +169,376 @@ class KVCache:
             t_needed = (t_needed + 1023) & ~1023 # then round up to the nearest multiple of 1024
             additional_shape = list(self.kv_cache.shape)
             additional_shape[4] = t_needed - self.kv_cache.size(4)
-            additional_cache = torch.empty(additional_shape, dtype=k.dtype, device=k.device)
+            additional_cache = torch.zeros(additional_shape, dtype=k.dtype, device=k.device)
             self.kv_cache = torch.cat([self.kv_cache, additional_cache], dim=4).contiguous()
             self.kv_shape = self.kv_cache.shape
         # Insert k, v into the cache
-        self.kv_cache[layer_idx, 0, :, :, t0:t1] = k
-        self.kv_cache[layer_idx, 1, :, :, t0:t1] = v
+        if self.row_pos is None:
+            self.kv_cache[layer_idx, 0, :, :, t0:t1] = k
+            self.kv_cache[layer_idx, 1, :, :, t0:t1] = v
+        else:
+            # every row writes at its own position, the same for all layers so worked out once per forward
+            if layer_idx == 0:
+                positions = self.row_pos[:, None] + torch.arange(T_add, device=k.device) # (B, T)
+                self.write_idx = (torch.arange(B, device=k.device)[:, None], positions)
+                key_pos = torch.arange(t1, device=k.device)
+                self.attn_mask = (key_pos[None, None, :] <= positions[:, :, None]).unsqueeze(1) # (B, 1, T, t1)
+            rows, positions = self.write_idx
+            self.kv_cache[layer_idx, 0, rows, :, positions] = k.transpose(1, 2)
+            self.kv_cache[layer_idx, 1, rows, :, positions] = v.transpose(1, 2)
         # Return the full cached keys/values up to current position (as a view)
         key_view = self.kv_cache[layer_idx, 0, :, :, :t1]
         value_view = self.kv_cache[layer_idx, 1, :, :, :t1]
         # Increment pos after the last layer of the Transformer processes
         if layer_idx == self.kv_cache.size(0) - 1:
             self.pos = t1
+            if self.row_pos is not None:
+                self.row_pos += T_add
         return key_view, value_view
 
 
+class PagedKVCache:
+    """
+    Paged KV cache: keys/values live in a pool of fixed size blocks (pages) of block_size
+    tokens, and every sequence has a block table listing the blocks that hold its history.
+    Blocks come from a free list when a sequence crosses a block boundary, so growing a
+    sequence is O(1) and no memory is reserved for tokens that were never generated.
+    Blocks are reference counted: fork() shares a sequence's blocks with a new sequence
+    (e.g. many samples of one prompt) and a shared block is copied on write.
+
+    A forward pass runs on the sequences selected with set_batch(). Each row is at its own
+    position, attention gathers each row's keys/values from its pages, and get_attn_mask()
+    keeps every query on its own row's history.
+    """
+
+    def __init__(self, num_blocks, num_heads, head_dim, num_layers, block_size=KV_BLOCK_SIZE, device=None):
+        # Each block holds (block_size, H, D) keys and values, per layer of the Transformer
+        self.kv_shape = (num_layers, 2, num_blocks, block_size, num_heads, head_dim)
+        self.kv_pages = None
+        self.block_size = block_size
+        self.device = device
+        self.free_blocks = list(range(num_blocks - 1, -1, -1)) # stack, pops the lowest ids first
+        self.ref_counts = [0] * num_blocks
+        self.block_tables = {} # sequence id -> list of block ids
+        self.lengths = {} # sequence id -> number of cached tokens
+        self.next_seq_id = 0
+        self.prefix_cache = None # a PrefixCache holding on to some of our blocks, if any
+        self.batch = [] # sequence ids of the rows of the next forward pass
+        self.write_slots = None # (B, T) slots where the current forward pass writes its keys/values
+        self.read_slots = None # (B, t1) slots holding each row's keys/values, padded with slot 0
+        self.attn_mask = None # (B, 1, T, t1), or None if plain causal attention does the job
+
+    @property
+    def num_blocks(self):
+        return self.kv_shape[2]
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def blocks_needed(self, num_tokens):
+        return -(-num_tokens // self.block_size)
+
+    def new_sequence(self, prefix_blocks=()):
+        """New sequence, optionally starting from full blocks already holding its prefix (see PrefixCache)."""
+        seq_id = self.next_seq_id
+        self.next_seq_id += 1
+        self.block_tables[seq_id] = list(prefix_blocks)
+        self.lengths[seq_id] = len(prefix_blocks) * self.block_size
+        for block in prefix_blocks:
+            self.ref_counts[block] += 1
+        return seq_id
+
+    def fork(self, seq_id):
+        """New sequence that shares the history of seq_id (no copies, until it is written to)."""
+        new_id = self.new_sequence()
+        self.block_tables[new_id] = list(self.block_tables[seq_id])
+        self.lengths[new_id] = self.lengths[seq_id]
+        for block in self.block_tables[new_id]:
+            self.ref_counts[block] += 1
+        return new_id
+
+    def truncate(self, seq_id, length):
+        """Forget the tokens of a sequence past length (e.g. speculative ones), freeing blocks it no longer needs."""
+        assert length <= self.lengths[seq_id]
+        table = self.block_tables[seq_id]
+        while len(table) > self.blocks_needed(length):
+            self._release(table.pop())
+        self.lengths[seq_id] = length
+
+    def free_sequence(self, seq_id):
+        for block in self.block_tables.pop(seq_id):
+            self._release(block)
+        del self.lengths[seq_id]
+
+    def set_batch(self, seq_ids):
+        self.batch = list(seq_ids)
+
+    def get_pos(self):
+        return torch.tensor([self.lengths[s] for s in self.batch], dtype=torch.long, device=self.device)
+
+    def get_attn_mask(self):
+        return self.attn_mask
+
+    def _allocate(self):
+        if not self.free_blocks and self.prefix_cache is not None:
+            self.prefix_cache.evict(lambda: self.free_blocks) # cached prefixes make way for live sequences
+        if not self.free_blocks:
+            self._grow()
+        block = self.free_blocks.pop()
+        self.ref_counts[block] = 1
+        return block
+
+    def _release(self, block):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+    def reserve(self, num_blocks):
+        """Make sure the pool has at least num_blocks blocks, growing it now rather than mid generation."""
+        if num_blocks > self.num_blocks:
+            self._grow(num_blocks - self.num_blocks)
+
+    def _grow(self, num_new=None):
+        # Add num_new blocks to the pool (default: double it). Block ids stay valid so no block table
+        # changes, but the pages are copied into a new pool, old and new both live for a moment.
+        # So size the pool up front: BatchScheduler never gets here, and Engine.generate (with a prefix
+        # cache) reserves its budget before the prefill, so only rows past its length hint grow the pool.
+        n = self.num_blocks
+        num_new = num_new or n
+        self.kv_shape = self.kv_shape[:2] + (n + num_new,) + self.kv_shape[3:]
+        if self.kv_pages is not None:
+            kv_pages = torch.zeros(self.kv_shape, dtype=self.kv_pages.dtype, device=self.kv_pages.device)
+            kv_pages[:, :, :n].copy_(self.kv_pages)
+            self.kv_pages = kv_pages
+        self.free_blocks = list(range(n + num_new - 1, n - 1, -1)) + self.free_blocks
+        self.ref_counts.extend([0] * num_new)
+
+    def _prepare(self, T_add, device):
+        # Make room for T_add new tokens in every row of the batch, then work out the
+        # slots to write to and to read from. The same for all layers, so done once per forward.
+        bs = self.block_size
+        write_slots = []
+        for seq_id in self.batch:
+            table, t0 = self.block_tables[seq_id], self.lengths[seq_id]
+            # copy on write: the partially filled last block may be shared with another sequence
+            if t0 % bs != 0 and self.ref_counts[table[-1]] > 1:
+                block = self._allocate()
+                self.kv_pages[:, :, block] = self.kv_pages[:, :, table[-1]]
+                self._release(table[-1])
+                table[-1] = block
+            while len(table) * bs < t0 + T_add:
+                table.append(self._allocate())
+            write_slots.append([table[t // bs] * bs + t % bs for t in range(t0, t0 + T_add)])
+        lengths = [self.lengths[s] for s in self.batch]
+        t1 = max(lengths) + T_add
+        num_blocks = self.blocks_needed(t1)
+        tables = [self.block_tables[s] + [0] * (num_blocks - len(self.block_tables[s])) for s in self.batch]
+        tables = torch.tensor(tables, dtype=torch.long, device=device) # (B, num_blocks)
+        read_slots = tables[:, :, None] * bs + torch.arange(bs, device=device) # (B, num_blocks, bs)
+        self.read_slots = read_slots.view(len(self.batch), -1)[:, :t1]
+        self.write_slots = torch.tensor(write_slots, dtype=torch.long, device=device)
+        if all(t0 == lengths[0] for t0 in lengths):
+            self.attn_mask = None # no padding when all rows are at the same position, the model's own masking does
+        else:
+            # each query sees its own row up to and including itself, the padding stays masked out
+            positions = torch.tensor(lengths, dtype=torch.long, device=device)[:, None] + torch.arange(T_add, device=device)
+            key_pos = torch.arange(t1, device=device)
+            self.attn_mask = (key_pos[None, None, :] <= positions[:, :, None]).unsqueeze(1) # (B, 1, T, t1)
+
+    def insert_kv(self, layer_idx, k, v):
+        # Lazy initialize the pages here because we need to know the dtype/device
+        if self.kv_pages is None:
+            # zeros, not empty: masked out slots are still multiplied by 0 in attention, and garbage could be NaN
+            self.kv_pages = torch.zeros(self.kv_shape, dtype=k.dtype, device=k.device)
+            self.device = k.device
+        B, H, T_add, D = k.size()
+        assert B == len(self.batch), f"Batch size mismatch: {B} != {len(self.batch)}"
+        if layer_idx == 0:
+            self._prepare(T_add, k.device)
+        # Pages of this layer as flat (num_blocks * block_size, H, D) slot arrays
+        key_slots = self.kv_pages[layer_idx, 0].flatten(0, 1)
+        value_slots = self.kv_pages[layer_idx, 1].flatten(0, 1)
+        key_slots[self.write_slots] = k.transpose(1, 2)
+        value_slots[self.write_slots] = v.transpose(1, 2)
+        # Gather each row's history from its pages, as (B, H, t1, D)
+        keys = key_slots[self.read_slots].transpose(1, 2)
+        values = value_slots[self.read_slots].transpose(1, 2)
+        # Advance all rows after the last layer of the Transformer processes
+        if layer_idx == self.kv_pages.size(0) - 1:
+            for seq_id in self.batch:
+                self.lengths[seq_id] += T_add
+        return keys, values
+
+
+class PrefixNode:
+    # A node of the PrefixCache radix tree, holding one full cache block of the prefix
+    __slots__ = ("key", "block", "parent", "children", "last_used")
+
+    def __init__(self, key, block, parent):
+        self.key = key # the block_size token ids of this block
+        self.block = block
+        self.parent = parent
+        self.children = {}
+        self.last_used = 0
+
+
+class PrefixCache:
+    """
+    Radix tree over token ids that keeps the KV cache blocks of prefixes that were already
+    prefilled, e.g. the history of a multi-turn chat or a shared system prompt. Every edge
+    is one full block of a PagedKVCache (block_size tokens), so a matched prefix can be used
+    by a new sequence as is, and only the rest of the prompt needs a prefill.
+    The tree holds a reference to its blocks. It is kept to max_tokens with LRU eviction of
+    the leaves, and the cache evicts from it too when it runs out of free blocks.
+    """
+
+    def __init__(self, kv_cache, max_tokens):
+        self.kv_cache = kv_cache
+        kv_cache.prefix_cache = self # so that the allocator can reclaim our blocks
+        self.block_size = kv_cache.block_size
+        self.max_blocks = max_tokens // self.block_size
+        self.root = PrefixNode(None, None, None)
+        self.num_blocks = 0 # number of blocks (nodes) in the tree
+        self.clock = 0 # logical time for the LRU order
+
+    def _touch(self, node):
+        self.clock += 1
+        node.last_used = self.clock
+
+    def match(self, tokens):
+        """Blocks of the longest cached prefix of tokens, leaving at least one token to prefill."""
+        bs, node, blocks = self.block_size, self.root, []
+        for i in range((len(tokens) - 1) // bs):
+            node = node.children.get(tuple(tokens[i * bs:(i + 1) * bs]))
+            if node is None:
+                break
+            self._touch(node)
+            blocks.append(node.block)
+        return blocks
+
+    def insert(self, tokens, block_table):
+        """Remember the full blocks of a sequence (tokens, cached in the blocks of block_table)."""
+        bs, node = self.block_size, self.root
+        for i in range(min(len(tokens) // bs, len(block_table))):
+            key = tuple(tokens[i * bs:(i + 1) * bs])
+            child = node.children.get(key)
+            if child is None:
+                # the first sequence to cache a prefix wins, later copies of it are not kept
+                child = PrefixNode(key, block_table[i], node)
+                node.children[key] = child
+                self.kv_cache.ref_counts[child.block] += 1
+                self.num_blocks += 1
+            self._touch(child)
+            node = child
+        self.evict(lambda: self.num_blocks <= self.max_blocks)
+
+    def evict(self, done):
+        """Drop the least recently used leaves until done() is true or the tree is empty."""
+        if done():
+            return
+        leaves, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self.root:
+                leaves.append((node.last_used, id(node), node))
+        heapq.heapify(leaves)
+        while leaves and not done():
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.key]
+            self.kv_cache._release(node.block)
+            self.num_blocks -= 1
+            if not parent.children and parent is not self.root:
+                heapq.heappush(leaves, (parent.last_used, id(parent), parent))
+
+    def clear(self):
+        self.evict(lambda: False)
+
+
 # -----------------------------------------------------------------------------
+# Sampling. Every row of a batch has its own temperature, top_k, top_p and random stream, so
+# that the samples of one prompt, or unrelated requests, can share a batch. The randomness is
+# counter based (Gumbel-max with hashed noise): the noise of a row only depends on its seed
+# and on how many tokens it sampled so far, so there is no generator state to carry around,
+# and a row samples the same tokens no matter which batch it ends up in.
+
+def _int64(x):
+    # wrap a python int to a signed 64-bit value
+    x &= (1 << 64) - 1
+    return x - (1 << 64) if x >= (1 << 63) else x
+
+_GOLDEN = _int64(0x9E3779B97F4A7C15)
+_MIX1 = _int64(0xBF58476D1CE4E5B9)
+_MIX2 = _int64(0x94D049BB133111EB)
+
+def _mix64(x):
+    # splitmix64 finalizer on int64 tensors: multiplies wrap around, shifts are made logical
+    x = x ^ ((x >> 30) & ((1 << 34) - 1))
+    x = x * _MIX1
+    x = x ^ ((x >> 27) & ((1 << 37) - 1))
+    x = x * _MIX2
+    return x ^ ((x >> 31) & ((1 << 33) - 1))
+
+def row_seed(seed, index=0):
+    """Seed of the random stream of the index-th sample of a request with the given seed."""
+    return _int64(seed + index * _GOLDEN)
+
+def sampling_params(temperature, top_k, top_p, seeds, device):
+    """
+    Lists of per-row sampling settings as what sample_tokens takes (top_k/top_p entries may be None).
+    Settings that no row uses become None, so sample_tokens can skip them without reading the device.
+    top_k stays a list, as its max is the number of candidates to keep.
+    """
+    top_k = [k or 0 for k in top_k]
+    top_p = [1.0 if p is None else p for p in top_p]
+    return (
+        torch.tensor(temperature, dtype=torch.float32, device=device) if any(t > 0 for t in temperature) else None,
+        top_k if any(top_k) else None,
+        torch.tensor(top_p, dtype=torch.float32, device=device) if any(p < 1.0 for p in top_p) else None,
+        torch.tensor(seeds, dtype=torch.long, device=device),
+    )
+
 @torch.inference_mode()
-def sample_next_token(logits, rng, temperature=1.0, top_k=None):
-    """Sample a single next token from given logits of shape (B, vocab_size). Returns (B, 1)."""
-    assert temperature >= 0.0, "temperature must be non-negative"
-    if temperature == 0.0:
-        return torch.argmax(logits, dim=-1, keepdim=True)
-    if top_k is not None:
-        k = min(top_k, logits.size(-1))
-        vals, idx = torch.topk(logits, k, dim=-1)
-        vals = vals / temperature
-        probs = F.softmax(vals, dim=-1)
-        choice = torch.multinomial(probs, num_samples=1, generator=rng)
-        return idx.gather(1, choice)
+def sample_tokens(logits, temperature, top_k, top_p, seeds, offsets):
+    """
+    Sample one token for every row of logits (B, vocab_size), returns (B,).
+    temperature (B,) (0 is greedy), top_k list (0 is off), top_p (B,) (1 is off) and seeds (see row_seed)
+    are what sampling_params returns, None being off for every row. offsets (B,) is the number of tokens
+    each row has sampled before.
+    """
+    B, V = logits.shape
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+    if temperature is None:
+        return greedy
+    scaled = logits / temperature.clamp(min=1e-5)[:, None]
+    # Gumbel-max: argmax of logits + Gumbel noise is a sample from softmax(logits)
+    ranks = torch.arange(V, device=logits.device)
+    keys = _mix64(seeds * _GOLDEN + offsets) # one key per row and step
+    bits = _mix64(keys[:, None] + ranks[None, :] * _GOLDEN) # noise per token id, independent of any sort
+    uniform = (((bits >> 40) & ((1 << 24) - 1)).float() + 0.5) / (1 << 24)
+    gumbel = -torch.log(-torch.log(uniform))
+    if top_k is None and top_p is None:
+        sampled = (scaled + gumbel).argmax(dim=-1)
     else:
-        logits = logits / temperature
-        probs = F.softmax(logits, dim=-1)
-        return torch.multinomial(probs, num_samples=1, generator=rng)
+        # top-k and top-p (nucleus) filtering over the candidates, in sorted order. top-p needs them all.
+        num_candidates = V if top_p is not None or 0 in top_k else min(max(top_k), V)
+        if num_candidates < V:
+            candidates, candidate_idx = scaled.topk(num_candidates, dim=-1)
+        else:
+            candidates, candidate_idx = scaled.sort(dim=-1, descending=True)
+        keep = torch.ones_like(candidates, dtype=torch.bool)
+        if top_k is not None:
+            k = torch.tensor([k if k > 0 else V for k in top_k], dtype=torch.long, device=logits.device)
+            keep &= ranks[None, :num_candidates] < k[:, None]
+        if top_p is not None:
+            probs = F.softmax(candidates.masked_fill(~keep, -float("inf")), dim=-1)
+            keep &= (probs.cumsum(dim=-1) - probs) < top_p[:, None] # the most likely token always stays
+        noisy = (candidates + gumbel.gather(1, candidate_idx)).masked_fill(~keep, -float("inf"))
+        sampled = candidate_idx.gather(1, noisy.argmax(dim=-1, keepdim=True))[:, 0]
+    return torch.where(temperature > 0, sampled, greedy)
 
 # -----------------------------------------------------------------------------
 
@@ -184,117 +551,265 @@ class RowState:
         self.python_expr_tokens = [] # Tokens of the current python expression
         self.completed = False # Whether this row has completed generation
 
+class BatchedRowState:
+    """
+    RowState for a whole batch at once, as tensors on the device, so that decoding doesn't
+    need the host for every token. The tool itself is evaluated by the host: a row that
+    closes a python block stalls (its tokens are junk from then on) until resume() rolls it
+    back and queues the tool output as forced tokens.
+    """
+
+    def __init__(self, special_tokens, row_max_tokens, device):
+        B = len(row_max_tokens)
+        zeros = lambda dtype: torch.zeros(B, dtype=dtype, device=device)
+        self.special = special_tokens
+        self.device = device
+        self.num_generated = zeros(torch.long) # also the offset of each row's random stream
+        self.row_max = torch.tensor([m if m is not None else 2**62 for m in row_max_tokens], dtype=torch.long, device=device)
+        self.last_token = zeros(torch.long) # the token each row feeds into the next forward pass
+        self.completed = self.row_max <= 0 # a row with no tokens to generate is done before it starts
+        self.completed_at = torch.full((B,), -1, dtype=torch.long, device=device) # token index that completed the row
+        self.stalled = zeros(torch.bool) # closed a python block, waiting for the host to evaluate it
+        self.fired_at = torch.full((B,), -1, dtype=torch.long, device=device) # token index of that python_end
+        self.in_python = zeros(torch.bool)
+        self.expr_len = zeros(torch.long) # number of tokens in the current python block
+        self.forced = torch.zeros((B, 1), dtype=torch.long, device=device) # queue of tokens to force into each row
+        self.forced_len = zeros(torch.long)
+        self.forced_pos = zeros(torch.long)
+
+    def step(self, sampled):
+        """Choose the next token of every row (forced or sampled) and update the state. Returns (tokens, masks)."""
+        special = self.special
+        is_forced = self.forced_pos < self.forced_len
+        queued = self.forced.gather(1, self.forced_pos.clamp(max=self.forced.size(1) - 1)[:, None])[:, 0]
+        next_token = torch.where(is_forced, queued, sampled)
+        self.forced_pos += is_forced
+        # On <|assistant_end|> or <|bos|>, or at its max_tokens, the row is completed
+        active = ~self.completed & ~self.stalled
+        is_end_token = (next_token == special["assistant_end"]) | (next_token == special["bos"])
+        done = active & (is_end_token | (self.num_generated + 1 >= self.row_max))
+        self.completed_at = torch.where(done, self.num_generated, self.completed_at)
+        self.completed |= done
+        active &= ~done
+        # Tool logic: closing a python block with an expression in it calls the tool
+        is_start = next_token == special["python_start"]
+        is_end = next_token == special["python_end"]
+        fired = active & is_end & self.in_python & (self.expr_len > 0)
+        self.fired_at = torch.where(fired, self.num_generated, self.fired_at)
+        self.stalled |= fired
+        expr_len = torch.where(is_start | is_end, 0, self.expr_len + self.in_python.long())
+        self.expr_len = torch.where(active, expr_len, self.expr_len)
+        self.in_python = torch.where(active & (is_start | is_end), is_start, self.in_python)
+        self.num_generated += 1
+        self.last_token = next_token
+        return next_token, ~is_forced
+
+    def resume(self, i, num_tokens, forced_tokens):
+        """Roll row i back to its first num_tokens tokens (the last one closing a tool call), and force the tool output."""
+        self.num_generated[i] = num_tokens
+        self.last_token[i] = self.special["python_end"]
+        self.stalled[i] = False
+        self.fired_at[i] = -1
+        self.in_python[i] = False
+        self.expr_len[i] = 0
+        if len(forced_tokens) > self.forced.size(1):
+            self.forced = F.pad(self.forced, (0, len(forced_tokens) - self.forced.size(1)))
+        if forced_tokens:
+            self.forced[i, :len(forced_tokens)] = torch.tensor(forced_tokens, dtype=torch.long, device=self.device)
+        self.forced_len[i] = len(forced_tokens)
+        self.forced_pos[i] = 0
+
 class Engine:
 
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer, prefix_cache_tokens=0):
         self.model = model
         self.tokenizer = tokenizer # needed for tool use
+        self.special_tokens = None # lazily looked up, see _step_row
+        m = model.config
+        self.kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
+        # Optionally keep the KV cache of prompts (and generations) around, so that a prompt that
+        # extends an earlier one (the next turn of a chat) only prefills the new tokens.
+        # Only valid while the weights don't change, see clear_prefix_cache.
+        self.prefix_cache = None
+        if prefix_cache_tokens > 0:
+            num_blocks = -(-(prefix_cache_tokens + m.sequence_len) // KV_BLOCK_SIZE)
+            kv_cache = PagedKVCache(num_blocks, device=model.get_device(), **self.kv_model_kwargs)
+            self.prefix_cache = PrefixCache(kv_cache, prefix_cache_tokens)
+
+    def clear_prefix_cache(self):
+        """Forget all cached prefixes, e.g. after the model weights were updated."""
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+
+    def _get_special_tokens(self):
+        if self.special_tokens is None:
+            # Get the special tokens we need to coordinate the tool use state machine
+            get_special = lambda s: self.tokenizer.encode_special(s)
+            self.special_tokens = {
+                "python_start": get_special("<|python_start|>"),
+                "python_end": get_special("<|python_end|>"),
+                "output_start": get_special("<|output_start|>"),
+                "output_end": get_special("<|output_end|>"),
+                "assistant_end": get_special("<|assistant_end|>"), # if sampled, ends row
+                "bos": self.tokenizer.get_bos_token_id(), # if sampled, ends row
+            }
+        return self.special_tokens
+
+    def _tool_output(self, expr_tokens):
+        # Evaluate the expression of a python block, returns the tokens to force in (if any)
+        special = self._get_special_tokens()
+        result = use_calculator(self.tokenizer.decode(expr_tokens))
+        if result is None:
+            return []
+        return [special["output_start"]] + self.tokenizer.encode(str(result)) + [special["output_end"]]
+
+    def _step_row(self, state, sampled_token):
+        """
+        Choose the next token of a row (forced, if tool output is waiting, else the sampled one),
+        update the row state and run the tool use state machine. Returns (token, mask),
+        where mask is 1 if the token was sampled and 0 if it was forced.
+        """
+        special = self._get_special_tokens()
+        # Select the next token in this row
+        is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
+        next_token = state.forced_tokens.popleft() if is_forced else sampled_token
+        # Update the state of this row to include the next token
+        state.current_tokens.append(next_token)
+        # On <|assistant_end|> or <|bos|>, mark the row as completed
+        if next_token == special["assistant_end"] or next_token == special["bos"]:
+            state.completed = True
+        # Handle tool logic
+        if next_token == special["python_start"]:
+            state.in_python_block = True
+            state.python_expr_tokens = []
+        elif next_token == special["python_end"] and state.in_python_block:
+            state.in_python_block = False
+            if state.python_expr_tokens:
+                state.forced_tokens.extend(self._tool_output(state.python_expr_tokens))
+            state.python_expr_tokens = []
+        elif state.in_python_block:
+            state.python_expr_tokens.append(next_token)
+        return next_token, 0 if is_forced else 1
 
     @torch.inference_mode()
-    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42):
-        """Same as generate, but does single prefill and then clones the KV cache."""
+    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, top_p=None, seed=42, sync_every=8):
+        """
+        Same as generate, but does single prefill and then clones the KV cache (or, with the prefix cache,
+        shares its KV cache pages) between the samples.
+        max_tokens, temperature, top_k, top_p and seed can also be lists with a setting for each sample.
+        Every sample draws from its own random stream: row_seed(seed, i) for the i-th sample of a single
+        seed, and the seed itself with a list (so a sample is the same as a single sample with its seed).
+
+        The stop conditions and the tool use state machine run on the device as batched tensors,
+        so decoding doesn't wait for the host: the tokens are copied over (and yielded) every
+        sync_every steps. A row that calls a tool runs ahead on junk until the next sync, where
+        it is rolled back to the tool call and the tool output is forced in from there. The
+        results are the same for any sync_every.
+        """
         assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        assert sync_every >= 1
         device = self.model.get_device()
-        rng = torch.Generator(device=device)
-        rng.manual_seed(seed)
-
-        # Get the special tokens we need to coordinate the tool use state machine
-        get_special = lambda s: self.tokenizer.encode_special(s)
-        python_start = get_special("<|python_start|>")
-        python_end = get_special("<|python_end|>")
-        output_start = get_special("<|output_start|>")
-        output_end = get_special("<|output_end|>")
-        assistant_end = get_special("<|assistant_end|>") # if sampled, ends row
-        bos = self.tokenizer.get_bos_token_id() # if sampled, ends row
-
-        # 1) Run a batch 1 prefill of the prompt tokens
+        per_row = lambda x: list(x) if isinstance(x, (list, tuple)) else [x] * num_samples
+        row_max_tokens, temperature, top_k, top_p = (per_row(x) for x in (max_tokens, temperature, top_k, top_p))
+        seeds = [row_seed(s) for s in seed] if isinstance(seed, (list, tuple)) else [row_seed(seed, i) for i in range(num_samples)]
+        assert all(len(x) == num_samples for x in (row_max_tokens, temperature, top_k, top_p, seeds)), "expecting one setting per sample"
+        assert all(t >= 0.0 for t in temperature), "temperature must be non-negative"
+        max_tokens = None if None in row_max_tokens else max(row_max_tokens)
+        if max_tokens is not None and max_tokens <= 0:
+            return
+        sampling = sampling_params(temperature, top_k, top_p, seeds, device)
+        special = self._get_special_tokens()
+
+        # 1) Run a batch 1 prefill of the prompt tokens, minus the prefix we may have cached already
         m = self.model.config
-        kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
-        kv_cache_prefill = KVCache(
-            batch_size=1,
-            seq_len=len(tokens),
-            **kv_model_kwargs,
-        )
-        ids = torch.tensor([tokens], dtype=torch.long, device=device)
-        logits = self.model.forward(ids, kv_cache=kv_cache_prefill)
-        logits = logits[:, -1, :]
-        next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-        sampled_tokens = next_ids[:, 0].tolist()
-
-        # 2) Replicate the KV cache for each sample/row
-        kv_length_hint = (len(tokens) + max_tokens) if max_tokens is not None else self.model.config.sequence_len
-        kv_cache_decode = KVCache(
-            batch_size=num_samples,
-            seq_len=kv_length_hint,
-            **kv_model_kwargs,
-        )
-        kv_cache_decode.prefill(kv_cache_prefill)
-        del kv_cache_prefill # no need to keep this memory around
+        gen_length_hint = (max_tokens if max_tokens is not None else max(m.sequence_len - len(tokens), 0)) + sync_every
+        generated = [[] for _ in range(num_samples)] # (token, mask) pairs of each row, as seen by the host
+        row_seqs = [] # the sequence of each row in the paged cache, with the prefix cache
+        try:
+            if self.prefix_cache is None:
+                kv_cache_prefill = KVCache(batch_size=1, seq_len=len(tokens), **self.kv_model_kwargs)
+                ids = torch.tensor([tokens], dtype=torch.long, device=device)
+                logits = self.model.forward(ids, kv_cache=kv_cache_prefill)
+                # 2) Replicate the KV cache for each sample/row. A contiguous cache keeps decoding as cheap
+                # as it gets: the rows only get out of step (and need a mask) once a tool call rolls one back
+                kv_cache = KVCache(batch_size=num_samples, seq_len=len(tokens) + gen_length_hint, **self.kv_model_kwargs)
+                kv_cache.prefill(kv_cache_prefill)
+                del kv_cache_prefill # no need to keep this memory around
+                row_ids = list(range(num_samples))
+            else:
+                blocks = lambda n: -(-n // KV_BLOCK_SIZE)
+                num_blocks = blocks(len(tokens)) + num_samples * (blocks(gen_length_hint) + 1) # the pool grows if we go past this
+                kv_cache = self.prefix_cache.kv_cache # lives across calls, together with the cached prefixes
+                kv_cache.reserve(num_blocks + self.prefix_cache.max_blocks)
+                row_seqs.append(kv_cache.new_sequence(self.prefix_cache.match(tokens)))
+                kv_cache.set_batch(row_seqs)
+                num_cached = kv_cache.lengths[row_seqs[0]]
+                ids = torch.tensor([tokens[num_cached:]], dtype=torch.long, device=device)
+                logits = self.model.forward(ids, kv_cache=kv_cache)
+                self.prefix_cache.insert(tokens, kv_cache.block_tables[row_seqs[0]])
+                # 2) One cache sequence per sample/row: the prompt pages are shared, not copied
+                row_seqs += [kv_cache.fork(row_seqs[0]) for _ in range(num_samples - 1)]
+                kv_cache.set_batch(row_seqs)
+                row_ids = row_seqs
+            logits = logits[:, -1, :].expand(num_samples, -1) # every row samples its own first token
 
-        # 3) Initialize states for each sample
-        row_states = [RowState(tokens.copy()) for _ in range(num_samples)]
+            # 3) Initialize the (batched, on device) state of the rows
+            state = BatchedRowState(special, row_max_tokens, device)
+            # token index that completed each row, once the host knows (-1: a row with nothing to generate)
+            done_at = [-1 if m is not None and m <= 0 else None for m in row_max_tokens]
 
-        # 4) Main generation loop
-        num_generated = 0
-        first_iteration = True
-        while True:
-            # Stop condition: we've reached max tokens
-            if max_tokens is not None and num_generated >= max_tokens:
-                break
-            # Stop condition: all rows are completed
-            if all(state.completed for state in row_states):
-                break
+            # 4) Main generation loop
+            num_yielded = 0
+            first_iteration = True
+            while True:
+                chunk_tokens, chunk_masks = [], []
+                for _ in range(sync_every):
+                    if not first_iteration:
+                        # Forward the model and get the next token for each row
+                        logits = self.model.forward(ids, kv_cache=kv_cache)  # (B, T, vocab_size)
+                        logits = logits[:, -1, :]  # (B, vocab_size) at last time step
+                    first_iteration = False
+                    sampled = sample_tokens(logits, *sampling, state.num_generated)
+                    # Choose the next token of each row, update the states: no host sync in here
+                    next_token, mask = state.step(sampled)
+                    chunk_tokens.append(next_token)
+                    chunk_masks.append(mask)
+                    ids = state.last_token[:, None]
 
-            # Get sampled tokens - either from prefill or from forward pass
-            if first_iteration:
-                # Use the tokens we already sampled from prefill
-                sampled_tokens = [sampled_tokens[0]] * num_samples  # Broadcast first token to all rows
-                # TODO: we should sample a token for each row instead of broadcasting
-                first_iteration = False
-            else:
-                # Forward the model and get the next token for each row
-                logits = self.model.forward(ids, kv_cache=kv_cache_decode)  # (B, T, vocab_size)
-                logits = logits[:, -1, :]  # (B, vocab_size) at last time step
-                next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-                sampled_tokens = next_ids[:, 0].tolist()
-
-            # Process each row: choose the next token, update state, optional tool use
-            token_column = [] # contains the next token id along each row
-            token_masks = [] # contains the mask (was it sampled (1) or forced (0)?) along each row
-            for i, state in enumerate(row_states):
-                # Select the next token in this row
-                is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
-                token_masks.append(0 if is_forced else 1) # mask is 0 if forced, 1 if sampled
-                next_token = state.forced_tokens.popleft() if is_forced else sampled_tokens[i]
-                token_column.append(next_token)
-                # Update the state of this row to include the next token
-                state.current_tokens.append(next_token)
-                # On <|assistant_end|> or <|bos|>, mark the row as completed
-                if next_token == assistant_end or next_token == bos:
-                    state.completed = True
-                # Handle tool logic
-                if next_token == python_start:
-                    state.in_python_block = True
-                    state.python_expr_tokens = []
-                elif next_token == python_end and state.in_python_block:
-                    state.in_python_block = False
-                    if state.python_expr_tokens:
-                        expr = self.tokenizer.decode(state.python_expr_tokens)
-                        result = use_calculator(expr)
-                        if result is not None:
-                            result_tokens = self.tokenizer.encode(str(result))
-                            state.forced_tokens.append(output_start)
-                            state.forced_tokens.extend(result_tokens)
-                            state.forced_tokens.append(output_end)
-                    state.python_expr_tokens = []
-                elif state.in_python_block:
-                    state.python_expr_tokens.append(next_token)
-
-            # Yield the token column
-            yield token_column, token_masks
-            num_generated += 1
-            # Prepare ids for next iteration
-            ids = torch.tensor(token_column, dtype=torch.long, device=device).unsqueeze(1)
+                # Sync: a single device to host copy for the whole chunk
+                n = len(chunk_tokens)
+                synced = torch.cat([torch.stack(chunk_tokens), torch.stack(chunk_masks).long(), state.completed_at[None], state.fired_at[None]]).tolist()
+                chunk_tokens, chunk_masks, completed_at, fired_at = synced[:n], synced[n:2*n], synced[2*n], synced[2*n+1]
+                for i in range(num_samples):
+                    t0 = len(generated[i])
+                    # a stalled row only keeps its tokens up to the tool call, the rest was junk
+                    num_valid = n if fired_at[i] < 0 else fired_at[i] - t0 + 1
+                    generated[i].extend((chunk_tokens[j][i], chunk_masks[j][i]) for j in range(num_valid))
+                    if completed_at[i] >= 0:
+                        done_at[i] = completed_at[i]
+                    if fired_at[i] >= 0:
+                        # Tool call: evaluate it, then roll the row back to just after its python_end
+                        row_tokens = [t for t, _ in generated[i]]
+                        start = len(row_tokens) - 1 - row_tokens[::-1].index(special["python_start"])
+                        forced_tokens = self._tool_output(row_tokens[start + 1:-1])
+                        kv_cache.truncate(row_ids[i], len(tokens) + len(row_tokens) - 1) # python_end is not fed yet
+                        state.resume(i, len(row_tokens), forced_tokens)
+                ids = state.last_token[:, None]
+
+                # Yield the token columns that are complete, i.e. every row got that far
+                num_ready = min(len(g) for g in generated)
+                for k in range(num_yielded, num_ready):
+                    yield [g[k][0] for g in generated], [g[k][1] for g in generated]
+                    # Stop condition: all rows are completed (this includes max_tokens)
+                    if all(d is not None and d <= k for d in done_at):
+                        return
+                num_yielded = num_ready
+        finally:
+            # Also runs when the caller stops early. Keep what we generated for the next turn of a chat.
+            for seq_id, row_tokens in zip(row_seqs, generated):
+                cached_tokens = (tokens + [t for t, _ in row_tokens])[:kv_cache.lengths[seq_id]]
+                self.prefix_cache.insert(cached_tokens, kv_cache.block_tables[seq_id])
+                kv_cache.free_sequence(seq_id)
 
     def generate_batch(self, tokens, num_samples=1, **kwargs):
         """
@@ -306,8 +821,10 @@ class Engine:
         bos = self.tokenizer.get_bos_token_id()
         results = [tokens.copy() for _ in range(num_samples)]
         masks = [[0] * len(tokens) for _ in range(num_samples)]
-        completed = [False] * num_samples
-        for token_column, token_masks in self.generate(tokens, num_samples, **kwargs):
+        max_tokens = kwargs.get("max_tokens")
+        row_max_tokens = list(max_tokens) if isinstance(max_tokens, (list, tuple)) else [max_tokens] * num_samples
+        completed = [m is not None and m <= 0 for m in row_max_tokens]
+        for step, (token_column, token_masks) in enumerate(self.generate(tokens, num_samples, **kwargs)):
             for i, (token, mask) in enumerate(zip(token_column, token_masks)):
                 if not completed[i]:
                     if token == assistant_end or token == bos:
@@ -315,11 +832,257 @@ class Engine:
                     else:
                         results[i].append(token)
                         masks[i].append(mask)
+                        if row_max_tokens[i] is not None and step + 1 >= row_max_tokens[i]:
+                            completed[i] = True # rows may have their own max_tokens
             # Stop if all rows are completed
             if all(completed):
                 break
         return results, masks
 
+# -----------------------------------------------------------------------------
+# Continuous batching
+
+class GenerationRequest:
+    """
+    A single prompt submitted to a BatchScheduler. The generated (token, mask) pairs are
+    passed to on_token as they come (followed by None once the request is finished), or,
+    without a callback, they can be consumed by iterating over the request. Like with
+    Engine.generate, the terminal token (<|assistant_end|> or <|bos|>) is included.
+    """
+
+    def __init__(self, tokens, max_tokens=None, temperature=1.0, top_k=None, top_p=None, seed=42, on_token=None):
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        assert temperature >= 0.0, "temperature must be non-negative"
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.seed = seed
+        self.on_token = on_token
+        self.queue = queue.Queue() if on_token is None else None
+        self.cancelled = False
+        self.finished = False
+        self.error = None
+
+    def cancel(self):
+        """Stop generating, the row of this request is freed at the next scheduler step."""
+        self.cancelled = True
+
+    def _emit(self, item):
+        if self.on_token is not None:
+            self.on_token(item)
+        else:
+            self.queue.put(item)
+
+    def _finish(self, error=None):
+        self.finished = True
+        self.error = error
+        self._emit(None)
+
+    def __iter__(self):
+        assert self.queue is not None, "a request with an on_token callback can't be iterated"
+        while (item := self.queue.get()) is not None:
+            yield item
+        if self.error is not None:
+            raise self.error
+
+
+class ScheduledRow:
+    # Per-row state of a request that is in the running batch of a BatchScheduler
+    def __init__(self, request, max_tokens, seq_id, num_reserved_blocks):
+        self.request = request
+        self.max_tokens = max_tokens # generation budget, also capped by max_seq_len
+        self.seq_id = seq_id # sequence of this row in the paged kv cache
+        self.num_reserved_blocks = num_reserved_blocks # cache blocks this row may grow into
+        self.state = RowState(request.tokens.copy())
+        self.seed = row_seed(request.seed) # same random stream as Engine.generate(num_samples=1)
+        self.num_generated = 0
+
+
+class BatchScheduler:
+    """
+    Continuous (iteration-level) batching on top of an Engine: instead of serving one request
+    at a time, every step() admits waiting requests into the running batch (a batch 1 prefill
+    each, straight into the pages of a shared PagedKVCache), decodes one token for all active
+    rows in a single forward pass, and evicts the rows that finished. Aggregate tokens/s then
+    scales with the number of concurrent users. Requests can be submitted from any thread,
+    and start() runs the step loop in a background thread.
+
+    Cache memory is a fixed pool of num_blocks pages (by default enough for max_batch_size
+    sequences of max_seq_len tokens). A request is admitted once the pool can hold its
+    prompt plus max_tokens, so short requests leave room for more concurrent ones, and a
+    running row never runs out of pages. Pages that no row uses keep the prefixes of past
+    requests (up to prefix_cache_tokens, by default all of them, 0 turns this off), so e.g.
+    the next turn of a chat only prefills the new messages.
+    """
+
+    def __init__(self, engine, max_batch_size=32, max_seq_len=None, num_blocks=None, prefix_cache_tokens=None, autocast_ctx=None):
+        self.engine = engine
+        self.model = engine.model
+        m = self.model.config
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len or m.sequence_len
+        num_blocks = num_blocks or max_batch_size * -(-self.max_seq_len // KV_BLOCK_SIZE)
+        self.kv_cache = PagedKVCache(num_blocks, device=self.model.get_device(), **engine.kv_model_kwargs)
+        assert num_blocks >= self.kv_cache.blocks_needed(self.max_seq_len), "num_blocks can't hold a single sequence"
+        if prefix_cache_tokens is None:
+            prefix_cache_tokens = num_blocks * KV_BLOCK_SIZE
+        self.prefix_cache = PrefixCache(self.kv_cache, prefix_cache_tokens) if prefix_cache_tokens > 0 else None
+        self.num_reserved_blocks = 0 # sum of the reservations of the running rows
+        self.autocast_ctx = autocast_ctx if autocast_ctx is not None else nullcontext() # autocast is per thread
+        self.rows = [] # the running batch, in the order of the rows of a forward pass
+        self.waiting = deque() # submitted requests that are not admitted yet
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    @property
+    def num_active(self):
+        return len(self.rows)
+
+    @property
+    def num_waiting(self):
+        return len(self.waiting)
+
+    def submit(self, tokens, **kwargs):
+        """Queue a prompt for generation, returns its GenerationRequest. Thread-safe."""
+        assert len(tokens) < self.max_seq_len, f"Prompt too long: {len(tokens)} >= {self.max_seq_len}"
+        request = GenerationRequest(tokens, **kwargs)
+        with self.cond:
+            self.waiting.append(request)
+            self.cond.notify()
+        return request
+
+    def start(self):
+        assert self.thread is None, "BatchScheduler is already running"
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.rows and not self.waiting:
+                    self.cond.wait()
+                if not self.running:
+                    break
+            try:
+                with self.autocast_ctx:
+                    self.step()
+            except Exception as e:
+                # a decode step failed: fail the running batch instead of killing the thread, later requests start fresh
+                for i in reversed(range(len(self.rows))):
+                    self._evict(i, error=e)
+
+    @torch.inference_mode()
+    def step(self):
+        """Admit waiting requests, decode one token for every active row, evict finished rows."""
+        # 1) Admission: prefill the new requests and sample their first token
+        while len(self.rows) < self.max_batch_size:
+            with self.cond:
+                if not self.waiting:
+                    break
+                request = self.waiting[0]
+                if request.cancelled:
+                    self.waiting.popleft()
+                    request._finish()
+                    continue
+                # first come first served: wait until the oldest request fits in the cache
+                max_tokens = self._max_tokens(request)
+                num_blocks = self.kv_cache.blocks_needed(len(request.tokens) + max_tokens)
+                if self.num_reserved_blocks + num_blocks > self.kv_cache.num_blocks:
+                    break
+                self.waiting.popleft()
+            self._admit(request, max_tokens, num_blocks)
+        self._evict_finished() # some rows may be done right after their first token
+        if not self.rows:
+            return
+        # 2) Decode: forward the last token of every row, each at its own position in the cache
+        device = self.model.get_device()
+        ids = torch.tensor([[row.state.current_tokens[-1]] for row in self.rows], dtype=torch.long, device=device)
+        self.kv_cache.set_batch([row.seq_id for row in self.rows])
+        logits = self.model.forward(ids, kv_cache=self.kv_cache)[:, -1, :] # (B, vocab_size)
+        for row, token in zip(self.rows, self._sample(logits, self.rows)):
+            self._advance(row, token)
+        # 3) Eviction: free the rows of finished or cancelled requests
+        self._evict_finished()
+
+    def _max_tokens(self, request):
+        max_tokens = self.max_seq_len - len(request.tokens)
+        if request.max_tokens is not None:
+            max_tokens = min(max_tokens, request.max_tokens)
+        return max_tokens
+
+    def _admit(self, request, max_tokens, num_blocks):
+        # the reservation covers the whole prompt even if part of it is cached, as the cached
+        # blocks may be shared with rows that finish (and are evicted from the prefix cache) first
+        # a failed admission fails its own request only (with the error), nothing is raised so that
+        # the running rows are left alone, also by _loop which fails all rows on a decode error
+        try:
+            prefix_blocks = self.prefix_cache.match(request.tokens) if self.prefix_cache is not None else []
+            seq_id = self.kv_cache.new_sequence(prefix_blocks)
+        except Exception as e:
+            request._finish(e)
+            return
+        row = ScheduledRow(request, max_tokens, seq_id, num_blocks)
+        self.rows.append(row)
+        self.num_reserved_blocks += num_blocks
+        try:
+            num_cached = self.kv_cache.lengths[seq_id]
+            ids = torch.tensor([request.tokens[num_cached:]], dtype=torch.long, device=self.model.get_device())
+            self.kv_cache.set_batch([seq_id])
+            logits = self.model.forward(ids, kv_cache=self.kv_cache)[:, -1, :]
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(request.tokens, self.kv_cache.block_tables[seq_id])
+            if max_tokens <= 0:
+                row.state.completed = True
+                return
+            self._advance(row, self._sample(logits, [row])[0])
+        except Exception as e:
+            self._evict(self.rows.index(row), error=e)
+
+    def _sample(self, logits, rows):
+        # Sample the next token of every row in one go, each with the settings of its own request
+        requests = [row.request for row in rows]
+        sampling = sampling_params(
+            [r.temperature for r in requests], [r.top_k for r in requests], [r.top_p for r in requests],
+            [row.seed for row in rows], logits.device,
+        )
+        offsets = torch.tensor([row.num_generated for row in rows], dtype=torch.long, device=logits.device)
+        return sample_tokens(logits, *sampling, offsets).tolist()
+
+    def _advance(self, row, sampled_token):
+        token, mask = self.engine._step_row(row.state, sampled_token)
+        row.num_generated += 1
+        if row.num_generated >= row.max_tokens:
+            row.state.completed = True
+        row.request._emit((token, mask))
+
+    def _evict_finished(self):
+        for i in reversed(range(len(self.rows))):
+            row = self.rows[i]
+            if row.state.completed or row.request.cancelled:
+                self._evict(i)
+
+    def _evict(self, i, error=None):
+        row = self.rows.pop(i)
+        if self.prefix_cache is not None and error is None:
+            # keep the generated tokens too, the next turn of the chat will start with them
+            cached_tokens = row.state.current_tokens[:self.kv_cache.lengths[row.seq_id]]
+            self.prefix_cache.insert(cached_tokens, self.kv_cache.block_tables[row.seq_id])
+        self.kv_cache.free_sequence(row.seq_id)
+        self.num_reserved_blocks -= row.num_reserved_blocks
+        row.request._finish(error)
+
 
 if __name__ == "__main__":
     """
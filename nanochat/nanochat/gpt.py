@@ -85,7 +85,12 @@ class CausalSelfAttention(nn.Module):
 
         # Attention: queries attend to keys/values autoregressively. A few cases to handle:
         enable_gqa = self.n_head != self.n_kv_head # Group Query Attention (GQA): duplicate key/value heads to match query heads if desired
-        if kv_cache is None or Tq == Tk:
+        attn_mask = kv_cache.get_attn_mask() if kv_cache is not None else None
+        if attn_mask is not None:
+            # Batched inference where the rows are at different positions (continuous batching, a rolled back row):
+            # the cache knows which keys each row's queries may see (its own history, causally)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, enable_gqa=enable_gqa)
+        elif kv_cache is None or Tq == Tk:
             # During training (no KV cache), attend as usual with causal attention
             # And even if there is KV cache, we can still use this simple version when Tq == Tk
             y = F.scaled_dot_product_attention(q, k, v, is_causal=True, enable_gqa=enable_gqa)
@@ -250,7 +255,12 @@ class GPT(nn.Module):
         assert self.cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
         # if kv cache exists, we need to offset the rotary embeddings to the current position in the cache
         T0 = 0 if kv_cache is None else kv_cache.get_pos()
-        cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
+        if isinstance(T0, torch.Tensor):
+            # per-row positions of shape (B,) (continuous batching), gather each row's rotary embeddings
+            positions = T0[:, None] + torch.arange(T, device=idx.device) # (B, T)
+            cos_sin = self.cos[0, positions], self.sin[0, positions] # (B, T, 1, head_dim/2)
+        else:
+            cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
 
         # Forward the trunk of the Transformer
         x = self.transformer.wte(idx)
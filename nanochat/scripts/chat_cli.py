@@ -35,8 +35,8 @@ bos = tokenizer.get_bos_token_id()
 user_start, user_end = tokenizer.encode_special("<|user_start|>"), tokenizer.encode_special("<|user_end|>")
 assistant_start, assistant_end = tokenizer.encode_special("<|assistant_start|>"), tokenizer.encode_special("<|assistant_end|>")
 
-# Create Engine for efficient generation
-engine = Engine(model, tokenizer)
+# Create Engine for efficient generation, it keeps the KV cache of the conversation between turns
+engine = Engine(model, tokenizer, prefix_cache_tokens=model.config.sequence_len)
 
 print("\nNanoChat Interactive Mode")
 print("-" * 50)
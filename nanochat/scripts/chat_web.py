@@ -3,7 +3,9 @@
 Unified web chat server - serves both UI and API from a single FastAPI instance.
 
 Uses data parallelism to distribute requests across multiple GPUs. Each GPU loads
-a full copy of the model, and incoming requests are distributed to available workers.
+a full copy of the model, and incoming requests are distributed to the least busy worker.
+Each worker serves many conversations at once with continuous batching (see BatchScheduler
+in nanochat/engine.py): new requests join the running decode batch at every step.
 
 Launch examples:
 
@@ -27,6 +29,7 @@ Abuse Prevention:
   - Maximum 32000 characters total conversation length
   - Temperature clamped to 0.0-2.0
   - Top-k clamped to 1-200
+  - Top-p clamped to (0.0, 1.0]
   - Max tokens clamped to 1-4096
 """
 
@@ -47,7 +50,7 @@ from dataclasses import dataclass
 from contextlib import nullcontext
 from nanochat.common import compute_init, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
-from nanochat.engine import Engine
+from nanochat.engine import Engine, BatchScheduler
 
 # Abuse prevention limits
 MAX_MESSAGES_PER_REQUEST = 500
@@ -57,6 +60,7 @@ MIN_TEMPERATURE = 0.0
 MAX_TEMPERATURE = 2.0
 MIN_TOP_K = 1
 MAX_TOP_K = 200
+MAX_TOP_P = 1.0
 MIN_MAX_TOKENS = 1
 MAX_MAX_TOKENS = 4096
 
@@ -71,6 +75,7 @@ parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
 parser.add_argument('-p', '--port', type=int, default=8000, help='Port to run the server on')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
+parser.add_argument('-b', '--max-batch-size', type=int, default=32, help='Max number of concurrent generations per GPU')
 parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind the server to')
 args = parser.parse_args()
 
@@ -92,6 +97,7 @@ class Worker:
     gpu_id: int
     device: torch.device
     engine: Engine
+    scheduler: BatchScheduler
     tokenizer: object
     autocast_ctx: torch.amp.autocast
 
@@ -106,7 +112,6 @@ class WorkerPool:
                 num_gpus = 1 # e.g. cpu|mps
         self.num_gpus = num_gpus
         self.workers: List[Worker] = []
-        self.available_workers: asyncio.Queue = asyncio.Queue()
 
     async def initialize(self, source: str, model_tag: Optional[str] = None, step: Optional[int] = None):
         """Load model on each GPU."""
@@ -126,26 +131,28 @@ class WorkerPool:
             model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step)
             engine = Engine(model, tokenizer)
             autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
+            scheduler = BatchScheduler(engine, max_batch_size=args.max_batch_size, autocast_ctx=autocast_ctx)
+            scheduler.start()
 
             worker = Worker(
                 gpu_id=gpu_id,
                 device=device,
                 engine=engine,
+                scheduler=scheduler,
                 tokenizer=tokenizer,
                 autocast_ctx=autocast_ctx
             )
             self.workers.append(worker)
-            await self.available_workers.put(worker)
 
         print(f"All {self.num_gpus} workers initialized!")
 
-    async def acquire_worker(self) -> Worker:
-        """Get an available worker from the pool."""
-        return await self.available_workers.get()
+    def pick_worker(self) -> Worker:
+        """Get the least busy worker. Workers batch requests, so they never have to be waited for."""
+        return min(self.workers, key=lambda w: w.scheduler.num_active + w.scheduler.num_waiting)
 
-    async def release_worker(self, worker: Worker):
-        """Return a worker to the pool."""
-        await self.available_workers.put(worker)
+    def shutdown(self):
+        for worker in self.workers:
+            worker.scheduler.stop()
 
 class ChatMessage(BaseModel):
     role: str
@@ -156,6 +163,7 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = None
     max_tokens: Optional[int] = None
     top_k: Optional[int] = None
+    top_p: Optional[float] = None
 
 def validate_chat_request(request: ChatRequest):
     """Validate chat request to prevent abuse."""
@@ -212,6 +220,14 @@ def validate_chat_request(request: ChatRequest):
                 detail=f"top_k must be between {MIN_TOP_K} and {MAX_TOP_K}"
             )
 
+    # Validate top_p
+    if request.top_p is not None:
+        if not (0.0 < request.top_p <= MAX_TOP_P):
+            raise HTTPException(
+                status_code=400,
+                detail=f"top_p must be greater than 0.0 and at most {MAX_TOP_P}"
+            )
+
     # Validate max_tokens
     if request.max_tokens is not None:
         if not (MIN_MAX_TOKENS <= request.max_tokens <= MAX_MAX_TOKENS):
@@ -228,6 +244,7 @@ async def lifespan(app: FastAPI):
     await app.state.worker_pool.initialize(args.source, model_tag=args.model_tag, step=args.step)
     print(f"Server ready at http://localhost:{args.port}")
     yield
+    app.state.worker_pool.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -264,7 +281,8 @@ async def generate_stream(
     tokens,
     temperature=None,
     max_new_tokens=None,
-    top_k=None
+    top_k=None,
+    top_p=None
 ) -> AsyncGenerator[str, None]:
     """Generate assistant response with streaming."""
     temperature = temperature if temperature is not None else args.temperature
@@ -279,16 +297,21 @@ async def generate_stream(
     # Track the last complete UTF-8 string (without replacement characters)
     last_clean_text = ""
 
-    with worker.autocast_ctx:
-        for token_column, token_masks in worker.engine.generate(
-            tokens,
-            num_samples=1,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-            seed=random.randint(0, 2**31 - 1)
-        ):
-            token = token_column[0]
+    # The worker's scheduler thread generates the tokens, hand them over to the event loop
+    loop = asyncio.get_running_loop()
+    token_queue = asyncio.Queue()
+    generation = worker.scheduler.submit(
+        tokens,
+        max_tokens=max_new_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        seed=random.randint(0, 2**31 - 1),
+        on_token=lambda item: loop.call_soon_threadsafe(token_queue.put_nowait, item),
+    )
+    try:
+        while (item := await token_queue.get()) is not None:
+            token, mask = item
 
             # Stopping criteria
             if token == assistant_end or token == bos:
@@ -307,6 +330,11 @@ async def generate_stream(
                 if new_text:  # Only yield if there's new content
                     yield f"data: {json.dumps({'token': new_text, 'gpu': worker.gpu_id}, ensure_ascii=False)}\n\n"
                     last_clean_text = current_text
+    finally:
+        # Free the batch row right away if we stopped early (e.g. the client disconnected)
+        generation.cancel()
+    if generation.error is not None:
+        raise generation.error
 
     yield f"data: {json.dumps({'done': True})}\n\n"
 
@@ -323,63 +351,62 @@ async def chat_completions(request: ChatRequest):
         logger.info(f"[{message.role.upper()}]: {message.content}")
     logger.info("-"*20)
 
-    # Acquire a worker from the pool (will wait if all are busy)
+    # Pick the least busy worker, it batches our request together with the ones it is already serving
     worker_pool = app.state.worker_pool
-    worker = await worker_pool.acquire_worker()
+    worker = worker_pool.pick_worker()
 
-    try:
-        # Build conversation tokens
-        bos = worker.tokenizer.get_bos_token_id()
-        user_start = worker.tokenizer.encode_special("<|user_start|>")
-        user_end = worker.tokenizer.encode_special("<|user_end|>")
-        assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
-        assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
-
-        conversation_tokens = [bos]
-        for message in request.messages:
-            if message.role == "user":
-                conversation_tokens.append(user_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(user_end)
-            elif message.role == "assistant":
-                conversation_tokens.append(assistant_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(assistant_end)
-
-        conversation_tokens.append(assistant_start)
-
-        # Streaming response with worker release after completion
-        response_tokens = []
-        async def stream_and_release():
-            try:
-                async for chunk in generate_stream(
-                    worker,
-                    conversation_tokens,
-                    temperature=request.temperature,
-                    max_new_tokens=request.max_tokens,
-                    top_k=request.top_k
-                ):
-                    # Accumulate response for logging
-                    chunk_data = json.loads(chunk.replace("data: ", "").strip())
-                    if "token" in chunk_data:
-                        response_tokens.append(chunk_data["token"])
-                    yield chunk
-            finally:
-                # Log the assistant response to console
-                full_response = "".join(response_tokens)
-                logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
-                logger.info("="*20)
-                # Release worker back to pool after streaming is done
-                await worker_pool.release_worker(worker)
-
-        return StreamingResponse(
-            stream_and_release(),
-            media_type="text/event-stream"
+    # Build conversation tokens
+    bos = worker.tokenizer.get_bos_token_id()
+    user_start = worker.tokenizer.encode_special("<|user_start|>")
+    user_end = worker.tokenizer.encode_special("<|user_end|>")
+    assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
+    assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
+
+    conversation_tokens = [bos]
+    for message in request.messages:
+        if message.role == "user":
+            conversation_tokens.append(user_start)
+            conversation_tokens.extend(worker.tokenizer.encode(message.content))
+            conversation_tokens.append(user_end)
+        elif message.role == "assistant":
+            conversation_tokens.append(assistant_start)
+            conversation_tokens.extend(worker.tokenizer.encode(message.content))
+            conversation_tokens.append(assistant_end)
+
+    conversation_tokens.append(assistant_start)
+    if len(conversation_tokens) >= worker.scheduler.max_seq_len:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Conversation is too long. Maximum {worker.scheduler.max_seq_len} tokens allowed"
         )
-    except Exception as e:
-        # Make sure to release worker even on error
-        await worker_pool.release_worker(worker)
-        raise e
+
+    # Streaming response with logging after completion
+    response_tokens = []
+    async def stream_and_log():
+        try:
+            async for chunk in generate_stream(
+                worker,
+                conversation_tokens,
+                temperature=request.temperature,
+                max_new_tokens=request.max_tokens,
+                top_k=request.top_k,
+                top_p=request.top_p
+            ):
+                # Accumulate response for logging
+                chunk_data = json.loads(chunk.replace("data: ", "").strip())
+                if "token" in chunk_data:
+                    response_tokens.append(chunk_data["token"])
+                yield chunk
+        finally:
+            # Log the assistant response to console
+            full_response = "".join(response_tokens)
+            logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
+            logger.info("="*20)
+
+    return StreamingResponse(
+        stream_and_log(),
+        media_type="text/event-stream"
+    )
 
 @app.get("/health")
 async def health():
@@ -389,7 +416,7 @@ async def health():
         "status": "ok",
         "ready": worker_pool is not None and len(worker_pool.workers) > 0,
         "num_gpus": worker_pool.num_gpus if worker_pool else 0,
-        "available_workers": worker_pool.available_workers.qsize() if worker_pool else 0
+        "active_generations": sum(w.scheduler.num_active for w in worker_pool.workers) if worker_pool else 0
     }
 
 @app.get("/stats")
@@ -398,12 +425,14 @@ async def stats():
     worker_pool = app.state.worker_pool
     return {
         "total_workers": len(worker_pool.workers),
-        "available_workers": worker_pool.available_workers.qsize(),
-        "busy_workers": len(worker_pool.workers) - worker_pool.available_workers.qsize(),
+        "busy_workers": sum(w.scheduler.num_active > 0 for w in worker_pool.workers),
         "workers": [
             {
                 "gpu_id": w.gpu_id,
-                "device": str(w.device)
+                "device": str(w.device),
+                "active_generations": w.scheduler.num_active,
+                "waiting_generations": w.scheduler.num_waiting,
+                "max_batch_size": w.scheduler.max_batch_size
             } for w in worker_pool.workers
         ]
     }
@@ -4,8 +4,10 @@ Test Engine class. Example run:
 python -m pytest tests/test_engine.py -v
 """
 
+import pytest
 import torch
-from nanochat.engine import KVCache
+from nanochat.engine import KVCache, PagedKVCache, PrefixCache, Engine, BatchScheduler, sample_tokens, sampling_params, row_seed
+from nanochat.gpt import GPT, GPTConfig
 
 def test_kv_cache_resize():
     """
@@ -64,3 +66,358 @@ def test_kv_cache_resize():
             original_v = original_cache[layer_idx, 1, :, :, token_idx, :]
             assert (actual_k == original_k).all(), f"Layer {layer_idx}, token {token_idx}: key doesn't match original"
             assert (actual_v == original_v).all(), f"Layer {layer_idx}, token {token_idx}: value doesn't match original"
+
+
+def test_kv_cache_truncate():
+    """Rows rolled back by truncate() write at their own positions and only see their own history."""
+    kv_cache = KVCache(batch_size=2, num_heads=1, seq_len=8, head_dim=1, num_layers=1)
+    def insert(values):
+        k = torch.tensor(values, dtype=torch.float32)[:, None, None, None]
+        keys, _ = kv_cache.insert_kv(0, k, -k)
+        return keys[:, 0, :, 0]
+    for i in range(4):
+        insert([i, 10 + i])
+    assert kv_cache.get_pos() == 4 and kv_cache.get_attn_mask() is None
+    kv_cache.truncate(1, 2)
+    assert kv_cache.get_pos().tolist() == [4, 2]
+    keys = insert([4, 20])
+    assert keys[0].tolist() == [0, 1, 2, 3, 4] and keys[1, :3].tolist() == [10, 11, 20]
+    assert kv_cache.get_attn_mask()[:, 0, 0].tolist() == [[True] * 5, [True] * 3 + [False] * 2]
+    assert kv_cache.get_pos().tolist() == [5, 3]
+
+
+class FakeTokenizer:
+    """Just enough of the tokenizer interface for the Engine, with ids as text."""
+    special = ["<|bos|>", "<|python_start|>", "<|python_end|>", "<|output_start|>", "<|output_end|>", "<|assistant_end|>"]
+
+    def encode_special(self, s):
+        return self.special.index(s)
+
+    def get_bos_token_id(self):
+        return 0
+
+    def encode(self, s):
+        return [10 + int(c) for c in s if c.isdigit()]
+
+    def decode(self, ids):
+        return "".join(str(i) for i in ids)
+
+
+def make_engine(seed=0, vocab_size=64):
+    # a tiny model with the default (random) nn init, so that generations are not degenerate
+    torch.manual_seed(seed)
+    config = GPTConfig(sequence_len=64, vocab_size=vocab_size, n_layer=2, n_head=4, n_kv_head=2, n_embd=32)
+    model = GPT(config)
+    model.eval()
+    return Engine(model, FakeTokenizer())
+
+
+def reference(engine, tokens, **kwargs):
+    return [column[0] for column, _ in engine.generate(tokens, num_samples=1, **kwargs)]
+
+
+def test_paged_kv_cache():
+    num_heads, head_dim, num_layers, block_size = 2, 3, 2, 4
+    kv_cache = PagedKVCache(num_blocks=4, num_heads=num_heads, head_dim=head_dim, num_layers=num_layers, block_size=block_size)
+
+    def insert(seq_ids, values):
+        # insert one token per sequence, with keys filled with the given values (values are negated)
+        kv_cache.set_batch(seq_ids)
+        k = torch.tensor(values, dtype=torch.float32)[:, None, None, None].expand(-1, num_heads, 1, head_dim)
+        for layer_idx in range(num_layers):
+            keys, values = kv_cache.insert_kv(layer_idx, k, -k)
+        return keys # (B, H, T, D)
+
+    a = kv_cache.new_sequence()
+    for i in range(6):
+        insert([a], [i])
+    assert kv_cache.block_tables[a] == [0, 1] and kv_cache.num_free_blocks == 2
+    # a fork shares all blocks, and writing to the shared partial block copies it first
+    b = kv_cache.fork(a)
+    keys = insert([a, b], [6, 100])
+    assert kv_cache.block_tables[a][0] == kv_cache.block_tables[b][0]
+    assert kv_cache.block_tables[a][1] != kv_cache.block_tables[b][1]
+    assert keys[0, 0, :, 0].tolist() == [0, 1, 2, 3, 4, 5, 6]
+    assert keys[1, 0, :, 0].tolist() == [0, 1, 2, 3, 4, 5, 100]
+    assert kv_cache.get_pos().tolist() == [7, 7]
+    # rows at different positions, and a new block for b when it crosses the boundary
+    c = kv_cache.new_sequence()
+    keys = insert([a, b, c], [7, 101, 200])
+    assert kv_cache.get_pos().tolist() == [8, 8, 1]
+    assert keys[2, 0, 0, 0].item() == 200
+    mask = kv_cache.get_attn_mask()
+    assert mask.shape == (3, 1, 1, 8) and mask[2, 0, 0].tolist() == [True] + [False] * 7
+    # out of blocks: the pool grows, and the existing pages survive it
+    keys = insert([a, b, c], [8, 102, 201])
+    assert kv_cache.num_blocks == 8
+    assert keys[0, 0, :, 0].tolist() == [0, 1, 2, 3, 4, 5, 6, 7, 8]
+    assert keys[1, 0, :, 0].tolist() == [0, 1, 2, 3, 4, 5, 100, 101, 102]
+    # freeing returns only the blocks nobody else uses
+    num_free = kv_cache.num_free_blocks
+    kv_cache.free_sequence(a)
+    assert kv_cache.num_free_blocks == num_free + 2 # block 0 is still used by b
+    kv_cache.free_sequence(b)
+    kv_cache.free_sequence(c)
+    assert kv_cache.num_free_blocks == kv_cache.num_blocks
+
+
+def test_engine_matches_naive_generate():
+    """The paged KV cache must not change what the model generates."""
+    engine = make_engine()
+    for tokens in [[0, 7, 8, 9], [0, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36]]:
+        expected = list(engine.model.generate(tokens, max_tokens=40, temperature=0.0))
+        stream = engine.generate(tokens, num_samples=3, max_tokens=40, temperature=0.0)
+        for (token_column, token_masks), token in zip(stream, expected):
+            if 0 in token_masks:
+                break # tool output was forced in, model.generate knows nothing about tools
+            assert token_column == [token] * 3
+
+
+def test_batch_scheduler_matches_engine():
+    """Continuous batching must produce the same tokens as generating each prompt on its own."""
+    engine = make_engine()
+    prompts = [[0, 7, 8, 9], [0, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29], [0, 40], [0, 33, 34, 35, 36, 37]]
+    settings = [dict(max_tokens=12, temperature=0.0), dict(max_tokens=20, temperature=0.0),
+                dict(max_tokens=5, temperature=1.0, seed=3), dict(max_tokens=16, temperature=0.8, top_k=8, seed=2)]
+    scheduler = BatchScheduler(engine, max_batch_size=3)
+    # more requests than rows, and one that joins while the others are decoding
+    requests = [scheduler.submit(p, **kw) for p, kw in zip(prompts[:3], settings[:3])]
+    scheduler.step()
+    scheduler.step()
+    requests.append(scheduler.submit(prompts[3], **settings[3]))
+    while scheduler.num_active or scheduler.num_waiting:
+        assert scheduler.num_active <= 3
+        scheduler.step()
+    for request, p, kw in zip(requests, prompts, settings):
+        assert request.finished
+        assert [token for token, _ in request] == reference(engine, p, **kw)
+
+
+def test_batch_scheduler_thread_and_cancel():
+    engine = make_engine()
+    scheduler = BatchScheduler(engine, max_batch_size=4, max_seq_len=32)
+    scheduler.start()
+    try:
+        # generation stops at the end of the cache when there is no max_tokens
+        long_request = scheduler.submit([0, 11, 12], temperature=0.0)
+        outputs = [scheduler.submit([0, 13 + i], max_tokens=8, temperature=0.0) for i in range(3)]
+        cancelled = scheduler.submit([0, 20], temperature=1.0)
+        cancelled.cancel()
+        tokens = [token for token, _ in long_request]
+        assert len(tokens) <= 32 - 3
+        assert tokens == reference(engine, [0, 11, 12], max_tokens=len(tokens), temperature=0.0)
+        for i, request in enumerate(outputs):
+            assert [token for token, _ in request] == reference(engine, [0, 13 + i], max_tokens=8, temperature=0.0)
+        list(cancelled)
+        assert cancelled.finished
+    finally:
+        scheduler.stop()
+    assert scheduler.num_active == 0
+
+
+def test_batch_scheduler_failed_admission():
+    engine = make_engine()
+    scheduler = BatchScheduler(engine, max_batch_size=4)
+    scheduler.stop() # never started, nothing to do
+    running = scheduler.submit([0, 11, 12], max_tokens=8, temperature=0.0)
+    scheduler.step()
+    bad = scheduler.submit([0, 1000]) # out of the vocab, its prefill fails
+    scheduler.step()
+    assert bad.finished and isinstance(bad.error, IndexError)
+    assert scheduler.num_active == 1 and not running.finished
+    while scheduler.num_active:
+        scheduler.step()
+    expected = reference(engine, [0, 11, 12], max_tokens=8, temperature=0.0)
+    assert [token for token, _ in running] == expected
+    assert scheduler.num_reserved_blocks == 0
+    # the same in the background thread, where a failed decode step fails all the running rows
+    scheduler.start()
+    try:
+        running = scheduler.submit([0, 11, 12], max_tokens=8, temperature=0.0)
+        tokens = iter(running)
+        first = next(tokens) # running is in the batch now
+        bad = scheduler.submit([0, 1000])
+        with pytest.raises(IndexError):
+            list(bad)
+        assert [token for token, _ in [first, *tokens]] == expected
+        assert running.error is None
+    finally:
+        scheduler.stop()
+    assert scheduler.num_reserved_blocks == 0
+
+
+def test_batch_scheduler_cache_budget():
+    """Requests wait for cache pages instead of overcommitting the pool."""
+    engine = make_engine()
+    # 6 blocks of 16 tokens: room for 3 requests of up to 32 tokens, or 1 of the full 64
+    scheduler = BatchScheduler(engine, max_batch_size=8, max_seq_len=64, num_blocks=6)
+    requests = [scheduler.submit([0, 10 + i], max_tokens=30, temperature=0.0) for i in range(4)]
+    scheduler.step()
+    assert scheduler.num_active == 3 and scheduler.num_waiting == 1
+    while scheduler.num_active or scheduler.num_waiting:
+        assert scheduler.kv_cache.num_blocks == 6
+        scheduler.step()
+    for i, request in enumerate(requests):
+        assert [token for token, _ in request] == reference(engine, [0, 10 + i], max_tokens=30, temperature=0.0)
+    # idle pages hold cached prefixes until they are needed
+    assert scheduler.kv_cache.num_free_blocks + scheduler.prefix_cache.num_blocks == 6
+    scheduler.prefix_cache.clear()
+    assert scheduler.kv_cache.num_free_blocks == 6
+
+
+def test_prefix_cache():
+    kv_cache = PagedKVCache(num_blocks=8, num_heads=1, head_dim=2, num_layers=1, block_size=4)
+    prefix_cache = PrefixCache(kv_cache, max_tokens=16)
+    seq = kv_cache.new_sequence()
+    kv_cache.block_tables[seq] = [kv_cache._allocate() for _ in range(3)] # pretend 11 tokens were prefilled
+    tokens = list(range(11))
+    prefix_cache.insert(tokens, kv_cache.block_tables[seq])
+    assert prefix_cache.num_blocks == 2 # only full blocks are cached
+    assert prefix_cache.match(tokens) == [0, 1]
+    assert prefix_cache.match(tokens[:8]) == [0] # at least one token is left to prefill
+    assert prefix_cache.match(tokens[:4] + [99] * 8) == [0]
+    assert prefix_cache.match([99] * 12) == []
+    kv_cache.free_sequence(seq)
+    assert kv_cache.num_free_blocks == 6 # the cached blocks stay allocated
+    # a second branch that shares the first block, then a third one that goes over the budget
+    other = [0, 1, 2, 3, 7, 7, 7, 7, 7]
+    prefix_cache.insert(other, [0, kv_cache._allocate()])
+    prefix_cache.match(tokens) # make the first branch the most recently used
+    prefix_cache.insert([5] * 12, [kv_cache._allocate() for _ in range(3)])
+    # 16 tokens of budget: the two least recently used leaves are gone, the shared block stays
+    assert prefix_cache.num_blocks == 4
+    assert prefix_cache.match(other) == [0]
+    assert prefix_cache.match(tokens) == [0]
+    assert len(prefix_cache.match([5] * 13)) == 3
+    # the allocator reclaims cached blocks before it grows the pool
+    blocks = [kv_cache._allocate() for _ in range(kv_cache.num_free_blocks + 1)]
+    assert blocks == [1, 6, 7, 0] # the free blocks, then the least recently used cached block
+    assert kv_cache.num_blocks == 8 and prefix_cache.num_blocks == 3
+    assert prefix_cache.match(tokens) == [] and prefix_cache.match([5] * 13) == [3, 4, 5]
+
+
+def test_engine_prefix_cache():
+    """The next turn of a chat only prefills the new tokens, and generates the same as without the cache."""
+    engine = make_engine()
+    cached_engine = Engine(engine.model, engine.tokenizer, prefix_cache_tokens=256)
+    prefill_lengths = []
+    forward = engine.model.forward
+    def recording_forward(idx, *args, **kwargs):
+        prefill_lengths.append(idx.size(1))
+        return forward(idx, *args, **kwargs)
+    engine.model.forward = recording_forward
+    conversation = [0] + list(range(20, 40))
+    for turn in range(3):
+        prefill_lengths.clear()
+        reply = [column[0] for column, _ in cached_engine.generate(conversation, max_tokens=10, temperature=0.0)]
+        assert reply == reference(engine, conversation, max_tokens=10, temperature=0.0)
+        if turn > 0:
+            # everything but the new message and the partial last block came from the cache
+            assert prefill_lengths[0] < 16 + 5
+        conversation = conversation + reply + [40 + turn, 41 + turn, 42 + turn, 43 + turn, 44 + turn]
+    # several samples need a bigger pool: it grows once, before the prefill, not while decoding
+    kv_cache = cached_engine.prefix_cache.kv_cache
+    grow, grown_at = kv_cache._grow, []
+    kv_cache._grow = lambda *args: (grown_at.append(len(prefill_lengths)), grow(*args))
+    prefill_lengths.clear()
+    results = cached_engine.generate_batch(conversation, num_samples=4, max_tokens=10, temperature=1.0)
+    assert grown_at == [0]
+    assert results == engine.generate_batch(conversation, num_samples=4, max_tokens=10, temperature=1.0)
+
+
+def test_batch_scheduler_prefix_cache():
+    engine = make_engine()
+    scheduler = BatchScheduler(engine, max_batch_size=4, max_seq_len=128)
+    conversation = [0] + list(range(20, 50))
+    for turn in range(3):
+        request = scheduler.submit(conversation, max_tokens=12, temperature=0.0)
+        if turn > 0:
+            assert len(scheduler.prefix_cache.match(conversation)) >= 2
+        while scheduler.num_active or scheduler.num_waiting:
+            scheduler.step()
+        reply = [token for token, _ in request]
+        assert reply == reference(engine, conversation, max_tokens=12, temperature=0.0)
+        conversation = conversation + reply + [50 + turn, 51 + turn]
+
+
+def test_sample_tokens():
+    logits = torch.tensor([[2.0, 1.0, 0.5, -1.0]]).expand(20000, -1)
+    n = logits.size(0)
+    offsets = torch.arange(n)
+    def sample(temperature, top_k=None, top_p=None, seed=0):
+        params = sampling_params([temperature] * n, [top_k] * n, [top_p] * n, [row_seed(seed)] * n, "cpu")
+        return sample_tokens(logits, *params, offsets)
+    def frequencies(tokens):
+        return torch.bincount(tokens, minlength=4).float() / n
+    # temperature 1 follows the softmax, a counter based stream is a proper random stream
+    assert torch.allclose(frequencies(sample(1.0)), torch.softmax(logits[0], dim=-1), atol=0.015)
+    assert torch.allclose(frequencies(sample(0.5)), torch.softmax(logits[0] / 0.5, dim=-1), atol=0.015)
+    # greedy, and the filters
+    assert (sample(0.0) == 0).all() and (sample(1.0, top_k=1) == 0).all() and (sample(1.0, top_p=0.01) == 0).all()
+    top2 = torch.softmax(logits[0, :2], dim=-1)
+    assert torch.allclose(frequencies(sample(1.0, top_k=2))[:2], top2, atol=0.015)
+    assert (sample(1.0, top_k=2) < 2).all()
+    assert (sample(1.0, top_p=0.8) < 3).all() # 2 tokens have 0.84 of the mass, the third is in too
+    assert (sample(1.0, top_p=0.6) < 2).all()
+    # the same seed and offset give the same token in any batch, different seeds are independent
+    tokens = sample(1.0)
+    params = sampling_params([1.0], [None], [None], [row_seed(0)], "cpu")
+    assert sample_tokens(logits[:1], *params, offsets[123:124]).item() == tokens[123].item()
+    assert (sample(1.0, seed=1) != tokens).float().mean() > 0.3
+    # heterogeneous rows in one batch
+    params = sampling_params([0.0, 1.0, 1.0], [None, 1, None], [None, None, 0.01], [1, 2, 3], "cpu")
+    assert sample_tokens(logits[:3], *params, offsets[:3]).tolist() == [0, 0, 0]
+    # a row samples the same token whichever path (greedy only, unfiltered, top-k, top-p) its batch takes
+    assert sampling_params([0.0, 0.0], [None, 5], [None, 0.5], [1, 2], "cpu")[0] is None
+    logits = torch.randn(3, 50)
+    offsets = torch.tensor([7, 7, 7])
+    batches = [([1.0, 1.0, 0.0], [None, None, None], [None, None, None]), ([1.0, 1.0, 0.0], [None, 3, None], [None, None, None]),
+               ([1.0, 1.0, 0.0], [None, None, None], [None, 0.9, None]), ([1.0, 1.0, 0.0], [None, 3, 50], [None, 0.9, None])]
+    rows = [sample_tokens(logits, *sampling_params(t, k, p, [5, 5, 5], "cpu"), offsets).tolist() for t, k, p in batches]
+    assert len({(row[0], row[2]) for row in rows}) == 1
+    assert rows[0][2] == logits[2].argmax().item()
+
+
+def test_engine_per_row_sampling():
+    engine = make_engine()
+    tokens = [0, 7, 8, 9]
+    # every sample draws its own first token
+    first = next(engine.generate(tokens, num_samples=16, max_tokens=1, temperature=1.0))[0]
+    assert len(set(first)) > 1
+    # and rows can have their own settings
+    results, _ = engine.generate_batch(tokens, num_samples=3, max_tokens=[3, 8, 5], temperature=[0.0, 1.0, 0.0])
+    greedy = reference(engine, tokens, max_tokens=5, temperature=0.0)
+    assert results[0][len(tokens):] == greedy[:3] and results[2][len(tokens):] == greedy
+    assert len(results[1]) <= len(tokens) + 8
+    # max_tokens=0 generates nothing, for all rows or just some of them
+    assert list(engine.generate(tokens, num_samples=2, max_tokens=0)) == []
+    assert engine.generate_batch(tokens, num_samples=2, max_tokens=0) == ([tokens] * 2, [[0] * len(tokens)] * 2)
+    results, _ = engine.generate_batch(tokens, num_samples=2, max_tokens=[0, 5], temperature=0.0)
+    assert results == [tokens, tokens + greedy]
+    # the first sample of a seed is what a single sample with that seed gives
+    column = [c for c, _ in engine.generate(tokens, num_samples=4, max_tokens=6, temperature=1.0, seed=7)]
+    assert [c[0] for c in column] == reference(engine, tokens, max_tokens=6, temperature=1.0, seed=7)
+    # with a list of seeds, every sample is what a single sample with its seed gives
+    column = [c for c, _ in engine.generate(tokens, num_samples=3, max_tokens=6, temperature=1.0, seed=[7, 8, 9])]
+    for i, seed in enumerate([7, 8, 9]):
+        assert [c[i] for c in column] == reference(engine, tokens, max_tokens=6, temperature=1.0, seed=seed)
+
+
+def test_engine_on_device_tool_use():
+    """The on-device state machine must match the host one, whatever the sync interval."""
+    engine = make_engine(vocab_size=24) # few tokens, so that the samples call the calculator
+    tokens = [0, 11, 12]
+    kwargs = dict(num_samples=16, max_tokens=40, temperature=1.0, seed=2)
+    expected = engine.generate_batch(tokens, sync_every=1, **kwargs)
+    for sync_every in [3, 8, 64]:
+        assert engine.generate_batch(tokens, sync_every=sync_every, **kwargs) == expected
+    results, masks = expected
+    assert any(0 in mask[len(tokens):] for mask in masks) # some tool output was forced in
+    # the scheduler runs the host version of the state machine, one row at a time
+    scheduler = BatchScheduler(engine, max_batch_size=16)
+    requests = [scheduler.submit(tokens, max_tokens=40, temperature=1.0, seed=row_seed(2, i)) for i in range(16)]
+    while scheduler.num_active or scheduler.num_waiting:
+        scheduler.step()
+    for request, result, mask in zip(requests, results, masks):
+        generated = [(token, m) for token, m in request if token not in (0, 5)]
+        assert generated == list(zip(result[len(tokens):], mask[len(tokens):]))